@@ -3,13 +3,49 @@
 import os
 import json
 import datetime
-from flask import Flask, request, jsonify, render_template, session, redirect, url_for, flash , send_file
+import math
+from flask import Flask, request, jsonify, render_template, session, redirect, url_for, flash , send_file, Response, stream_with_context, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-import glob
+from werkzeug.wsgi import wrap_file
 import re
-import base64 
+import base64
+import io
+import threading
+import time
+import atexit
+import hashlib
+import gzip
+import shutil
+import mmap
+import struct
+import zlib
+import hmac
+import random
+import queue
+import logging
+import logging.handlers
+import contextvars
+import mimetypes
+import urllib.parse
+import functools
+import csv
+import multiprocessing
+import click
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image, features as pil_features
+import numpy as np
+try:
+    import brotli # 選用套件：未安裝時只提供 gzip 壓縮
+except ImportError:
+    brotli = None
 
 # --- App Configuration ---
 app = Flask(__name__, instance_relative_config=True)
@@ -18,6 +54,110 @@ app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['BEHAVIOR_REPORT_FOLDER'] = os.path.join(app.root_path, 'SynologyDrive\json_behavior')
 app.config['STUDENT_WEEK_PHOTO_FOLDER'] = r'C:\Users\User\Desktop\test\student_week_photo'
+app.config['WSGI_THREADS'] = 16 # 部署時 WSGI 伺服器的請求執行緒數 (waitress threads / gunicorn --threads)，用來決定儲存空間的名額
+app.config['FILESYSTEM_IO_WORKERS'] = 16 # 專門存取報告/影像儲存空間的執行緒數量；都在忙碌時新的檔案操作排隊等待
+app.config['FILESYSTEM_IO_RESERVED_THREADS'] = 4 # 保留給登入與事件記錄的請求執行緒數，同時使用儲存空間的請求最多 WSGI_THREADS 減去此數
+app.config['FILESYSTEM_IO_SLOT_WAIT_SECONDS'] = 10.0 # 請求等待儲存空間名額的最長秒數，逾時回應 503
+app.config['FILESYSTEM_IO_TIMEOUT_SECONDS'] = 15.0 # 請求等待單一檔案操作的最長秒數，逾時回應 503
+app.config['REPORT_CATALOG_REFRESH_SECONDS'] = 60 # 報告目錄背景增量掃描的間隔 (秒)
+app.config['REPORT_SIDECAR_FOLDER'] = os.path.join(app.instance_path, 'report_sidecars') # 報告摘要 (sidecar) 存放位置
+app.config['REPORT_SUMMARY_CACHE_MAX_BYTES'] = 32 * 1024 * 1024 # 記憶體中報告摘要快取的容量上限
+app.config['REPORT_RESPONSE_CACHE_MAX_BYTES'] = 64 * 1024 * 1024 # 預先序列化/壓縮的報告回應快取上限
+app.config['RESPONSE_GZIP_LEVEL'] = 6
+app.config['RESPONSE_BROTLI_QUALITY'] = 5
+app.config['REPORT_BATCH_PAGE_SIZE'] = 10 # /api/student/report_batches 預設每次回傳的批次數
+app.config['REPORT_BATCH_MAX_PAGE_SIZE'] = 50 # 每次最多可取得的批次數
+app.config['IMAGE_VARIANT_SIZES'] = {'thumb': 320, 'medium': 960} # 縮圖最長邊 (像素)，'original' 代表原圖
+app.config['KEYFRAME_CACHE_MAX_AGE'] = 365 * 24 * 3600 # 帶版本參數 (v=) 的影像 URL 內容不會改變，瀏覽器可快取這麼久
+# 在 nginx 後方執行時：{磁碟資料夾: nginx internal location}，影像以 X-Accel-Redirect 交由 nginx 送出；
+# Apache/lighttpd 則改設定 USE_X_SENDFILE = True (Flask 內建的 X-Sendfile 支援)
+app.config['X_ACCEL_REDIRECT_LOCATIONS'] = {}
+# 每日封裝檔 (flask pack-day) 所在資料夾；None 代表不使用，報告與關鍵影格都以個別檔案讀取
+app.config['PACKED_STORAGE_FOLDER'] = None
+app.config['PACKED_STORAGE_REFRESH_SECONDS'] = 30 # 檢查封裝檔是否新增/替換的間隔 (秒)
+app.config['IMAGE_VARIANT_CACHE_FOLDER'] = os.path.join(app.instance_path, 'image_variants')
+app.config['IMAGE_VARIANT_CACHE_MAX_BYTES'] = 1024 * 1024 * 1024 # 縮圖磁碟快取上限
+app.config['IMAGE_VARIANT_TOUCH_INTERVAL_SECONDS'] = 3600 # 使用順序記在記憶體中，命中時最多每隔幾秒才更新一次檔案修改時間 (供重新啟動後重建順序)
+app.config['IMAGE_VARIANT_WORKERS'] = os.cpu_count() or 4 # 產生縮圖的工作執行緒數量
+app.config['CONTACT_SHEET_TILE_SIZE'] = 160 # 關鍵影格拼貼圖中每格的最長邊 (像素)
+app.config['CONTACT_SHEET_COLUMNS'] = 8
+app.config['CONTACT_SHEET_MAX_IMAGES'] = 200 # 單張拼貼圖最多包含的影像數，超過的部分不放入
+app.config['CONTACT_SHEET_CACHE_MAX_BYTES'] = 64 * 1024 * 1024 # 記憶體中拼貼圖快取的容量上限
+app.config['CLICK_LOG_FLUSH_SIZE'] = 200 # 暫存的事件數達到此數量時立即寫入資料庫
+app.config['CLICK_LOG_FLUSH_INTERVAL_SECONDS'] = 2.0 # 否則最多每隔幾秒寫入一次
+app.config['CLICK_LOG_MAX_EVENTS_PER_REQUEST'] = 500 # /api/log_events 單次請求可送出的事件上限
+app.config['CLICK_LOG_MAX_DURATION_SECONDS'] = 24 * 3600 # duration_seconds 的合理上限，超出範圍的值存為 NULL
+app.config['CLICK_LOG_MAX_EVENT_AGE_SECONDS'] = 300 # 前端暫存事件的 age_ms 最多可把事件時間往前推多久
+app.config['CLICK_LOG_MAX_PENDING_EVENTS'] = 50000 # 記憶體中等待寫入的事件上限，資料庫持續無法寫入時超過的新事件直接丟棄
+app.config['CLICK_LOG_MAX_FLUSH_ATTEMPTS'] = 5 # 同一批事件寫入失敗幾次後放棄，改寫入 dead-letter 檔案
+app.config['CLICK_LOG_DEAD_LETTER_FOLDER'] = os.path.join(app.instance_path, 'click_log_dead_letter') # 放棄寫入的事件 (每天一個 .jsonl)
+app.config['CLICK_LOG_RETENTION_DAYS'] = 90 # 原始 ClickLog 保留天數，更早的事件封存後從資料表刪除 (flask compact-click-logs)
+app.config['CLICK_LOG_ARCHIVE_FOLDER'] = os.path.join(app.instance_path, 'click_log_archive') # 封存檔 (每月一個資料夾，每天一個 .jsonl.gz)
+app.config['SESSION_INACTIVITY_TIMEOUT_SECONDS'] = 1800 # 兩筆事件間隔超過此秒數視為離開 (30分鐘)
+app.config['SESSION_DWELL_LOOKBACK_DAYS'] = 7 # 未指定日期時，估計停留時間所涵蓋的天數
+app.config['SUMMARY_MAX_PAGE_SIZE'] = 200 # 班級摘要每頁最多回傳的學生數
+app.config['SUMMARY_REPORT_WORKERS'] = 8 # 班級摘要同時交給檔案系統執行緒池讀取的學生報告數 (滑動視窗大小)
+app.config['SUMMARY_STUDENT_TIMEOUT_SECONDS'] = 5.0 # 單一學生報告讀取的逾時秒數，逾時則顯示「無報告」
+app.config['SUMMARY_REQUEST_DEADLINE_SECONDS'] = 20.0 # 整個班級摘要請求等待報告的總時限，之後尚未完成的學生都以「無報告」代替
+app.config['NON_TASK_ATTENTION_THRESHOLD'] = 30.0 # 非任務行為佔比 (%) 超過此值的學生列為需要關注
+app.config['CLASS_SUMMARY_CACHE_SIZE'] = 64 # 班級彙總結果快取的 (班級, 日期) 組合數上限
+app.config['TREND_DEFAULT_WEEKS'] = 8 # 行為趨勢 API 預設涵蓋的週數
+app.config['TREND_MAX_WEEKS'] = 104 # 行為趨勢 API 可查詢的最大週數
+app.config['LOG_LEVEL'] = 'INFO'
+app.config['LOG_SAMPLE_RATES'] = {'DEBUG': 0.1} # 各層級實際輸出的比例，未列出的層級全部輸出
+app.config['LOG_QUEUE_SIZE'] = 10000 # 日誌佇列滿時直接丟棄新紀錄，不阻塞請求
+app.config['DASHBOARD_EVENTS_HEARTBEAT_SECONDS'] = 15 # SSE 連線閒置時送出註解行的間隔，避免被代理伺服器斷線
+app.config['DASHBOARD_EVENTS_QUEUE_SIZE'] = 256 # 每個 SSE 訂閱者的待送事件上限，超過時要求前端重新載入
+app.config['DASHBOARD_EVENTS_HISTORY_SIZE'] = 512 # 保留最近的事件數，斷線重連時依 Last-Event-ID 補送
+app.config['DASHBOARD_EVENTS_MAX_REPORT_CHANGES'] = 50 # 單次掃描變動的報告超過此數量時改送 resync，不逐一推送
+app.config['REPORT_WATCH_INTERVAL_SECONDS'] = 5 # 有教師訂閱即時更新時，掃描報告資料夾的間隔 (秒)
+app.config['IDENTITY_CACHE_TTL_SECONDS'] = 60 # 登入身分快取的有效秒數；帳號在其他行程被修改時最多延遲這麼久生效
+app.config['IDENTITY_CACHE_MAX_ENTRIES'] = 4096
+app.config['USER_IMPORT_HASH_WORKERS'] = os.cpu_count() or 4 # 批次匯入帳號時計算密碼雜湊的行程數
+app.config['USER_IMPORT_BATCH_SIZE'] = 500 # 批次匯入時每個交易寫入的帳號數
+app.config['USER_IMPORT_MAX_ROWS'] = 5000 # 單次匯入的 CSV 資料列上限
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN') # Prometheus 抓取 /api/admin/metrics 用的 Bearer token
+app.config['METRICS_ALLOW_LOOPBACK'] = False # 允許本機 (127.0.0.1/::1) 不帶 token 存取；在同一台主機的反向代理後方時不要開啟 (所有請求都來自本機)
+# 以 FLASK_ 開頭的環境變數覆寫上述設定，例如 FLASK_BEHAVIOR_REPORT_FOLDER、FLASK_STUDENT_WEEK_PHOTO_FOLDER、
+# FLASK_SQLALCHEMY_DATABASE_URI；合成資料產生器與效能測試 (generate_synthetic_data.py / benchmark.py) 依此指向測試資料
+app.config.from_prefixed_env()
+
+# --- Logging (日誌) ---
+# 請求執行緒只把紀錄放進佇列，由背景的 QueueListener 寫到 stdout；低層級的紀錄依比例抽樣。
+logger = logging.getLogger('classroom_detect')
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, sample_rates):
+        super().__init__()
+        self.sample_rates = sample_rates
+
+    def filter(self, record):
+        rate = self.sample_rates.get(record.levelname, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """佇列已滿時丟棄紀錄並計數，而不是阻塞或印出錯誤。"""
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+log_queue = queue.Queue(maxsize=app.config['LOG_QUEUE_SIZE'])
+log_queue_handler = DroppingQueueHandler(log_queue)
+log_queue_handler.addFilter(SamplingFilter(app.config['LOG_SAMPLE_RATES']))
+_log_output_handler = logging.StreamHandler()
+_log_output_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(threadName)s] %(message)s'))
+log_queue_listener = logging.handlers.QueueListener(log_queue, _log_output_handler)
+logger.addHandler(log_queue_handler)
+logger.setLevel(app.config['LOG_LEVEL'])
+logger.propagate = False
+log_queue_listener.start()
+atexit.register(log_queue_listener.stop)
 
 db = SQLAlchemy(app)
 login_manager = LoginManager(app)
@@ -52,61 +192,3004 @@ class ClickLog(db.Model):
     timestamp = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
     duration_seconds = db.Column(db.Integer, nullable=True) # 新增: 記錄停留時長 (秒)
 
-    def __repr__(self):
-        return f"Log(User ID '{self.user_id}', Type '{self.event_type}', Target '{self.element_or_page_id}', Duration '{self.duration_seconds}')"
-    
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
+    __table_args__ = (
+        db.Index('ix_click_log_user_time', 'user_id', 'timestamp'), # 停留時間計算: 依學生與時間區間取出事件
+        db.Index('ix_click_log_time', 'timestamp'), # 保存期限: 依日期找出要封存的事件
+    )
+
+    def __repr__(self):
+        return f"Log(User ID '{self.user_id}', Type '{self.event_type}', Target '{self.element_or_page_id}', Duration '{self.duration_seconds}')"
+
+# 班級：由一位教師負責；教師的儀表板與班級 API 只查詢自己班級的學生。一位學生可以屬於多個班級。
+class SchoolClass(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), unique=True, nullable=False)
+    teacher_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    enrollments = db.relationship('Enrollment', backref='school_class', lazy='dynamic', cascade='all, delete-orphan')
+
+    def __repr__(self):
+        return f"SchoolClass('{self.name}', Teacher ID '{self.teacher_id}')"
+
+class Enrollment(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    class_id = db.Column(db.Integer, db.ForeignKey('school_class.id'), nullable=False)
+    student_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('class_id', 'student_id', name='uq_enrollment_class_student'), # 依班級查學生
+        db.Index('ix_enrollment_student', 'student_id'), # 依學生查所屬班級
+    )
+
+    def __repr__(self):
+        return f"Enrollment(Class ID '{self.class_id}', Student ID '{self.student_id}')"
+
+# 活動彙總表：依 (學生, 日期, 事件類型, 目標ID) 累計次數與停留秒數，在寫入 ClickLog 時同步更新
+class ActivityRollup(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False) # 依 ClickLog.timestamp (UTC) 的日期
+    event_type = db.Column(db.String(50), nullable=False)
+    element_or_page_id = db.Column(db.String(100), nullable=False)
+    event_count = db.Column(db.Integer, nullable=False, default=0)
+    total_duration_seconds = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'day', 'event_type', 'element_or_page_id', name='uq_activity_rollup_key'),
+        db.Index('ix_activity_rollup_day_user', 'day', 'user_id'),
+    )
+
+    def __repr__(self):
+        return f"ActivityRollup(User ID '{self.user_id}', Day '{self.day}', Type '{self.event_type}', Target '{self.element_or_page_id}', Count '{self.event_count}')"
+
+# 已封存的 ClickLog 日期 (UTC)：超過保存期限的原始事件匯出到封存檔後才刪除，兩個步驟的進度記錄在這裡，
+# 中斷後重新執行會從未完成的步驟繼續
+class ClickLogArchiveDay(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False, unique=True)
+    status = db.Column(db.String(10), nullable=False) # 'exported' 已寫出封存檔、'compacted' 已刪除原始事件
+    row_count = db.Column(db.Integer, nullable=False) # 封存檔中的事件數
+    max_log_id = db.Column(db.Integer, nullable=False) # 封存的最大 ClickLog.id，刪除時只刪到這裡
+    archive_path = db.Column(db.String(255), nullable=False) # 相對於 CLICK_LOG_ARCHIVE_FOLDER
+    sha256 = db.Column(db.String(64), nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    compacted_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"ClickLogArchiveDay('{self.day}', '{self.status}', '{self.row_count}')"
+
+# 每位學生每天各頁面的停留秒數：寫入 ClickLog 時以會話切割重算受影響的學生與日期，封存刪除原始事件後仍保留
+class PageDwellDaily(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    element_or_page_id = db.Column(db.String(100), nullable=False)
+    dwell_seconds = db.Column(db.Float, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'day', 'element_or_page_id', name='uq_page_dwell_daily_key'),
+        db.Index('ix_page_dwell_daily_day_user', 'day', 'user_id'),
+    )
+
+    def __repr__(self):
+        return f"PageDwellDaily(User ID '{self.user_id}', Day '{self.day}', Page '{self.element_or_page_id}', Seconds '{self.dwell_seconds}')"
+
+# 報告目錄：記錄 BEHAVIOR_REPORT_FOLDER 中每份報告的摘要，讓 API 不必每次都掃描資料夾
+class ReportCatalogEntry(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    student_name = db.Column(db.String(80), nullable=False, index=True) # 學生資料夾名稱 (即 username)
+    filename = db.Column(db.String(255), nullable=False)
+    report_date = db.Column(db.String(10), nullable=True, index=True) # YYYY-MM-DD，統一從檔名解析
+    report_generation_time = db.Column(db.String(50), nullable=True) # JSON 中的原始字串
+    report_datetime = db.Column(db.DateTime, nullable=True) # 解析後的時間，用於排序與顯示
+    file_size = db.Column(db.Integer, nullable=False)
+    file_mtime = db.Column(db.Float, nullable=False)
+    report_metadata_json = db.Column(db.Text, nullable=True) # 完整的 report_metadata (JSON 字串)
+    parse_error = db.Column(db.String(255), nullable=True) # 非空代表檔案無法解析
+    keyframe_manifest_json = db.Column(db.Text, nullable=True) # 關鍵影格清單 (見 build_keyframe_manifest)
+    scanned_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    __table_args__ = (db.UniqueConstraint('student_name', 'filename', name='uq_report_catalog_student_file'),)
+
+    @property
+    def report_metadata(self):
+        return json.loads(self.report_metadata_json) if self.report_metadata_json else {}
+
+    @property
+    def file_path(self):
+        return os.path.join(app.config['BEHAVIOR_REPORT_FOLDER'], self.student_name, self.filename)
+
+    def __repr__(self):
+        return f"ReportCatalogEntry('{self.student_name}', '{self.filename}')"
+
+# 行為時間序列：每位學生每個報告日期的各行為佔比，報告進入目錄時同步寫入，供跨日期的趨勢查詢使用
+class BehaviorSeriesPoint(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    student_name = db.Column(db.String(80), nullable=False)
+    report_date = db.Column(db.String(10), nullable=False) # YYYY-MM-DD，與 ReportCatalogEntry.report_date 相同
+    behavior_category = db.Column(db.String(100), nullable=False)
+    percentage = db.Column(db.Float, nullable=False, default=0)
+    count = db.Column(db.Integer, nullable=True)
+    report_filename = db.Column(db.String(255), nullable=False) # 來源報告；同一天有多份報告時只保留最新的一份
+
+    __table_args__ = (
+        db.UniqueConstraint('student_name', 'report_date', 'behavior_category', name='uq_behavior_series_key'),
+        db.Index('ix_behavior_series_date', 'report_date'),
+    )
+
+    def __repr__(self):
+        return f"BehaviorSeriesPoint('{self.student_name}', '{self.report_date}', '{self.behavior_category}', '{self.percentage}')"
+
+# --- Identity Cache (登入身分快取) ---
+# 每個已登入的請求 (包含大量的縮圖與事件紀錄請求) 都會呼叫 load_user；快取 (id, username, role)，
+# 在 TTL 內不必再查詢資料庫。同一行程內修改或刪除 User 時立即失效。
+class CachedUser(UserMixin):
+    """load_user 回傳的唯讀身分，不綁定資料庫 session，可跨請求重複使用；需要修改帳號時請另外查詢 User。"""
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.role = user.role
+
+    def __repr__(self):
+        return f"CachedUser('{self.username}', '{self.role}')"
+
+_identity_cache = OrderedDict() # user_id -> (到期時間 monotonic, CachedUser)
+_identity_cache_lock = threading.Lock()
+_identity_cache_stats = {"hits": 0, "misses": 0}
+
+def invalidate_cached_identity(user_id):
+    with _identity_cache_lock:
+        _identity_cache.pop(user_id, None)
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _invalidate_identity_on_change(mapper, connection, target):
+    invalidate_cached_identity(target.id)
+
+@login_manager.user_loader
+def load_user(user_id):
+    user_id = int(user_id)
+    now = time.monotonic()
+    with _identity_cache_lock:
+        cached = _identity_cache.get(user_id)
+        if cached is not None and cached[0] > now:
+            _identity_cache.move_to_end(user_id)
+            _identity_cache_stats["hits"] += 1
+            return cached[1]
+        _identity_cache_stats["misses"] += 1
+
+    user = db.session.get(User, user_id)
+    if user is None:
+        invalidate_cached_identity(user_id)
+        return None
+    identity = CachedUser(user)
+    with _identity_cache_lock:
+        _identity_cache[user_id] = (now + app.config['IDENTITY_CACHE_TTL_SECONDS'], identity)
+        _identity_cache.move_to_end(user_id)
+        while len(_identity_cache) > app.config['IDENTITY_CACHE_MAX_ENTRIES']:
+            _identity_cache.popitem(last=False)
+    return identity
+
+def role_required(*roles, page=False):
+    """
+    取代 @login_required 並檢查 current_user.role。角色不符時，API 回傳 403 JSON；
+    page=True 的頁面則與原本一樣顯示提示並導回首頁。
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped(*args, **kwargs):
+            if current_user.role not in roles:
+                if page:
+                    flash('權限不足，無法訪問此頁面。', 'warning')
+                    return redirect(url_for('index'))
+                return jsonify({'error': '權限不足'}), 403
+            return view(*args, **kwargs)
+        return login_required(wrapped)
+    return decorator
+
+# --- Class Scope (教師可查詢的學生範圍) ---
+# 教師端的查詢都以班級名單 (Enrollment) 限定學生，成本只取決於班級人數，不隨全校人數增加。
+# 系統中還沒有建立任何班級時維持舊行為：所有學生視為同一班 (DEFAULT_CLASS_ID)。
+DEFAULT_CLASS_ID = 'all'
+
+class ClassScope:
+    """
+    class_id: 指定的班級 id；未指定時為 DEFAULT_CLASS_ID (教師的所有班級，或尚未建立班級時的全部學生)。
+    class_ids: 範圍內的班級 id 列表；None 代表尚未建立班級，所有學生都在範圍內。
+    """
+    def __init__(self, class_id, class_ids, teacher_id):
+        self.class_id = class_id
+        self.class_ids = class_ids
+        self.teacher_id = teacher_id
+
+    @property
+    def cache_key(self):
+        # 未指定班級時，範圍依教師而不同
+        return self.class_id if self.class_id != DEFAULT_CLASS_ID or self.class_ids is None else ('teacher', self.teacher_id)
+
+    def student_ids_select(self):
+        """範圍內學生 id 的子查詢 (以班級 id 走 Enrollment 的索引)；所有學生都在範圍內時回傳 None。"""
+        if self.class_ids is None:
+            return None
+        return db.select(Enrollment.student_id).where(Enrollment.class_id.in_(self.class_ids))
+
+    def student_filters(self):
+        """限定 User 查詢為範圍內學生的條件。"""
+        filters = [User.role == 'student']
+        student_ids = self.student_ids_select()
+        if student_ids is not None:
+            filters.append(User.id.in_(student_ids))
+        return filters
+
+    def student_names_select(self):
+        return db.select(User.username).where(*self.student_filters())
+
+    def contains(self, student_id):
+        return db.session.query(User.id).filter(User.id == student_id, *self.student_filters()).first() is not None
+
+    def student_ids(self):
+        """範圍內學生 id 的集合；所有學生都在範圍內時回傳 None。"""
+        student_ids = self.student_ids_select()
+        return None if student_ids is None else set(db.session.execute(student_ids).scalars())
+
+    def version(self):
+        """班級名單的版本，名單有增減時改變，用於 ETag。"""
+        if self.class_ids is None:
+            return None
+        return db.session.query(db.func.count(Enrollment.id), db.func.max(Enrollment.id)).filter(
+            Enrollment.class_id.in_(self.class_ids)
+        ).one()
+
+class ClassNotFoundError(LookupError):
+    pass
+
+def resolve_class_scope(teacher_id, class_id=None):
+    """
+    依教師與 ?class_id= 決定查詢範圍。指定的班級必須由這位教師負責，否則拋出 ClassNotFoundError。
+    教師沒有任何班級 (但系統中已有其他班級) 時，範圍內沒有學生。
+    """
+    if class_id is not None and class_id != DEFAULT_CLASS_ID:
+        try:
+            class_id = int(class_id)
+        except (TypeError, ValueError):
+            raise ClassNotFoundError(class_id)
+        if db.session.query(SchoolClass.id).filter_by(id=class_id, teacher_id=teacher_id).first() is None:
+            raise ClassNotFoundError(class_id)
+        return ClassScope(class_id, [class_id], teacher_id)
+    class_ids = [class_id for (class_id,) in db.session.query(SchoolClass.id).filter_by(teacher_id=teacher_id).order_by(SchoolClass.id)]
+    if not class_ids and db.session.query(SchoolClass.id).first() is None:
+        return ClassScope(DEFAULT_CLASS_ID, None, teacher_id)
+    return ClassScope(DEFAULT_CLASS_ID, class_ids, teacher_id)
+
+def current_class_scope():
+    """目前登入教師在這個請求的查詢範圍 (?class_id=)；班級不存在或不屬於該教師時拋出 ClassNotFoundError。"""
+    return resolve_class_scope(current_user.id, request.args.get('class_id') or None)
+
+def class_not_found_response():
+    return jsonify({"error": "找不到指定的班級。"}), 404
+
+@app.cli.command('create-class')
+@click.argument('name')
+@click.argument('teacher_username')
+def create_class_command(name, teacher_username):
+    """建立班級並指定負責的教師。"""
+    db.create_all()
+    teacher = User.query.filter_by(username=teacher_username, role='teacher').first()
+    if teacher is None:
+        print(f"找不到教師帳號: {teacher_username}")
+        raise SystemExit(1)
+    if SchoolClass.query.filter_by(name=name).first() is not None:
+        print(f"班級已存在: {name}")
+        raise SystemExit(1)
+    db.session.add(SchoolClass(name=name, teacher_id=teacher.id))
+    db.session.commit()
+    print(f"已建立班級 {name} (教師: {teacher_username})。")
+
+@app.cli.command('enroll-students')
+@click.argument('class_name')
+@click.argument('usernames', nargs=-1, required=True)
+def enroll_students_command(class_name, usernames):
+    """將學生加入班級；已在班級中的學生會略過。"""
+    db.create_all()
+    school_class = SchoolClass.query.filter_by(name=class_name).first()
+    if school_class is None:
+        print(f"找不到班級: {class_name}")
+        raise SystemExit(1)
+    students = dict(db.session.query(User.username, User.id).filter(User.username.in_(usernames), User.role == 'student'))
+    for username in usernames:
+        if username not in students:
+            print(f"找不到學生帳號: {username}")
+    enrolled_before = school_class.enrollments.count()
+    if students:
+        db.session.execute(sqlite_insert(Enrollment).on_conflict_do_nothing(), [
+            {"class_id": school_class.id, "student_id": student_id} for student_id in students.values()
+        ])
+        db.session.commit()
+    enrolled = school_class.enrollments.count()
+    print(f"班級 {class_name} 新加入 {enrolled - enrolled_before} 位學生，目前共 {enrolled} 位。")
+
+# --- Bulk User Import (批次匯入帳號) ---
+# CSV 欄位為 username,password,role (role 可省略，預設 student)。密碼雜湊 (PBKDF2/scrypt) 是 CPU 密集工作，
+# 交給行程池在所有核心上平行計算；已存在的帳號以單一查詢找出，新帳號分批以交易寫入。
+# 任何一列有問題只會記錄在該列的錯誤中，不影響其他列。
+# 教師可透過網頁匯入的角色只有 student；教師帳號只能以 flask import-users 建立，避免教師自行建立其他教師帳號。
+USER_IMPORT_ROLES = ('student', 'teacher')
+USER_IMPORT_WEB_ROLES = ('student',)
+
+class UserImportError(ValueError):
+    """整份 CSV 無法匯入 (編碼錯誤、缺少欄位、超過列數上限)。"""
+
+def parse_user_import_csv(text, allowed_roles=USER_IMPORT_ROLES):
+    """
+    解析匯入用的 CSV 文字，回傳 (可匯入的列, 錯誤列表)。
+    每一列為 {'line', 'username', 'password', 'role'}；錯誤為 {'line', 'username', 'error'}，line 為 CSV 中的行號。
+    role 不在 allowed_roles 中的列記為錯誤。
+    """
+    reader = csv.DictReader(io.StringIO(text))
+    fieldnames = [name.strip().lower() for name in (reader.fieldnames or [])]
+    if 'username' not in fieldnames or 'password' not in fieldnames:
+        raise UserImportError("CSV 第一行必須包含 username 與 password 欄位")
+    reader.fieldnames = fieldnames
+
+    rows, errors, seen = [], [], set()
+    for record in reader:
+        line = reader.line_num
+        if len(rows) + len(errors) >= app.config['USER_IMPORT_MAX_ROWS']:
+            raise UserImportError(f"單次最多匯入 {app.config['USER_IMPORT_MAX_ROWS']} 個帳號")
+        username = (record.get('username') or '').strip()
+        password = record.get('password') or ''
+        role = (record.get('role') or '').strip().lower() or 'student'
+        if not username and not password:
+            continue # 略過空白列
+
+        if not username:
+            error = '缺少帳號名稱'
+        elif len(username) > 80:
+            error = '帳號名稱超過 80 個字元'
+        elif len(password) < 3:
+            error = '密碼長度至少需要3位'
+        elif role not in USER_IMPORT_ROLES:
+            error = f'未知的角色 "{role}"'
+        elif role not in allowed_roles:
+            error = f'不允許匯入角色 "{role}"'
+        elif username in seen:
+            error = 'CSV 中重複的帳號'
+        else:
+            error = None
+        if error:
+            errors.append({'line': line, 'username': username, 'error': error})
+            continue
+        seen.add(username)
+        rows.append({'line': line, 'username': username, 'password': password, 'role': role})
+    return rows, errors
+
+def decode_user_import_csv(data):
+    """上傳的 CSV 位元組轉為文字；接受 Excel 另存的 UTF-8 BOM。"""
+    try:
+        return data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise UserImportError("CSV 必須是 UTF-8 編碼")
+
+def _insert_user_rows(rows, errors):
+    """以單一交易寫入一批帳號；若與同時註冊的帳號衝突，改為逐列寫入以找出是哪幾列。回傳成功筆數。"""
+    values = [{'username': row['username'], 'password_hash': row['password_hash'], 'role': row['role']} for row in rows]
+    try:
+        db.session.execute(db.insert(User), values)
+        db.session.commit()
+        return len(rows)
+    except IntegrityError:
+        db.session.rollback()
+
+    created = 0
+    for row, value in zip(rows, values):
+        try:
+            db.session.execute(db.insert(User), [value])
+            db.session.commit()
+            created += 1
+        except IntegrityError:
+            db.session.rollback()
+            errors.append({'line': row['line'], 'username': row['username'], 'error': '帳號已存在'})
+    return created
+
+_password_hash_pool_lock = threading.Lock()
+_password_hash_pool_state = {"pool": None}
+
+def get_password_hash_pool():
+    """
+    計算密碼雜湊的行程池：第一次匯入時建立，之後重複使用。子行程以 spawn 啟動，
+    因為呼叫端的程序中有日誌、ClickLog 寫入等背景執行緒，fork 出的子行程可能卡在它們持有的鎖上。
+    """
+    with _password_hash_pool_lock:
+        if _password_hash_pool_state["pool"] is None:
+            pool = ProcessPoolExecutor(max_workers=app.config['USER_IMPORT_HASH_WORKERS'],
+                                       mp_context=multiprocessing.get_context('spawn'))
+            _password_hash_pool_state["pool"] = pool
+            atexit.register(pool.shutdown)
+        return _password_hash_pool_state["pool"]
+
+def _discard_password_hash_pool(pool):
+    with _password_hash_pool_lock:
+        if _password_hash_pool_state["pool"] is pool:
+            _password_hash_pool_state["pool"] = None
+    pool.shutdown(wait=False)
+
+def import_users(rows, errors=None):
+    """
+    建立 parse_user_import_csv 解析出的帳號。回傳 {'created', 'errors'}，errors 依 CSV 行號排序。
+    需在 app context 中呼叫。
+    """
+    errors = list(errors or [])
+    if rows:
+        existing = set(db.session.execute(
+            db.select(User.username).where(User.username.in_([row['username'] for row in rows]))
+        ).scalars())
+        for row in rows:
+            if row['username'] in existing:
+                errors.append({'line': row['line'], 'username': row['username'], 'error': '帳號已存在'})
+        rows = [row for row in rows if row['username'] not in existing]
+
+    created = 0
+    if rows:
+        started = time.perf_counter()
+        workers = app.config['USER_IMPORT_HASH_WORKERS']
+        pool = get_password_hash_pool()
+        try:
+            hashes = pool.map(generate_password_hash, [row['password'] for row in rows],
+                              chunksize=max(1, len(rows) // (workers * 4)))
+            for row, password_hash in zip(rows, hashes):
+                row['password_hash'] = password_hash
+        except BrokenProcessPool:
+            _discard_password_hash_pool(pool) # 子行程異常結束：下次匯入時重新建立
+            raise
+        logger.info("已以 %d 個行程計算 %d 組密碼雜湊，耗時 %.2f 秒。", workers, len(rows), time.perf_counter() - started)
+
+        batch_size = app.config['USER_IMPORT_BATCH_SIZE']
+        for start in range(0, len(rows), batch_size):
+            created += _insert_user_rows(rows[start:start + batch_size], errors)
+
+    errors.sort(key=lambda error: error['line'])
+    return {'created': created, 'errors': errors}
+
+@app.cli.command('import-users')
+@click.argument('csv_file', type=click.File('rb'))
+def import_users_command(csv_file):
+    """從 CSV (username,password,role) 批次建立帳號。"""
+    db.create_all()
+    try:
+        rows, errors = parse_user_import_csv(decode_user_import_csv(csv_file.read()))
+    except UserImportError as e:
+        print(f"匯入失敗: {e}")
+        raise SystemExit(1)
+    result = import_users(rows, errors)
+    for error in result['errors']:
+        print(f"第 {error['line']} 行 ({error['username'] or '-'}): {error['error']}")
+    print(f"帳號匯入完成: 建立 {result['created']} 個，{len(result['errors'])} 列有錯誤。")
+
+# --- Helper Functions for Activity Summary ---
+TAB_DISPLAY_NAMES = {
+    'summaryNotesTab': 'AI觀察與建議',
+    'overallStatsTab': '整體行為統計',
+    'timelineTab': '行為趨勢圖',
+    'sequenceDetailsTab': '詳細序列分析'
+}
+PAGE_ENTRY_EVENT_TYPES = {'tab_view_start', 'page_view_start'} # 代表學生進入某頁面/標籤頁
+PAGE_EXIT_EVENT_PREFIX = 'tab_view_end' # 包含 tab_view_end_unload 等變體
+
+def compute_page_dwell_times(user_ids, start_time=None, end_time=None, session_timeout_seconds=None):
+    """
+    一次為多位學生計算各頁面的停留秒數，回傳 {user_id: {page_id: seconds}}。
+    只取出 (user_id, timestamp, event_type, element_or_page_id) 欄位並轉為 NumPy 陣列：
+    學生目前所在的頁面由最近一次頁面進入事件決定 (離開事件之後視為不在任何頁面)，
+    相鄰兩筆事件的間隔計入該頁面；間隔達到閒置逾時則視為已離開，不予計入。
+    """
+    if session_timeout_seconds is None:
+        session_timeout_seconds = app.config['SESSION_INACTIVITY_TIMEOUT_SECONDS']
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+
+    query = db.session.query(
+        ClickLog.user_id, ClickLog.timestamp, ClickLog.event_type, ClickLog.element_or_page_id
+    ).filter(ClickLog.user_id.in_(user_ids))
+    if start_time is not None:
+        query = query.filter(ClickLog.timestamp >= start_time)
+    if end_time is not None:
+        query = query.filter(ClickLog.timestamp < end_time)
+    rows = query.order_by(ClickLog.user_id, ClickLog.timestamp).all()
+    if len(rows) < 2:
+        return {}
+
+    user_column, timestamp_column, event_type_column, page_column = zip(*rows)
+    users = np.array(user_column, dtype=np.int64)
+    seconds = np.array(timestamp_column, dtype='datetime64[us]').astype(np.int64) / 1e6
+    is_entry = np.fromiter((t in PAGE_ENTRY_EVENT_TYPES for t in event_type_column), dtype=bool, count=len(rows))
+    is_exit = np.fromiter((t.startswith(PAGE_EXIT_EVENT_PREFIX) for t in event_type_column), dtype=bool, count=len(rows))
+    page_names, page_codes = np.unique(np.array(page_column, dtype=object), return_inverse=True)
+
+    row_index = np.arange(len(rows))
+    # 每筆事件往前找最近一次進入/離開事件 (前向填補)，且不可跨越到上一位學生
+    last_marker = np.maximum.accumulate(np.where(is_entry | is_exit, row_index, -1))
+    user_starts = np.r_[True, users[1:] != users[:-1]]
+    user_start_index = np.maximum.accumulate(np.where(user_starts, row_index, 0))
+    on_page = (last_marker >= user_start_index) & is_entry[np.maximum(last_marker, 0)]
+
+    gaps = np.diff(seconds)
+    counted = (users[1:] == users[:-1]) & (gaps < session_timeout_seconds) & on_page[:-1]
+    if not counted.any():
+        return {}
+
+    counted_users = users[:-1][counted]
+    counted_pages = page_codes[last_marker[:-1][counted]]
+    pair_keys = counted_users * len(page_names) + counted_pages
+    unique_keys, key_index = np.unique(pair_keys, return_inverse=True)
+    totals = np.bincount(key_index, weights=gaps[counted])
+
+    dwell_by_user = {}
+    for key, total in zip(unique_keys.tolist(), totals.tolist()):
+        user_id, page_code = divmod(key, len(page_names))
+        dwell_by_user.setdefault(user_id, {})[page_names[page_code]] = total
+    return dwell_by_user
+
+def calculate_time_on_page(student_user_id, page_entry_element_pattern, session_timeout_seconds=None):
+    """單一學生在 ID 包含指定字串的頁面上的總停留秒數 (保留舊介面，內部使用 compute_page_dwell_times)。"""
+    dwell = compute_page_dwell_times([student_user_id], session_timeout_seconds=session_timeout_seconds)
+    return sum(
+        total for page_id, total in dwell.get(student_user_id, {}).items()
+        if page_entry_element_pattern in page_id
+    )
+
+def format_seconds_to_readable(total_seconds_float):
+    total_seconds = int(total_seconds_float) # 確保是整數
+    hours = total_seconds // 3600
+    minutes = (total_seconds % 3600) // 60
+    seconds = total_seconds % 60
+    if hours > 0:
+        return f"{hours}小時 {minutes}分 {seconds}秒"
+    elif minutes > 0:
+        return f"{minutes}分 {seconds}秒"
+    else:
+        return f"{seconds}秒"
+
+# --- Filesystem I/O Executor (檔案系統工作執行緒池) ---
+# 報告與影像放在網路磁碟上，讀取可能很慢。相關端點的檔案操作都交給這個有上限的執行緒池。
+# 同時使用儲存空間的請求不超過 WSGI_THREADS - FILESYSTEM_IO_RESERVED_THREADS 個，儲存空間卡住時只有這些端點回應 503，
+# 其餘執行緒保留給登入與事件記錄：請求第一次存取儲存空間時取得名額 (最多等待 FILESYSTEM_IO_SLOT_WAIT_SECONDS 秒)，
+# 同一個請求之後的檔案操作共用這個名額，請求結束時才釋放；單一檔案操作超過 FILESYSTEM_IO_TIMEOUT_SECONDS 秒也回應 503。
+class StorageBusyError(Exception):
+    """等待儲存空間名額或檔案操作結果逾時。"""
+
+filesystem_executor = ThreadPoolExecutor(max_workers=app.config['FILESYSTEM_IO_WORKERS'], thread_name_prefix='filesystem-io')
+_storage_request_slots = threading.BoundedSemaphore(
+    max(1, app.config['WSGI_THREADS'] - app.config['FILESYSTEM_IO_RESERVED_THREADS'])
+)
+_filesystem_io_lock = threading.Lock()
+# in_flight: 已送出但尚未完成的檔案操作數；active_requests: 持有儲存空間名額的請求數
+_filesystem_io_state = {"in_flight": 0, "active_requests": 0}
+
+def _release_filesystem_io_slot(_future=None):
+    with _filesystem_io_lock:
+        _filesystem_io_state["in_flight"] -= 1
+
+def filesystem_io_in_flight():
+    with _filesystem_io_lock:
+        return _filesystem_io_state["in_flight"]
+
+def filesystem_io_active_requests():
+    with _filesystem_io_lock:
+        return _filesystem_io_state["active_requests"]
+
+def _acquire_storage_slot():
+    wait_seconds = app.config['FILESYSTEM_IO_SLOT_WAIT_SECONDS']
+    if not _storage_request_slots.acquire(timeout=wait_seconds):
+        raise StorageBusyError(f"等待 {wait_seconds} 秒仍沒有空閒的儲存空間名額")
+    with _filesystem_io_lock:
+        _filesystem_io_state["active_requests"] += 1
+
+def _release_storage_slot():
+    with _filesystem_io_lock:
+        _filesystem_io_state["active_requests"] -= 1
+    _storage_request_slots.release()
+
+def acquire_storage_request_slot():
+    """目前的請求取得儲存空間名額；已經持有時直接返回。名額在請求結束時由 release_storage_request_slot 釋放。"""
+    if not g.get('storage_slot_held'):
+        _acquire_storage_slot()
+        g.storage_slot_held = True
+
+@app.teardown_request
+def release_storage_request_slot(exc):
+    if g.pop('storage_slot_held', False):
+        _release_storage_slot()
+
+def submit_filesystem_io(fn, *args):
+    """把檔案操作交給執行緒池 (在應用程式上下文中執行) 並回傳 Future；執行緒都在忙碌時排隊等待。"""
+    with _filesystem_io_lock:
+        _filesystem_io_state["in_flight"] += 1
+    request_metrics = get_request_metrics()
+    def run():
+        _current_request_metrics.set(request_metrics) # 讓工作中的 JSON 解析與資料庫時間計入發出請求的端點
+        try:
+            with app.app_context(), measure_phase('filesystem'):
+                return fn(*args)
+        finally:
+            _current_request_metrics.set(None)
+    try:
+        future = filesystem_executor.submit(run)
+    except BaseException:
+        _release_filesystem_io_slot()
+        raise
+    # 逾時的工作若已開始執行仍會在背景跑完，完成或被取消後才減少計數
+    future.add_done_callback(_release_filesystem_io_slot)
+    return future
+
+def run_filesystem_io(fn, *args):
+    """
+    在檔案系統執行緒池中執行 fn(*args) 並等待結果；等待名額或結果逾時都拋出 StorageBusyError。
+    在請求中呼叫時使用該請求的儲存空間名額，同一個請求多次呼叫只佔用一個名額。
+    """
+    in_request = has_request_context()
+    if in_request:
+        acquire_storage_request_slot()
+    else:
+        _acquire_storage_slot()
+    try:
+        future = submit_filesystem_io(fn, *args)
+        timeout_seconds = app.config['FILESYSTEM_IO_TIMEOUT_SECONDS']
+        try:
+            return future.result(timeout=timeout_seconds)
+        except FuturesTimeoutError:
+            future.cancel() # 仍在排隊的工作不再執行
+            raise StorageBusyError(f"檔案操作超過 {timeout_seconds} 秒仍未完成")
+    finally:
+        if not in_request:
+            _release_storage_slot()
+
+def storage_busy_response(e):
+    logger.warning("儲存空間忙碌: %s", e)
+    response = jsonify({'error': '報告儲存空間目前忙碌中，請稍後再試。'})
+    response.status_code = 503
+    response.headers['Retry-After'] = '5'
+    return response
+
+app.register_error_handler(StorageBusyError, storage_busy_response)
+
+# --- Packed Storage (每日封裝檔) ---
+# 網路磁碟上大量小檔案的 metadata 操作 (開檔、stat、listdir) 成本遠高於讀取本身。
+# flask pack-day 把一天的報告 JSON 與關鍵影格打包成一個封裝檔，讀取時以 mmap 直接取出位元組，不必逐檔開啟。
+# 封裝內的檔案以原本的磁碟路徑對應，下列 storage_* 函數對呼叫端而言與讀取個別檔案相同；
+# 同一路徑同時存在於封裝檔與磁碟上時以封裝檔為準 (已封裝的日期要更新內容，請重新執行 pack-day)。
+# 重新封裝時寫入新版本的檔名 (<YYYYMMDD>.<版本>.pack)，不覆寫伺服器正以 mmap 開啟的舊檔 (Windows 上無法取代)；
+# 伺服器切換到新版本，經過一個 PACKED_STORAGE_REFRESH_SECONDS 週期 (讓進行中的讀取完成) 後才關閉舊檔並刪除。
+#
+# 封裝檔格式 (<YYYYMMDD>.<版本>.pack，舊格式 <YYYYMMDD>.pack 視為版本 0):
+#   8 位元組 PACK_MAGIC | 8 位元組索引長度 (little-endian) | UTF-8 JSON 索引 | 各檔案內容
+#   索引: {"version": 1, "day": "YYYYMMDD", "members": {名稱: [資料區內的位移, 長度, 原始 mtime_ns, crc32]}}
+#   名稱為 "reports/<學生>/<報告檔名>" 或 "photos/<MMDD>/ID_n/Keyframes/<影像檔名>"
+PACK_MAGIC = b'CDPACK1\n'
+PACK_HEADER = struct.Struct('<8sQ')
+PACK_ROOTS = {'reports': 'BEHAVIOR_REPORT_FOLDER', 'photos': 'STUDENT_WEEK_PHOTO_FOLDER'}
+PACK_FILENAME_PATTERN = re.compile(r'^(\d{8})(?:\.(\d+))?\.pack$')
+
+def parse_pack_filename(filename):
+    """回傳 (日期 YYYYMMDD, 版本)；不是封裝檔檔名時回傳 None。"""
+    match = PACK_FILENAME_PATTERN.match(filename)
+    if not match:
+        return None
+    return match.group(1), int(match.group(2) or 0)
+
+def find_day_packs(folder, day):
+    """資料夾中某一天的所有封裝檔，依版本由舊到新排序：[(版本, 路徑)]。"""
+    packs = []
+    if os.path.isdir(folder):
+        for entry in os.scandir(folder):
+            parsed = parse_pack_filename(entry.name)
+            if parsed is not None and parsed[0] == day and entry.is_file():
+                packs.append((parsed[1], entry.path))
+    return sorted(packs)
+
+class PackedStat:
+    """封裝內檔案的 stat 結果；大小與修改時間沿用打包前的原始檔案，版本與 ETag 不會因打包而改變。"""
+    def __init__(self, size, mtime_ns):
+        self.st_size = size
+        self.st_mtime_ns = mtime_ns
+        self.st_mtime = mtime_ns // 10**9 + (mtime_ns % 10**9) * 1e-9 # 與 os.stat 的 st_mtime 計算方式相同，才能與報告目錄比對
+
+class PackFile:
+    """以 mmap 開啟的唯讀封裝檔。"""
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.version = (st.st_size, st.st_mtime_ns)
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_length = PACK_HEADER.unpack_from(self._mmap, 0)
+        if magic != PACK_MAGIC:
+            raise ValueError(f"{os.path.basename(path)} 不是封裝檔")
+        index = json.loads(self._mmap[PACK_HEADER.size:PACK_HEADER.size + index_length].decode('utf-8'))
+        self.day = index.get("day")
+        self.members = index["members"]
+        self.data_start = PACK_HEADER.size + index_length
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read(self, name, start=0, length=None):
+        offset, size = self.members[name][:2]
+        start = min(start, size)
+        length = size - start if length is None else min(length, size - start)
+        begin = self.data_start + offset + start
+        return self._mmap[begin:begin + length] # 切片即複製出 bytes，不會留下指向 mmap 的參照
+
+    def stat(self, name):
+        _, size, mtime_ns = self.members[name][:3]
+        return PackedStat(size, mtime_ns)
+
+    def verify(self):
+        """以索引中的 crc32 檢查每個檔案，回傳內容不符的名稱。"""
+        return [name for name, member in self.members.items() if zlib.crc32(self.read(name)) != member[3]]
+
+def _storage_key(path):
+    return os.path.normcase(os.path.normpath(path))
+
+class PackedStorage:
+    """
+    PACKED_STORAGE_FOLDER 中所有封裝檔的索引：磁碟路徑 -> (封裝檔, 名稱)。
+    每隔 PACKED_STORAGE_REFRESH_SECONDS 才以一次 os.scandir 檢查封裝檔是否有新增或新版本；每一天只使用最新版本。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._packs = {} # 封裝檔路徑 -> PackFile
+        self._retired = [] # [(停用時間, PackFile)]：已被取代、等待關閉的封裝檔
+        self._superseded = set() # 已有新版本、關閉後可刪除的舊封裝檔路徑
+        self._files = {} # _storage_key(磁碟路徑) -> (PackFile, 名稱)
+        self._folders = {} # _storage_key(資料夾) -> {檔名}
+        self._roots = None
+        self._last_refresh = None
+        self.reads = 0
+
+    def _refresh_if_due(self):
+        folder = app.config['PACKED_STORAGE_FOLDER']
+        roots = tuple(app.config[config_key] for config_key in PACK_ROOTS.values())
+        now = time.monotonic()
+        with self._lock:
+            if self._roots == roots and self._last_refresh is not None and \
+                    now - self._last_refresh < app.config['PACKED_STORAGE_REFRESH_SECONDS']:
+                return
+            self._last_refresh = now
+        packs, superseded = {}, set()
+        if folder and os.path.isdir(folder):
+            with self._lock:
+                loaded = dict(self._packs) if self._roots == roots else {}
+            newest = {} # 日期 -> (版本, DirEntry)
+            for entry in os.scandir(folder):
+                parsed = parse_pack_filename(entry.name)
+                if parsed is None or not entry.is_file():
+                    continue
+                day, generation = parsed
+                if day in newest and newest[day][0] > generation:
+                    superseded.add(entry.path)
+                    continue
+                if day in newest:
+                    superseded.add(newest[day][1].path)
+                newest[day] = (generation, entry)
+            for _, entry in newest.values():
+                st = entry.stat()
+                current = loaded.get(entry.path)
+                if current is not None and current.version == (st.st_size, st.st_mtime_ns):
+                    packs[entry.path] = current
+                    continue
+                try:
+                    packs[entry.path] = PackFile(entry.path)
+                except (OSError, ValueError, KeyError, struct.error) as e:
+                    logger.warning("無法開啟封裝檔 %s: %s", entry.path, e)
+        self._rebuild(packs, roots)
+        self._release_retired(now, superseded)
+
+    def _release_retired(self, now, superseded):
+        """
+        關閉停用已超過一個更新週期的封裝檔 (lookup 取得的參照在這段時間內已用完)，
+        再刪除已有新版本的舊檔；其他程序仍開著時 (Windows) 留到下次更新再試。
+        """
+        grace_seconds = app.config['PACKED_STORAGE_REFRESH_SECONDS']
+        with self._lock:
+            expired = [pack for retired_at, pack in self._retired if now - retired_at >= grace_seconds]
+            self._retired = [(retired_at, pack) for retired_at, pack in self._retired if now - retired_at < grace_seconds]
+            self._superseded |= superseded
+            in_use = set(self._packs) | {pack.path for _, pack in self._retired}
+            removable = self._superseded - in_use
+        for pack in expired:
+            pack.close()
+        for path in removable:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.debug("暫時無法刪除舊版封裝檔 %s: %s", path, e)
+                continue
+            with self._lock:
+                self._superseded.discard(path)
+
+    def _rebuild(self, packs, roots):
+        root_folders = dict(zip(PACK_ROOTS, roots))
+        files, folders = {}, {}
+        for pack_path in sorted(packs): # 依檔名排序，後面的封裝檔優先
+            pack = packs[pack_path]
+            for name in pack.members:
+                root, _, relative = name.partition('/')
+                if root not in root_folders or not relative:
+                    continue
+                disk_path = os.path.join(root_folders[root], *relative.split('/'))
+                files[_storage_key(disk_path)] = (pack, name)
+                folders.setdefault(_storage_key(os.path.dirname(disk_path)), set()).add(os.path.basename(disk_path))
+        now = time.monotonic()
+        with self._lock:
+            self._retired.extend((now, pack) for path, pack in self._packs.items() if packs.get(path) is not pack)
+            self._packs, self._files, self._folders, self._roots = packs, files, folders, roots
+
+    def lookup(self, path):
+        """回傳 (PackFile, 名稱)；路徑不在任何封裝檔中時回傳 None。"""
+        self._refresh_if_due()
+        with self._lock:
+            return self._files.get(_storage_key(path))
+
+    def list_folder(self, folder):
+        """資料夾已被封裝時回傳其中的檔名集合，否則回傳 None。"""
+        self._refresh_if_due()
+        with self._lock:
+            names = self._folders.get(_storage_key(folder))
+            return set(names) if names is not None else None
+
+    def report_files(self):
+        """已封裝的報告：[(學生, 報告檔名, 磁碟路徑, PackedStat)]。"""
+        self._refresh_if_due()
+        with self._lock:
+            packs, roots = list(self._packs.values()), self._roots
+        report_files = {}
+        for pack in sorted(packs, key=lambda p: p.path):
+            for name in pack.members:
+                parts = name.split('/')
+                if len(parts) == 3 and parts[0] == 'reports':
+                    disk_path = os.path.join(roots[0], parts[1], parts[2])
+                    report_files[(parts[1], parts[2])] = (parts[1], parts[2], disk_path, pack.stat(name))
+        return list(report_files.values())
+
+    def read(self, path, start=0, length=None):
+        found = self.lookup(path)
+        if found is None:
+            return None
+        pack, name = found
+        with self._lock:
+            self.reads += 1
+        return pack.read(name, start, length)
+
+    def stats(self):
+        with self._lock:
+            return {"packs": len(self._packs), "files": len(self._files), "reads": self.reads}
+
+packed_storage = PackedStorage()
+
+def storage_stat(path):
+    """與 os.stat 相同，但已封裝的檔案由封裝檔索引回答，不存取磁碟。"""
+    found = packed_storage.lookup(path)
+    if found is not None:
+        return found[0].stat(found[1])
+    return os.stat(path)
+
+def storage_isfile(path):
+    return packed_storage.lookup(path) is not None or os.path.isfile(path)
+
+def storage_read(path, start=0, length=None):
+    """讀取檔案內容 (或從 start 開始的 length 位元組)。"""
+    data = packed_storage.read(path, start, length)
+    if data is not None:
+        return data
+    with open(path, 'rb') as f:
+        if start:
+            f.seek(start)
+        return f.read() if length is None else f.read(length)
+
+def storage_open(path):
+    """回傳可讀取的二進位檔案物件 (供 PIL 等需要檔案物件的函式庫使用)。"""
+    data = packed_storage.read(path)
+    return io.BytesIO(data) if data is not None else open(path, 'rb')
+
+def storage_listdir(folder):
+    """資料夾中的檔名集合；資料夾已被封裝時不存取磁碟，資料夾不存在時回傳空集合。"""
+    names = packed_storage.list_folder(folder)
+    if names is not None:
+        return names
+    return set(os.listdir(folder)) if os.path.isdir(folder) else set()
+
+def _iter_day_files(day):
+    """找出某一天 (YYYYMMDD) 要封裝的磁碟檔案：[(封裝內名稱, 磁碟路徑)]。"""
+    report_root = app.config['BEHAVIOR_REPORT_FOLDER']
+    report_date = f"{day[:4]}-{day[4:6]}-{day[6:]}"
+    if os.path.isdir(report_root):
+        for student_dir in os.scandir(report_root):
+            if not student_dir.is_dir():
+                continue
+            for file_entry in os.scandir(student_dir.path):
+                if file_entry.is_file() and REPORT_FILENAME_PATTERN.match(file_entry.name) and \
+                        report_date_from_filename(file_entry.name) == report_date:
+                    yield f"reports/{student_dir.name}/{file_entry.name}", file_entry.path
+
+    # 關鍵影格資料夾只有月日 (見 get_keyframe_folder)
+    photo_day_folder = os.path.join(app.config['STUDENT_WEEK_PHOTO_FOLDER'], day[4:])
+    for dirpath, _, filenames in os.walk(photo_day_folder):
+        relative = os.path.relpath(dirpath, app.config['STUDENT_WEEK_PHOTO_FOLDER']).replace(os.sep, '/')
+        for filename in sorted(filenames):
+            yield f"photos/{relative}/{filename}", os.path.join(dirpath, filename)
+
+def pack_day(day, remove_loose=False):
+    """
+    將某一天的報告與關鍵影格寫入 PACKED_STORAGE_FOLDER/<day>.<版本>.pack，回傳 {'path', 'files', 'bytes', 'removed'}。
+    該日已有封裝檔時會與最新版本合併 (磁碟上的檔案優先) 並寫成下一個版本，不覆寫舊檔。
+    寫入後以 crc32 驗證，remove_loose 時才刪除已封裝的磁碟檔案。
+    """
+    folder = app.config['PACKED_STORAGE_FOLDER']
+    if not folder:
+        raise ValueError("未設定 PACKED_STORAGE_FOLDER")
+    os.makedirs(folder, exist_ok=True)
+    existing_packs = find_day_packs(folder, day)
+    generation = existing_packs[-1][0] + 1 if existing_packs else 1
+    pack_path = os.path.join(folder, f"{day}.{generation:04d}.pack")
+    previous = PackFile(existing_packs[-1][1]) if existing_packs else None
+    try:
+        result = _write_day_pack(day, pack_path, previous)
+    finally:
+        if previous is not None:
+            previous.close()
+    if result["files"] == 0:
+        return {"path": pack_path, "files": 0, "bytes": 0, "removed": 0}
+
+    # 舊版本在其他程序 (執行中的伺服器) 仍開著時無法刪除，由伺服器切換到新版本後再刪除
+    for _, old_path in existing_packs:
+        try:
+            os.remove(old_path)
+        except OSError:
+            pass
+
+    removed = 0
+    if remove_loose:
+        for name, path in result["loose_files"].items():
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError as e:
+                logger.warning("無法刪除已封裝的檔案 %s: %s", path, e)
+        photo_day_folder = os.path.join(app.config['STUDENT_WEEK_PHOTO_FOLDER'], day[4:])
+        for dirpath, _, _ in sorted(os.walk(photo_day_folder), reverse=True): # 由深到淺移除空資料夾
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                pass
+    return {"path": pack_path, "files": result["files"], "bytes": result["bytes"], "removed": removed}
+
+def _write_day_pack(day, pack_path, previous):
+    """寫入並驗證 pack_path (尚不存在的新檔名)，回傳 {'path', 'files', 'bytes', 'loose_files'}。"""
+    loose_files = dict(_iter_day_files(day))
+    names = sorted(set(loose_files) | set(previous.members if previous else ()))
+    if not names:
+        return {"path": pack_path, "files": 0, "bytes": 0, "loose_files": loose_files}
+
+    # 先寫資料區 (位移相對於資料區開頭)，再把索引與資料區組成封裝檔
+    members = {}
+    temp_path = f"{pack_path}.{os.getpid()}.tmp"
+    data_path = temp_path + '.data'
+    offset = 0
+    with open(data_path, 'wb') as data_file:
+        for name in names:
+            if name in loose_files:
+                with open(loose_files[name], 'rb') as f:
+                    content = f.read()
+                    mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+            else:
+                content = previous.read(name)
+                mtime_ns = previous.members[name][2]
+            data_file.write(content)
+            members[name] = [offset, len(content), mtime_ns, zlib.crc32(content)]
+            offset += len(content)
+    index = json.dumps({"version": 1, "day": day, "members": members}, ensure_ascii=False).encode('utf-8')
+    with open(temp_path, 'wb') as pack_file, open(data_path, 'rb') as data_file:
+        pack_file.write(PACK_HEADER.pack(PACK_MAGIC, len(index)))
+        pack_file.write(index)
+        shutil.copyfileobj(data_file, pack_file, 1024 * 1024)
+        pack_file.flush()
+        os.fsync(pack_file.fileno())
+    os.remove(data_path)
+
+    with PackFile(temp_path) as written:
+        corrupted = written.verify()
+    if corrupted:
+        os.remove(temp_path)
+        raise ValueError(f"封裝檔驗證失敗: {', '.join(corrupted[:5])}")
+    os.replace(temp_path, pack_path)
+    return {"path": pack_path, "files": len(names), "bytes": offset, "loose_files": loose_files}
+
+@app.cli.command('pack-day')
+@click.argument('day')
+@click.option('--remove-loose', is_flag=True, help='封裝並驗證成功後刪除磁碟上的個別檔案')
+def pack_day_command(day, remove_loose):
+    """將某一天 (YYYYMMDD) 的報告與關鍵影格打包成 PACKED_STORAGE_FOLDER 中的單一封裝檔。"""
+    try:
+        if not re.fullmatch(r'\d{8}', day):
+            raise ValueError(day)
+        datetime.datetime.strptime(day, '%Y%m%d')
+    except ValueError:
+        print("日期格式錯誤，應為 YYYYMMDD。")
+        raise SystemExit(1)
+    try:
+        result = pack_day(day, remove_loose)
+    except (OSError, ValueError) as e:
+        print(f"封裝失敗: {e}")
+        raise SystemExit(1)
+    print(f"已封裝 {result['files']} 個檔案 ({result['bytes'] / 1024 / 1024:.1f} MB) 至 {result['path']}，刪除 {result['removed']} 個個別檔案。")
+
+# --- Report Catalog (報告目錄) ---
+# 例如 student_楊忠潁_behavior_report_20250630_125840.json
+REPORT_FILENAME_PATTERN = re.compile(r'^student_(.+?)_behavior_report_.*\.json$')
+REPORT_FILENAME_DATE_PATTERN = re.compile(r'_(\d{8})_')
+
+_report_catalog_lock = threading.Lock()
+_report_catalog_state = {"last_refresh": None, "refreshing": False}
+_report_catalog_initial_scan = threading.Event() # 程序啟動後第一次掃描結束 (無論成功與否) 時設定
+
+def parse_report_datetime(report_time_str, f_path):
+    """將 report_generation_time 解析為 datetime，兼容 "YYYY-MM-DD HH:MM:SS" 與 "M/D" 兩種格式。"""
+    try:
+        return datetime.datetime.strptime(report_time_str, '%Y-%m-%d %H:%M:%S')
+    except (ValueError, TypeError):
+        pass
+    try:
+        # 假設年份為當前年份
+        return datetime.datetime.strptime(f"{datetime.date.today().year}/{report_time_str}", '%Y/%m/%d')
+    except (ValueError, TypeError):
+        logger.warning("無法解析報告 '%s' 中的日期 '%s'。將使用檔案修改時間作為備用。", os.path.basename(f_path), report_time_str)
+        return datetime.datetime.fromtimestamp(storage_stat(f_path).st_mtime)
+
+def report_date_from_filename(filename):
+    match = REPORT_FILENAME_DATE_PATTERN.search(filename)
+    if not match:
+        return None
+    date_part = match.group(1)
+    return f"{date_part[:4]}-{date_part[4:6]}-{date_part[6:8]}"
+
+def _populate_catalog_entry(entry, f_path, stat_result):
+    entry.file_size = stat_result.st_size
+    entry.file_mtime = stat_result.st_mtime
+    entry.report_date = report_date_from_filename(entry.filename)
+    entry.scanned_at = datetime.datetime.utcnow()
+    try:
+        summary = load_report_summary(f_path)
+        metadata = summary.get('report_metadata') or {}
+        entry.report_generation_time = metadata.get('report_generation_time', '')
+        entry.report_datetime = parse_report_datetime(entry.report_generation_time, f_path)
+        entry.report_metadata_json = json.dumps(metadata, ensure_ascii=False)
+        entry.parse_error = None
+        manifest = build_keyframe_manifest(summary)
+        entry.keyframe_manifest_json = json.dumps(manifest, ensure_ascii=False)
+        _remember_keyframe_manifest(entry.student_name, entry.filename, manifest)
+        record_behavior_series(
+            entry.student_name, entry.filename, entry.report_date,
+            (summary.get('overall_summary') or {}).get('behavior_statistics') or [],
+        )
+    except (ValueError, AttributeError) as e: # 包含 JSONDecodeError 與 UnicodeDecodeError
+        logger.warning("處理報告文件 %s 時出錯: %s。已在目錄中標記為無效。", entry.filename, e)
+        entry.report_generation_time = None
+        entry.report_datetime = None
+        entry.report_metadata_json = None
+        entry.keyframe_manifest_json = None
+        entry.parse_error = str(e)[:255]
+        _forget_keyframe_manifest(entry.student_name, entry.filename)
+        forget_behavior_series(entry.student_name, entry.filename, entry.report_date)
+
+_report_catalog_schema_checked = False
+
+def ensure_report_catalog_schema():
+    """報告目錄只是可隨時重建的索引，若資料表欄位與模型不一致 (舊版本建立的表)，直接重建。"""
+    global _report_catalog_schema_checked
+    if _report_catalog_schema_checked:
+        return
+    table = ReportCatalogEntry.__table__
+    inspector = db.inspect(db.engine)
+    if inspector.has_table(table.name):
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        if set(table.columns.keys()) - existing_columns:
+            logger.info("報告目錄資料表結構已過期，正在重建。")
+            table.drop(db.engine)
+    table.create(db.engine, checkfirst=True)
+    _report_catalog_schema_checked = True
+
+def iter_report_files(report_root_folder):
+    """列出所有報告 (學生, 報告檔名, 路徑, stat)：先列出已封裝的報告，再掃描磁碟上的學生資料夾。"""
+    yield from packed_storage.report_files()
+    for student_dir in os.scandir(report_root_folder):
+        if not student_dir.is_dir():
+            continue
+        filename_prefix = f"student_{student_dir.name}_behavior_report_"
+        for file_entry in os.scandir(student_dir.path):
+            if not file_entry.is_file() or not file_entry.name.startswith(filename_prefix):
+                continue
+            if not REPORT_FILENAME_PATTERN.match(file_entry.name):
+                continue
+            yield student_dir.name, file_entry.name, file_entry.path, file_entry.stat()
+
+def refresh_report_catalog():
+    """
+    增量掃描 BEHAVIOR_REPORT_FOLDER 並更新報告目錄。
+    只有新出現、或大小/修改時間有變動的檔案才會被重新讀取；已刪除的檔案會從目錄中移除。
+    """
+    report_root_folder = app.config['BEHAVIOR_REPORT_FOLDER']
+    if not os.path.isdir(report_root_folder):
+        # 網路磁碟暫時無法存取時保留現有目錄，避免整份目錄被清空後又全部重讀
+        logger.warning("報告根目錄不存在或無法存取: %s", report_root_folder)
+        return {"added": 0, "updated": 0, "removed": 0}
+
+    ensure_report_catalog_schema()
+    ensure_behavior_series()
+    existing = {(e.student_name, e.filename): e for e in ReportCatalogEntry.query.all()}
+    seen_keys = set()
+    added = updated = removed = 0
+    changes = [] # (student_name, filename, report_date, 'added' | 'updated' | 'removed')，提交後推送給教師儀表板
+
+    for student_name, filename, path, stat_result in iter_report_files(report_root_folder):
+        key = (student_name, filename)
+        if key in seen_keys:
+            continue # 已封裝的報告以封裝檔為準
+        seen_keys.add(key)
+        entry = existing.get(key)
+        if entry is not None and entry.file_size == stat_result.st_size and entry.file_mtime == stat_result.st_mtime:
+            continue # 未變動，不需重新讀取
+        if entry is None:
+            entry = ReportCatalogEntry(student_name=student_name, filename=filename)
+            db.session.add(entry)
+            added += 1
+            change = 'added'
+        else:
+            updated += 1
+            change = 'updated'
+        _populate_catalog_entry(entry, path, stat_result)
+        changes.append((entry.student_name, entry.filename, entry.report_date, change))
+
+    for key, entry in existing.items():
+        if key not in seen_keys:
+            db.session.delete(entry)
+            _forget_keyframe_manifest(*key)
+            forget_behavior_series(entry.student_name, entry.filename, entry.report_date)
+            removed += 1
+            changes.append((entry.student_name, entry.filename, entry.report_date, 'removed'))
+
+    db.session.commit()
+    if added or updated or removed:
+        logger.info("報告目錄已更新 (新增 %d, 更新 %d, 移除 %d)。", added, updated, removed)
+        if dashboard_events.has_subscribers():
+            publish_report_changes(changes)
+    return {"added": added, "updated": updated, "removed": removed}
+
+def _run_report_catalog_refresh():
+    try:
+        with app.app_context():
+            refresh_report_catalog()
+    except Exception as e:
+        logger.exception("掃描報告目錄時發生錯誤: %s", e)
+    finally:
+        with _report_catalog_lock:
+            _report_catalog_state["last_refresh"] = time.monotonic()
+            _report_catalog_state["refreshing"] = False
+        _report_catalog_initial_scan.set()
+
+def ensure_report_catalog_fresh():
+    """
+    確保報告目錄不過期。程序啟動後的第一次掃描同步執行，掃描期間的其他請求也等待它完成，
+    不會查到空的或不完整的目錄；之後超過 REPORT_CATALOG_REFRESH_SECONDS 時改在背景執行緒中掃描，
+    請求本身不會等待檔案系統，先使用目前 (稍舊) 的目錄。
+    """
+    with _report_catalog_lock:
+        refreshing = _report_catalog_state["refreshing"]
+        last_refresh = _report_catalog_state["last_refresh"]
+        if not refreshing:
+            if last_refresh is not None and time.monotonic() - last_refresh < app.config['REPORT_CATALOG_REFRESH_SECONDS']:
+                return
+            _report_catalog_state["refreshing"] = True
+    if refreshing:
+        _report_catalog_initial_scan.wait() # 只有第一次掃描需要等待；之後的背景掃描期間立即返回
+        return
+
+    if last_refresh is None:
+        _run_report_catalog_refresh()
+    else:
+        threading.Thread(target=_run_report_catalog_refresh, name='report-catalog-refresh', daemon=True).start()
+
+@app.cli.command('refresh-report-catalog')
+def refresh_report_catalog_command():
+    """立即增量掃描報告資料夾並更新報告目錄。"""
+    db.create_all()
+    result = refresh_report_catalog()
+    print(f"報告目錄掃描完成: 新增 {result['added']}, 更新 {result['updated']}, 移除 {result['removed']}。")
+
+# --- Report JSON Cache (已解析報告快取) ---
+class ReportJsonCache:
+    """
+    以檔案路徑為鍵、全程序共用的已解析報告快取。
+    每次讀取都會以檔案的修改時間與大小驗證，總容量超過上限時淘汰最久未使用的項目。
+    loader(path) 回傳 (資料, 佔用位元組數)。回傳的資料在多個請求間共用，呼叫端不可修改。
+    """
+    def __init__(self, max_bytes, loader):
+        self.max_bytes = max_bytes
+        self.loader = loader
+        self._entries = OrderedDict() # path -> ((mtime, size), cost, data)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._loading_locks = {} # path -> [鎖, 持有或等待中的請求數]，避免同一份報告被多個請求同時重複解析
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def load(self, path):
+        stat_result = storage_stat(path)
+        version = (stat_result.st_mtime, stat_result.st_size)
+        cached = self._get(path, version)
+        if cached is not None:
+            return cached
+
+        with self._lock:
+            loading = self._loading_locks.get(path)
+            if loading is None:
+                loading = self._loading_locks[path] = [threading.Lock(), 0]
+            loading[1] += 1
+        try:
+            with loading[0]:
+                # 等待期間可能已有其他請求完成解析
+                cached = self._get(path, version, count_miss=False)
+                if cached is not None:
+                    return cached
+                data, cost = self.loader(path)
+                self._put(path, version, cost, data)
+                return data
+        finally:
+            with self._lock:
+                loading[1] -= 1
+                if loading[1] == 0: # 最後一個等待者離開後才移除，之後的請求不會拿到另一把鎖而重複解析
+                    del self._loading_locks[path]
+
+    def _get(self, path, version, count_miss=True):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry[2]
+            if count_miss:
+                self.misses += 1
+            return None
+
+    def _put(self, path, version, size, data):
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self._total_bytes -= old[1]
+            if size > self.max_bytes:
+                return # 單一檔案超過上限時不快取
+            self._entries[path] = (version, size, data)
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._total_bytes -= evicted[1]
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+# --- Report Summary Reader (報告局部讀取) ---
+# 大部分 API 只需要 report_metadata 與 overall_summary。報告第一次被讀到時以串流方式掃描最上層的區段，
+# 只解析需要的部分 (detailed_sequence_analysis 逐批讀取、不整包載入)，並把結果寫成小型的 sidecar 檔，
+# 之後的讀取只需載入 sidecar，成本與報告中有多少批次無關。
+REPORT_SUMMARY_SECTIONS = ('report_metadata', 'overall_summary')
+REPORT_SIDECAR_VERSION = 2
+
+# 以 latin-1 解碼原始位元組：每個位元組對應一個字元，因此字元位置即檔案的位元組位置；
+# UTF-8 多位元組字元的每個位元組都 >= 0x80，不會被誤認為引號、括號等 JSON 結構字元。
+_json_scanner = json.JSONDecoder()
+_JSON_WHITESPACE = re.compile(r'[ \t\r\n]*')
+
+def _skip_json_whitespace(text, pos):
+    return _JSON_WHITESPACE.match(text, pos).end()
+
+def iter_json_array_items(text, start):
+    """逐一產生從 start 開始的 JSON 陣列中每個元素的 (起點, 終點)，一次只解析一個元素。"""
+    if text[start:start + 1] != '[':
+        raise ValueError(f"預期為陣列 (位置 {start})")
+    pos = _skip_json_whitespace(text, start + 1)
+    if text[pos:pos + 1] == ']':
+        return
+    while True:
+        _, item_end = _json_scanner.raw_decode(text, pos)
+        yield pos, item_end
+        pos = _skip_json_whitespace(text, item_end)
+        separator = text[pos:pos + 1]
+        if separator == ']':
+            return
+        if separator != ',':
+            raise ValueError(f"陣列缺少逗號 (位置 {pos})")
+        pos = _skip_json_whitespace(text, pos + 1)
+
+def _skip_json_value(text, pos):
+    """回傳從 pos 開始的 JSON 值結束的位置；陣列逐一元素跳過，避免整個陣列同時存在於記憶體中。"""
+    if text[pos:pos + 1] == '[':
+        end = pos
+        for _, end in iter_json_array_items(text, pos):
+            pass
+        return text.index(']', end) + 1
+    return _json_scanner.raw_decode(text, pos)[1]
+
+def iter_json_object_members(text, pos=0):
+    """逐一產生從 pos 開始的 JSON 物件中每個成員的 (鍵, 值起點, 值終點)。"""
+    pos = _skip_json_whitespace(text, pos)
+    if text[pos:pos + 1] != '{':
+        raise ValueError("報告最上層不是 JSON 物件")
+    pos = _skip_json_whitespace(text, pos + 1)
+    if text[pos:pos + 1] == '}':
+        return
+    while True:
+        key, key_end = _json_scanner.raw_decode(text, pos)
+        if not isinstance(key, str):
+            raise ValueError(f"物件的鍵必須是字串 (位置 {pos})")
+        pos = _skip_json_whitespace(text, key_end)
+        if text[pos:pos + 1] != ':':
+            raise ValueError(f"物件缺少冒號 (位置 {pos})")
+        value_start = _skip_json_whitespace(text, pos + 1)
+        value_end = _skip_json_value(text, value_start)
+        yield key.encode('latin-1').decode('utf-8'), value_start, value_end
+        pos = _skip_json_whitespace(text, value_end)
+        separator = text[pos:pos + 1]
+        if separator == '}':
+            return
+        if separator != ',':
+            raise ValueError(f"物件缺少逗號 (位置 {pos})")
+        pos = _skip_json_whitespace(text, pos + 1)
+
+def _decode_json_slice(raw, start, end):
+    return json.loads(raw[start:end].decode('utf-8'))
+
+def scan_report_summary(report_path):
+    """
+    以串流方式掃描報告，回傳摘要：report_metadata、overall_summary，
+    以及從 detailed_sequence_analysis 逐批整理出的資訊 (不會一次載入整個陣列)：
+    每個批次在檔案中的位元組範圍、所有影像檔名，以及甘特圖用的精簡時間軸 [[影像檔名, 行為], ...]。
+    """
+    summary = {section: {} for section in REPORT_SUMMARY_SECTIONS}
+    image_filenames = set()
+    sequence_offsets = []
+    behavior_timeline = []
+    raw = storage_read(report_path)
+    text = raw.decode('latin-1')
+    with measure_phase('json_parse'):
+        for key, start, end in iter_json_object_members(text):
+            if key in REPORT_SUMMARY_SECTIONS:
+                summary[key] = _decode_json_slice(raw, start, end)
+            elif key == 'detailed_sequence_analysis' and text[start:start + 1] == '[':
+                for item_start, item_end in iter_json_array_items(text, start):
+                    sequence = _decode_json_slice(raw, item_start, item_end)
+                    sequence_offsets.append([item_start, item_end])
+                    if isinstance(sequence, dict):
+                        image_filenames.update(sequence.get('image_filenames_in_batch') or [])
+                        behavior_timeline.extend(sequence_behavior_timeline(sequence))
+    summary["sequence_count"] = len(sequence_offsets)
+    summary["sequence_offsets"] = sequence_offsets
+    summary["image_filenames"] = sorted(image_filenames)
+    summary["behavior_timeline"] = behavior_timeline
+    return summary
+
+def sequence_behavior_timeline(sequence):
+    """將單一批次的 per_image_highlights 轉為 [[影像檔名, 行為], ...]；image_index_in_sequence 兼容從 0 或 1 開始。"""
+    filenames = sequence.get('image_filenames_in_batch') or []
+    highlights = (sequence.get('analysis') or {}).get('per_image_highlights') or []
+    timeline = []
+    for highlight in highlights:
+        image_index = highlight.get('image_index_in_sequence')
+        behavior_category = highlight.get('behavior_category')
+        if not behavior_category or not isinstance(image_index, int) or isinstance(image_index, bool):
+            continue
+        if 0 <= image_index < len(filenames):
+            timeline.append([filenames[image_index], behavior_category])
+        elif 0 < image_index <= len(filenames):
+            timeline.append([filenames[image_index - 1], behavior_category])
+    return timeline
+
+def read_report_batch_page(report_path, offset, limit):
+    """回傳 (批次總數, 第 [offset, offset+limit) 個批次)。"""
+    summary = load_report_summary(report_path)
+    return summary["sequence_count"], read_report_sequences(report_path, summary["sequence_offsets"][offset:offset + limit])
+
+def read_report_sequences(report_path, offsets):
+    """依 sidecar 中記錄的位元組範圍，只讀取並解析指定的批次。"""
+    if not offsets:
+        return []
+    raw = storage_read(report_path, offsets[0][0], offsets[-1][1] - offsets[0][0])
+    base = offsets[0][0]
+    with measure_phase('json_parse'):
+        return [_decode_json_slice(raw, start - base, end - base) for start, end in offsets]
+
+def _report_sidecar_path(report_path):
+    digest = hashlib.sha1(os.path.abspath(report_path).encode('utf-8')).hexdigest()
+    return os.path.join(app.config['REPORT_SIDECAR_FOLDER'], digest[:2], f"{digest}.json")
+
+def _load_report_summary(report_path):
+    """ReportJsonCache 的 loader：優先讀取有效的 sidecar，否則掃描報告並寫入新的 sidecar。"""
+    stat_result = storage_stat(report_path)
+    source = {"mtime_ns": stat_result.st_mtime_ns, "size": stat_result.st_size}
+    sidecar_path = _report_sidecar_path(report_path)
+    try:
+        with open(sidecar_path, 'r', encoding='utf-8') as f, measure_phase('json_parse'):
+            sidecar = json.load(f)
+        if sidecar.get("version") == REPORT_SIDECAR_VERSION and sidecar.get("source") == source:
+            return sidecar["summary"], os.path.getsize(sidecar_path)
+    except (OSError, ValueError, KeyError):
+        pass # 沒有 sidecar 或已過期，重新掃描
+
+    summary = scan_report_summary(report_path)
+    payload = json.dumps({"version": REPORT_SIDECAR_VERSION, "source": source, "summary": summary}, ensure_ascii=False)
+    try:
+        os.makedirs(os.path.dirname(sidecar_path), exist_ok=True)
+        temp_path = f"{sidecar_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(payload)
+        os.replace(temp_path, sidecar_path)
+    except OSError as e:
+        logger.warning("無法寫入報告摘要 %s: %s", sidecar_path, e)
+    return summary, len(payload.encode('utf-8'))
+
+report_summary_cache = ReportJsonCache(app.config['REPORT_SUMMARY_CACHE_MAX_BYTES'], loader=_load_report_summary)
+
+def load_report_summary(report_path):
+    """
+    只讀取報告的摘要區段，回傳 {"report_metadata", "overall_summary", "sequence_count", "sequence_offsets",
+    "image_filenames", "behavior_timeline"}。不會載入 detailed_sequence_analysis；批次內容請用 read_report_sequences。
+    """
+    return report_summary_cache.load(report_path)
+
+# --- Behavior Time Series (行為時間序列) ---
+def record_behavior_series(student_name, report_filename, report_date, behavior_stats):
+    """將一份報告的 behavior_statistics 寫入時間序列；若同一天已有更新的報告則略過。"""
+    if not report_date:
+        return
+    newer_exists = BehaviorSeriesPoint.query.filter(
+        BehaviorSeriesPoint.student_name == student_name,
+        BehaviorSeriesPoint.report_date == report_date,
+        BehaviorSeriesPoint.report_filename > report_filename
+    ).first() is not None
+    if newer_exists:
+        return
+    BehaviorSeriesPoint.query.filter_by(student_name=student_name, report_date=report_date).delete()
+    points = {}
+    for item in behavior_stats:
+        category = item.get("behavior_category")
+        if not category:
+            continue
+        point = points.setdefault(category, BehaviorSeriesPoint(
+            student_name=student_name, report_date=report_date, behavior_category=category,
+            percentage=0, count=None, report_filename=report_filename
+        ))
+        point.percentage += float(item.get("percentage") or 0)
+        if item.get("count") is not None:
+            point.count = (point.count or 0) + int(item["count"])
+    db.session.add_all(points.values())
+
+def forget_behavior_series(student_name, report_filename, report_date):
+    """移除某份報告寫入的時間序列；若同一天還有其他有效報告，改用其中最新的一份。"""
+    deleted = BehaviorSeriesPoint.query.filter_by(student_name=student_name, report_filename=report_filename).delete()
+    if not deleted or not report_date:
+        return
+    replacement = ReportCatalogEntry.query.filter(
+        ReportCatalogEntry.student_name == student_name,
+        ReportCatalogEntry.report_date == report_date,
+        ReportCatalogEntry.filename != report_filename,
+        ReportCatalogEntry.parse_error.is_(None)
+    ).order_by(ReportCatalogEntry.filename.desc()).first()
+    if replacement is None:
+        return
+    try:
+        summary = load_report_summary(replacement.file_path)
+    except (OSError, ValueError) as e:
+        logger.warning("無法讀取報告 %s 以更新行為時間序列: %s", replacement.filename, e)
+        return
+    record_behavior_series(
+        student_name, replacement.filename, report_date,
+        (summary.get('overall_summary') or {}).get('behavior_statistics') or [],
+    )
+
+def rebuild_behavior_series():
+    """從報告目錄 (與報告摘要 sidecar) 重建整個行為時間序列，回傳寫入的報告數。"""
+    BehaviorSeriesPoint.query.delete()
+    report_count = 0
+    for entry in ReportCatalogEntry.query.filter(ReportCatalogEntry.parse_error.is_(None)).order_by(ReportCatalogEntry.filename):
+        try:
+            summary = load_report_summary(entry.file_path)
+        except (OSError, ValueError) as e:
+            logger.warning("無法讀取報告 %s 以建立行為時間序列: %s", entry.filename, e)
+            continue
+        record_behavior_series(
+            entry.student_name, entry.filename, entry.report_date,
+            (summary.get('overall_summary') or {}).get('behavior_statistics') or [],
+        )
+        report_count += 1
+    db.session.commit()
+    return report_count
+
+_behavior_series_checked = False
+
+def ensure_behavior_series():
+    """確認時間序列資料表存在；若是空的但報告目錄已有報告 (舊版本升級)，從目錄補齊。"""
+    global _behavior_series_checked
+    if _behavior_series_checked:
+        return
+    BehaviorSeriesPoint.__table__.create(db.engine, checkfirst=True)
+    ensure_report_catalog_schema()
+    has_reports = ReportCatalogEntry.query.filter(ReportCatalogEntry.parse_error.is_(None)).first() is not None
+    if BehaviorSeriesPoint.query.first() is None and has_reports:
+        report_count = rebuild_behavior_series()
+        logger.info("已從報告目錄補齊 %d 份報告的行為時間序列。", report_count)
+    _behavior_series_checked = True
+
+@app.cli.command('rebuild-behavior-series')
+def rebuild_behavior_series_command():
+    """從報告目錄重建行為時間序列。"""
+    db.create_all()
+    report_count = rebuild_behavior_series()
+    print(f"行為時間序列重建完成，共 {report_count} 份報告。")
+
+def build_behavior_series_matrix(rows, granularity):
+    """
+    rows: [(student_name, report_date, behavior_category, percentage), ...]
+    回傳 (periods, students, categories, values)。values 為「期間 × 學生 × 行為」的 NumPy 陣列，
+    值為該學生在該期間所有報告的平均佔比；該期間沒有報告的學生為 NaN。
+    granularity 為 'day' (每個報告日期) 或 'week' (以週一為起點的週)。
+    """
+    def period_of(report_date):
+        if granularity == 'week':
+            day = datetime.date.fromisoformat(report_date)
+            return (day - datetime.timedelta(days=day.weekday())).isoformat()
+        return report_date
+
+    periods = sorted({period_of(row[1]) for row in rows})
+    students = sorted({row[0] for row in rows})
+    categories = sorted({row[2] for row in rows})
+    period_index = {p: i for i, p in enumerate(periods)}
+    student_index = {name: i for i, name in enumerate(students)}
+    category_index = {c: i for i, c in enumerate(categories)}
+
+    sums = np.zeros((len(periods), len(students), len(categories)), dtype=np.float64)
+    if rows:
+        np.add.at(sums, (
+            np.fromiter((period_index[period_of(row[1])] for row in rows), dtype=np.intp, count=len(rows)),
+            np.fromiter((student_index[row[0]] for row in rows), dtype=np.intp, count=len(rows)),
+            np.fromiter((category_index[row[2]] for row in rows), dtype=np.intp, count=len(rows)),
+        ), np.fromiter((row[3] for row in rows), dtype=np.float64, count=len(rows)))
+    report_counts = np.zeros((len(periods), len(students)), dtype=np.float64)
+    for student_name, report_date in {(row[0], row[1]) for row in rows}:
+        report_counts[period_index[period_of(report_date)], student_index[student_name]] += 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values = sums / report_counts[:, :, None]
+    return periods, students, categories, values
+
+def _rounded_series(values):
+    return [None if np.isnan(v) else round(float(v), 1) for v in values]
+
+# --- Keyframe Manifest (關鍵影格路徑清單) ---
+# 每份報告只在第一次被看到時解析一次影像路徑，之後的圖片請求只需查字典
+_keyframe_manifests = {} # (student_name, report_filename) -> {"folder": ..., "images": {name: (path, exists)}}
+_keyframe_manifests_lock = threading.Lock()
+
+def get_keyframe_folder(metadata):
+    """根據報告的 student_number 與 report_generation_time 推算關鍵影格資料夾，資訊不足時回傳 None。"""
+    student_number = metadata.get('student_number')
+    report_time_str = metadata.get('report_generation_time')
+    if not student_number or not report_time_str:
+        return None
+
+    # 1. 處理時間: 將 "6/11" 或 "2024-06-11 10:30:00" 格式化為 "0611"
+    report_time_folder = "".join(filter(str.isdigit, report_time_str))
+    # 如果是 YYYYMMDD 格式，取中間四位
+    if len(report_time_folder) == 8:
+         report_time_folder = report_time_folder[4:]
+    report_time_folder = report_time_folder.zfill(4)
+
+    # 2. 處理座號: 將 "1" 轉換為 "ID_1"
+    id_folder = f"ID_{student_number}"
+
+    # 3. 使用 os.path.join 安全地組合出資料夾路徑
+    return os.path.join(
+        app.config['STUDENT_WEEK_PHOTO_FOLDER'], # 根目錄
+        report_time_folder,                     # 日期資料夾，例如 "0611"
+        id_folder,                              # 學生ID資料夾，例如 "ID_2"
+        "Keyframes"                             # 固定的子資料夾
+    )
+
+def build_keyframe_manifest(report_summary):
+    """
+    收集報告摘要 (見 load_report_summary) 中 detailed_sequence_analysis 與 behavior_to_images_index 提到的所有影像檔名，
+    並以一次 storage_listdir 判斷哪些檔案實際存在。
+    """
+    folder = get_keyframe_folder(report_summary.get('report_metadata') or {})
+    image_names = set(report_summary.get('image_filenames') or [])
+    behavior_index = (report_summary.get('overall_summary') or {}).get('behavior_to_images_index') or {}
+    for images in behavior_index.values():
+        image_names.update(images)
+
+    existing_files = storage_listdir(folder) if folder else set()
+    return {"folder": folder, "images": {name: name in existing_files for name in sorted(image_names)}}
+
+def _remember_keyframe_manifest(student_name, report_filename, manifest):
+    folder = manifest.get("folder")
+    resolved = {
+        name: (os.path.join(folder, name) if folder else None, exists)
+        for name, exists in manifest.get("images", {}).items()
+    }
+    with _keyframe_manifests_lock:
+        _keyframe_manifests[(student_name, report_filename)] = {"folder": folder, "images": resolved}
+
+def _forget_keyframe_manifest(student_name, report_filename):
+    with _keyframe_manifests_lock:
+        _keyframe_manifests.pop((student_name, report_filename), None)
+
+def get_keyframe_manifest(student_name, report_filename):
+    """
+    取得報告的關鍵影格清單：優先使用記憶體中的版本，其次是報告目錄中保存的版本，
+    若報告尚未被目錄掃描到，才直接讀取報告建立。報告不存在時回傳 None。
+    """
+    key = (student_name, report_filename)
+    with _keyframe_manifests_lock:
+        manifest = _keyframe_manifests.get(key)
+    if manifest is not None:
+        return manifest
+
+    entry = ReportCatalogEntry.query.filter_by(student_name=student_name, filename=report_filename).first()
+    if entry is not None and entry.keyframe_manifest_json:
+        _remember_keyframe_manifest(student_name, report_filename, json.loads(entry.keyframe_manifest_json))
+    else:
+        report_json_path = os.path.join(app.config['BEHAVIOR_REPORT_FOLDER'], student_name, report_filename)
+        if not storage_isfile(report_json_path):
+            return None
+        _remember_keyframe_manifest(student_name, report_filename, build_keyframe_manifest(load_report_summary(report_json_path)))
+    with _keyframe_manifests_lock:
+        return _keyframe_manifests.get(key)
+
+def resolve_keyframe_image(manifest, image_filename):
+    """回傳 (圖片路徑, 是否存在)。清單中標記為不存在的圖片會重新檢查一次，以便接收稍後才同步完成的檔案。"""
+    resolved = manifest["images"].get(image_filename)
+    if resolved is not None and resolved[1]:
+        return resolved
+    folder = manifest["folder"]
+    if not folder:
+        return None, False
+    image_path = os.path.join(folder, image_filename)
+    exists = storage_isfile(image_path)
+    if exists or resolved is not None:
+        with _keyframe_manifests_lock:
+            manifest["images"][image_filename] = (image_path, exists)
+    return image_path, exists
+
+def keyframe_file_version(image_path):
+    """影像的版本字串：由大小與修改時間 (奈秒) 雜湊而成，檔案被替換後會得到新的 URL。"""
+    st = storage_stat(image_path)
+    return hashlib.sha1(f"{st.st_size}|{st.st_mtime_ns}".encode('utf-8')).hexdigest()[:16]
+
+def resolve_keyframe_versions(manifest, image_filenames):
+    """回傳 {檔名: 版本字串}，不存在的影像為 None。"""
+    versions = {}
+    for image_filename in image_filenames:
+        image_path, exists = resolve_keyframe_image(manifest, image_filename)
+        try:
+            versions[image_filename] = keyframe_file_version(image_path) if exists else None
+        except FileNotFoundError:
+            versions[image_filename] = None
+    return versions
+
+KEYFRAME_URL_SAFE_CHARS = "!$'()*,/:;?@" # 與 werkzeug 建構網址時保留不編碼的字元相同
+
+def keyframe_image_url(report_filename, image_filename, version, size_name='original', variant_format=None):
+    """
+    與 url_for('api_get_sequence_image', ...) 產生相同的網址。圖片清單一次要產生上百個網址，
+    因此路徑與 report_file 參數每個請求只用 url_for 產生一次，其餘參數直接編碼 (與 werkzeug 相同的保留字元)。
+    """
+    prefixes = g.setdefault('keyframe_image_url_prefixes', {})
+    prefix = prefixes.get(report_filename)
+    if prefix is None:
+        prefix = prefixes[report_filename] = url_for('api_get_sequence_image', report_file=report_filename)
+    query = [('image_file', image_filename), ('v', version)]
+    if size_name != 'original':
+        query.append(('size', size_name))
+    query.append(('format', variant_format))
+    return prefix + ''.join(
+        f"&{name}={urllib.parse.quote_plus(value, safe=KEYFRAME_URL_SAFE_CHARS)}" for name, value in query if value is not None
+    )
+
+def _accel_redirect_uri(file_path):
+    """依 X_ACCEL_REDIRECT_LOCATIONS 將磁碟路徑轉為 nginx internal URI；不在任何對應資料夾下時回傳 None。"""
+    real_path = os.path.realpath(file_path)
+    for folder, location in app.config['X_ACCEL_REDIRECT_LOCATIONS'].items():
+        relative = os.path.relpath(real_path, os.path.realpath(folder))
+        if relative != os.pardir and not relative.startswith(os.pardir + os.sep):
+            return location.rstrip('/') + '/' + urllib.parse.quote(relative.replace(os.sep, '/'))
+    return None
+
+def load_keyframe_file(file_path):
+    """
+    在檔案系統執行緒池中執行：取得送出影像所需的 (內容, 大小, 修改時間, 代理傳送標頭)。
+    封裝檔中的影像直接取出位元組；交給前端代理 (X-Accel-Redirect / X-Sendfile) 傳送時只取修改時間，內容為 None；
+    否則只開啟檔案並回傳檔案物件，內容由 WSGI 伺服器的 file_wrapper (可使用 sendfile) 送出，不讀入記憶體。
+    """
+    packed = packed_storage.lookup(file_path)
+    if packed is not None:
+        pack, name = packed
+        data = pack.read(name)
+        return data, len(data), pack.stat(name).st_mtime, None
+    accel_uri = _accel_redirect_uri(file_path) if app.config['X_ACCEL_REDIRECT_LOCATIONS'] else None
+    if accel_uri is not None:
+        return None, None, os.path.getmtime(file_path), ('X-Accel-Redirect', accel_uri)
+    if app.config['USE_X_SENDFILE']:
+        return None, None, os.path.getmtime(file_path), ('X-Sendfile', os.path.abspath(file_path))
+    f = open(file_path, 'rb')
+    try:
+        st = os.fstat(f.fileno())
+    except BaseException:
+        f.close()
+        raise
+    return f, st.st_size, st.st_mtime, None
+
+def send_keyframe_file(file_path, mimetype, etag, immutable):
+    """
+    送出影像檔案，支援條件式請求 (ETag / If-Modified-Since) 與 Range。
+    開啟檔案與取得檔案資訊都在檔案系統執行緒池中進行 (見 load_keyframe_file)；設定了前端代理時內容由代理直接傳送。
+    immutable 代表 URL 帶有正確的版本，可長期快取。
+    """
+    body, size, last_modified, offload = run_filesystem_io(load_keyframe_file, file_path)
+    mimetype = mimetype or mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+    if offload is not None:
+        header, target = offload
+        response = Response(mimetype=mimetype)
+        response.headers[header] = target
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response = response.make_conditional(request) # Range 由代理處理
+    elif isinstance(body, bytes):
+        response = send_file(io.BytesIO(body), mimetype=mimetype, conditional=True, etag=etag, last_modified=last_modified)
+    else:
+        # 與 send_file 相同的處理，但檔案已在執行緒池中開啟，大小也已知道，請求執行緒不再 stat 儲存空間
+        response = Response(wrap_file(request.environ, body), mimetype=mimetype, direct_passthrough=True)
+        response.content_length = size
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response = response.make_conditional(request, accept_ranges=True, complete_length=size)
+    response.cache_control.no_cache = None
+    response.cache_control.private = True # 需要登入才能取得
+    if immutable:
+        response.cache_control.max_age = app.config['KEYFRAME_CACHE_MAX_AGE']
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True # 舊格式 (不帶版本) 的 URL：每次以 ETag 重新驗證
+    return response
+
+# --- Image Variants (縮圖產生與磁碟快取) ---
+IMAGE_VARIANT_FORMATS = {'jpeg': ('JPEG', 'jpg', 'image/jpeg'), 'webp': ('WEBP', 'webp', 'image/webp')}
+
+image_variant_executor = ThreadPoolExecutor(max_workers=app.config['IMAGE_VARIANT_WORKERS'], thread_name_prefix='image-variant')
+_image_variant_lock = threading.Lock()
+_image_variant_inflight = {} # cache_path -> Future，避免同一張縮圖被同時產生多次
+_image_variant_index = None # cache_path -> 檔案大小，依最近使用時間排序 (OrderedDict)
+_image_variant_total_bytes = 0
+_image_variant_touched_at = {} # cache_path -> 檔案修改時間最後一次更新的時間，避免每次命中都寫入 metadata
+
+def choose_image_variant_format(requested_format, accept_header):
+    """明確指定 format= 時使用指定格式，否則瀏覽器支援 WebP 就回傳 WebP。"""
+    if requested_format in IMAGE_VARIANT_FORMATS:
+        return requested_format
+    if 'image/webp' in (accept_header or '') and pil_features.check('webp'):
+        return 'webp'
+    return 'jpeg'
+
+def _load_image_variant_index():
+    """第一次使用時掃描快取資料夾，以檔案修改時間 (命中時會更新) 作為 LRU 順序。"""
+    global _image_variant_index, _image_variant_total_bytes
+    cache_folder = app.config['IMAGE_VARIANT_CACHE_FOLDER']
+    files = []
+    if os.path.isdir(cache_folder):
+        for dirpath, _, filenames in os.walk(cache_folder):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                st = os.stat(path)
+                files.append((st.st_mtime, path, st.st_size))
+    files.sort()
+    _image_variant_index = OrderedDict((path, size) for _, path, size in files)
+    _image_variant_touched_at.clear()
+    _image_variant_touched_at.update((path, mtime) for mtime, path, _ in files)
+    _image_variant_total_bytes = sum(size for _, _, size in files)
+
+def _touch_image_variant(cache_path, size=None):
+    """在 LRU 索引中標記為最近使用 (size 不為 None 代表新加入)，並在超過容量時淘汰最舊的縮圖。"""
+    global _image_variant_total_bytes
+    evicted_paths = []
+    now = time.time()
+    persist_touch = False
+    with _image_variant_lock:
+        if _image_variant_index is None:
+            _load_image_variant_index()
+        if cache_path in _image_variant_index:
+            _image_variant_index.move_to_end(cache_path)
+            if size is None and now - _image_variant_touched_at.get(cache_path, 0) >= app.config['IMAGE_VARIANT_TOUCH_INTERVAL_SECONDS']:
+                _image_variant_touched_at[cache_path] = now
+                persist_touch = True
+        elif size is not None:
+            _image_variant_index[cache_path] = size
+            _image_variant_touched_at[cache_path] = now
+            _image_variant_total_bytes += size
+        max_bytes = app.config['IMAGE_VARIANT_CACHE_MAX_BYTES']
+        while _image_variant_total_bytes > max_bytes and len(_image_variant_index) > 1:
+            evicted_path, evicted_size = _image_variant_index.popitem(last=False)
+            _image_variant_touched_at.pop(evicted_path, None)
+            _image_variant_total_bytes -= evicted_size
+            evicted_paths.append(evicted_path)
+    for evicted_path in evicted_paths:
+        try:
+            os.remove(evicted_path)
+        except OSError:
+            pass
+    if persist_touch:
+        try:
+            os.utime(cache_path) # 讓重新啟動後重建的 LRU 順序大致正確
+        except OSError:
+            pass
+
+def _render_image_variant(source_path, cache_path, max_side, variant_format):
+    pil_format = IMAGE_VARIANT_FORMATS[variant_format][0]
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+    with storage_open(source_path) as source, Image.open(source) as img:
+        img.draft('RGB', (max_side, max_side)) # JPEG 可直接以較低解析度解碼，大幅減少解碼時間
+        img = img.convert('RGB')
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+        img.save(tmp_path, pil_format, quality=80)
+    os.replace(tmp_path, cache_path)
+    return os.path.getsize(cache_path)
+
+def get_image_variant(source_path, size_name, variant_format):
+    """
+    回傳縮圖在磁碟快取中的路徑與 mimetype。
+    快取檔名由原圖路徑、大小、修改時間與縮圖規格雜湊而成，原圖變動後自然對應到新的快取檔。
+    """
+    max_side = app.config['IMAGE_VARIANT_SIZES'][size_name]
+    _, extension, mimetype = IMAGE_VARIANT_FORMATS[variant_format]
+    st = storage_stat(source_path)
+    key = hashlib.sha1(f"{source_path}|{st.st_size}|{st.st_mtime_ns}|{max_side}|{variant_format}".encode('utf-8')).hexdigest()
+    cache_path = os.path.join(app.config['IMAGE_VARIANT_CACHE_FOLDER'], key[:2], f"{key}.{extension}")
+
+    if os.path.isfile(cache_path):
+        _touch_image_variant(cache_path)
+        return cache_path, mimetype
+
+    with _image_variant_lock:
+        future = _image_variant_inflight.get(cache_path)
+        if future is None:
+            future = image_variant_executor.submit(_render_image_variant, source_path, cache_path, max_side, variant_format)
+            _image_variant_inflight[cache_path] = future
+            is_owner = True
+        else:
+            is_owner = False
+    try:
+        variant_size = future.result()
+    finally:
+        if is_owner:
+            with _image_variant_lock:
+                _image_variant_inflight.pop(cache_path, None)
+    if is_owner:
+        _touch_image_variant(cache_path, variant_size)
+    return cache_path, mimetype
+
+# --- Keyframe Contact Sheets (關鍵影格拼貼圖) ---
+# 影像瀏覽器打開某個行為時，把所有關鍵影格縮小後拼成一張圖，一個請求就能顯示整個畫廊。
+_contact_sheet_cache = OrderedDict() # 快取鍵 (見 contact_sheet_key) -> 拼貼結果 dict
+_contact_sheet_cache_lock = threading.Lock()
+_contact_sheet_cache_state = {"bytes": 0}
+
+def _render_contact_tile(image_path, tile_size):
+    """縮小單張影像；無法讀取的影像回傳 None，在拼貼圖中視為缺少。"""
+    try:
+        with storage_open(image_path) as source, Image.open(source) as img:
+            img.draft('RGB', (tile_size, tile_size))
+            img = img.convert('RGB')
+            img.thumbnail((tile_size, tile_size), Image.LANCZOS)
+            return img
+    except OSError as e:
+        logger.warning("無法讀取關鍵影格 %s: %s", image_path, e)
+        return None
+
+def contact_sheet_key(manifest, image_filenames, variant_format):
+    """回傳 (快取鍵, 各影像版本)；任何一張影像被替換或拼貼設定改變時，快取鍵都會不同。"""
+    versions = resolve_keyframe_versions(manifest, image_filenames)
+    key = compute_etag('contact_sheet', manifest["folder"], [(name, versions[name]) for name in image_filenames],
+                       app.config['CONTACT_SHEET_TILE_SIZE'], app.config['CONTACT_SHEET_COLUMNS'], variant_format)
+    return key, versions
+
+def get_contact_sheet(manifest, versions, cache_key, variant_format):
+    """
+    取得拼貼結果 {"image": bytes, "mimetype", "width", "height", "tiles": [...], "missing": [...]}。
+    各影像在縮圖執行緒池中並行解碼與縮小，完成的結果依位元組數以 LRU 快取。
+    """
+    with _contact_sheet_cache_lock:
+        cached = _contact_sheet_cache.get(cache_key)
+        if cached is not None:
+            _contact_sheet_cache.move_to_end(cache_key)
+            return cached
+
+    tile_size = app.config['CONTACT_SHEET_TILE_SIZE']
+    names = [name for name, version in versions.items() if version]
+    paths = [resolve_keyframe_image(manifest, name)[0] for name in names]
+    rendered = list(image_variant_executor.map(functools.partial(_render_contact_tile, tile_size=tile_size), paths))
+    tiles_to_place = [(name, tile) for name, tile in zip(names, rendered) if tile is not None]
+    missing = [name for name in versions if name not in {placed for placed, _ in tiles_to_place}]
+
+    columns = max(1, min(app.config['CONTACT_SHEET_COLUMNS'], len(tiles_to_place)))
+    rows = max(1, -(-len(tiles_to_place) // columns))
+    sheet = Image.new('RGB', (columns * tile_size, rows * tile_size), (255, 255, 255))
+    tiles = []
+    for index, (name, tile) in enumerate(tiles_to_place):
+        # 每格大小固定，影像置中；tiles 記錄影像實際所在的矩形
+        x = (index % columns) * tile_size + (tile_size - tile.width) // 2
+        y = (index // columns) * tile_size + (tile_size - tile.height) // 2
+        sheet.paste(tile, (x, y))
+        tiles.append({"image_file": name, "version": versions[name], "x": x, "y": y, "width": tile.width, "height": tile.height})
+
+    pil_format, _, mimetype = IMAGE_VARIANT_FORMATS[variant_format]
+    output = io.BytesIO()
+    sheet.save(output, pil_format, quality=80)
+    result = {
+        "image": output.getvalue(), "mimetype": mimetype, "width": sheet.width, "height": sheet.height,
+        "tile_size": tile_size, "columns": columns, "tiles": tiles, "missing": missing,
+    }
+    with _contact_sheet_cache_lock:
+        if cache_key not in _contact_sheet_cache:
+            _contact_sheet_cache_state["bytes"] += len(result["image"])
+        _contact_sheet_cache[cache_key] = result
+        _contact_sheet_cache.move_to_end(cache_key)
+        while _contact_sheet_cache_state["bytes"] > app.config['CONTACT_SHEET_CACHE_MAX_BYTES'] and len(_contact_sheet_cache) > 1:
+            _, evicted = _contact_sheet_cache.popitem(last=False)
+            _contact_sheet_cache_state["bytes"] -= len(evicted["image"])
+    return result
+
+# --- ClickLog Write Buffer (點擊日誌批次寫入) ---
+def _bounded_number(value, minimum, maximum):
+    """轉為 float；無法轉換、不是有限值 (inf/nan) 或超出 [minimum, maximum] 時回傳 None。"""
+    try:
+        number = float(value)
+    except (ValueError, TypeError, OverflowError):
+        return None
+    if not math.isfinite(number) or not minimum <= number <= maximum:
+        return None
+    return number
+
+def build_click_log_row(user_id, event_type, element_or_page_id, duration_seconds_raw=None, age_ms_raw=None, received_at=None):
+    """
+    將前端事件轉為 ClickLog 資料列 (dict)；時間戳在收到事件時決定，而不是寫入資料庫時。
+    前端暫存後批次送出的事件帶有 age_ms (事件發生到送出經過的毫秒數)，時間戳為收到時間減去 age_ms，
+    不依賴用戶端時鐘；age_ms 限制在 0 到 CLICK_LOG_MAX_EVENT_AGE_SECONDS 之間，事件時間不會晚於收到時間。
+    """
+    received_at = received_at or datetime.datetime.utcnow()
+    duration_to_save = None
+    if duration_seconds_raw is not None:
+        duration = _bounded_number(duration_seconds_raw, 0, app.config['CLICK_LOG_MAX_DURATION_SECONDS'])
+        if duration is None:
+            logger.warning("Invalid duration_seconds value: %r. Storing as NULL.", duration_seconds_raw)
+        else:
+            duration_to_save = int(duration) # 先轉float再轉int，處理可能的小數
+    timestamp = received_at
+    if age_ms_raw is not None:
+        max_age_ms = app.config['CLICK_LOG_MAX_EVENT_AGE_SECONDS'] * 1000
+        age_ms = _bounded_number(age_ms_raw, -math.inf, math.inf)
+        if age_ms is not None:
+            timestamp = received_at - datetime.timedelta(milliseconds=min(max(age_ms, 0), max_age_ms))
+    return {
+        "user_id": user_id,
+        "event_type": str(event_type),
+        "element_or_page_id": str(element_or_page_id),
+        "timestamp": timestamp,
+        "duration_seconds": duration_to_save,
+    }
+
+def apply_activity_rollup(rows):
+    """將一批 ClickLog 資料列累加到 ActivityRollup (不會提交交易)。"""
+    totals = {}
+    for row in rows:
+        key = (row["user_id"], row["timestamp"].date(), row["event_type"], row["element_or_page_id"])
+        count, duration = totals.get(key, (0, 0))
+        totals[key] = (count + 1, duration + (row["duration_seconds"] or 0))
+    if not totals:
+        return
+
+    table = ActivityRollup.__table__
+    stmt = sqlite_insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id', 'day', 'event_type', 'element_or_page_id'],
+        set_={
+            'event_count': table.c.event_count + stmt.excluded.event_count,
+            'total_duration_seconds': table.c.total_duration_seconds + stmt.excluded.total_duration_seconds,
+        }
+    )
+    db.session.execute(stmt, [
+        {"user_id": user_id, "day": day, "event_type": event_type, "element_or_page_id": element_or_page_id,
+         "event_count": count, "total_duration_seconds": duration}
+        for (user_id, day, event_type, element_or_page_id), (count, duration) in totals.items()
+    ])
+
+def replace_page_dwell_rows(day, user_ids):
+    """以原始事件重算某一天指定學生的頁面停留秒數，取代 PageDwellDaily 中的舊資料 (不會提交交易)。"""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    start, end = _click_log_day_bounds(day)
+    dwell_by_user = compute_page_dwell_times(user_ids, start, end)
+    db.session.execute(PageDwellDaily.__table__.delete().where(
+        PageDwellDaily.day == day, PageDwellDaily.user_id.in_(user_ids)
+    ))
+    dwell_rows = [
+        {"user_id": user_id, "day": day, "element_or_page_id": page_id, "dwell_seconds": seconds}
+        for user_id, pages in dwell_by_user.items() for page_id, seconds in pages.items()
+    ]
+    if dwell_rows:
+        db.session.execute(PageDwellDaily.__table__.insert(), dwell_rows)
+
+def _page_dwell_increments(previous_time, current_page, rows, session_timeout_seconds):
+    """
+    依 compute_page_dwell_times 的規則累計一段依時間排序的事件的停留秒數，回傳 {page_id: seconds}。
+    previous_time / current_page 是這段事件之前最後一筆事件的時間與當時所在的頁面 (沒有則為 None)。
+    """
+    totals = {}
+    for row in rows:
+        if previous_time is not None and current_page is not None:
+            gap = (row["timestamp"] - previous_time).total_seconds()
+            if gap < session_timeout_seconds:
+                totals[current_page] = totals.get(current_page, 0) + gap
+        if row["event_type"] in PAGE_ENTRY_EVENT_TYPES:
+            current_page = row["element_or_page_id"]
+        elif row["event_type"].startswith(PAGE_EXIT_EVENT_PREFIX):
+            current_page = None
+        previous_time = row["timestamp"]
+    return totals
+
+def apply_page_dwell_rollup(rows):
+    """
+    依一批已寫入的 ClickLog 資料列更新 PageDwellDaily (不會提交交易)。
+    這批事件都在該學生當天既有事件之後時 (一般情況)，只從前一筆事件與當時所在的頁面接著累加；
+    有較早的事件晚到時，重算該學生當天的停留時間。已壓縮的日期原始事件已刪除，保留封存時算好的資料。
+    """
+    rows_by_key = {}
+    for row in rows:
+        rows_by_key.setdefault((row["user_id"], row["timestamp"].date()), []).append(row)
+    if not rows_by_key:
+        return
+    compacted_days = {
+        day for (day,) in db.session.query(ClickLogArchiveDay.day).filter(
+            ClickLogArchiveDay.day.in_({day for _, day in rows_by_key}), ClickLogArchiveDay.status == 'compacted'
+        )
+    }
+    session_timeout_seconds = app.config['SESSION_INACTIVITY_TIMEOUT_SECONDS']
+    increments = {}
+    recompute_users_by_day = {}
+    for (user_id, day), user_rows in rows_by_key.items():
+        if day in compacted_days:
+            continue
+        user_rows.sort(key=lambda row: row["timestamp"])
+        day_start, day_end = _click_log_day_bounds(day)
+        first_time = user_rows[0]["timestamp"]
+        user_day_filters = (ClickLog.user_id == user_id, ClickLog.timestamp >= day_start, ClickLog.timestamp < day_end)
+        later_count = db.session.query(db.func.count(ClickLog.id)).filter(
+            *user_day_filters, ClickLog.timestamp >= first_time
+        ).scalar()
+        if later_count != len(user_rows):
+            recompute_users_by_day.setdefault(day, set()).add(user_id)
+            continue
+        previous_time = db.session.query(db.func.max(ClickLog.timestamp)).filter(
+            *user_day_filters, ClickLog.timestamp < first_time
+        ).scalar()
+        current_page = None
+        if previous_time is not None:
+            marker = db.session.query(ClickLog.event_type, ClickLog.element_or_page_id).filter(
+                *user_day_filters, ClickLog.timestamp < first_time,
+                db.or_(ClickLog.event_type.in_(PAGE_ENTRY_EVENT_TYPES), ClickLog.event_type.startswith(PAGE_EXIT_EVENT_PREFIX, autoescape=True))
+            ).order_by(ClickLog.timestamp.desc()).first()
+            if marker is not None and marker[0] in PAGE_ENTRY_EVENT_TYPES:
+                current_page = marker[1]
+        for page_id, seconds in _page_dwell_increments(previous_time, current_page, user_rows, session_timeout_seconds).items():
+            increments[(user_id, day, page_id)] = seconds
+
+    if increments:
+        table = PageDwellDaily.__table__
+        stmt = sqlite_insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['user_id', 'day', 'element_or_page_id'],
+            set_={'dwell_seconds': table.c.dwell_seconds + stmt.excluded.dwell_seconds}
+        )
+        db.session.execute(stmt, [
+            {"user_id": user_id, "day": day, "element_or_page_id": page_id, "dwell_seconds": seconds}
+            for (user_id, day, page_id), seconds in increments.items()
+        ])
+    for day, user_ids in recompute_users_by_day.items():
+        replace_page_dwell_rows(day, user_ids)
+
+def rebuild_activity_rollup():
+    """
+    從 ClickLog 原始日誌重新計算彙總表與每日頁面停留時間，回傳重建後的彙總資料列數。
+    已封存 (原始事件已刪除) 的日期無法重算，保留原本的彙總資料。
+    """
+    click_log_buffer.flush()
+    ensure_click_log_schema()
+    table = ActivityRollup.__table__
+    day_expr = db.func.date(ClickLog.timestamp)
+    compacted_days = db.select(ClickLogArchiveDay.day).where(ClickLogArchiveDay.status == 'compacted')
+    source = db.select(
+        ClickLog.user_id,
+        day_expr,
+        ClickLog.event_type,
+        ClickLog.element_or_page_id,
+        db.func.count(ClickLog.id),
+        db.func.coalesce(db.func.sum(ClickLog.duration_seconds), 0),
+    ).where(day_expr.not_in(compacted_days)).group_by(ClickLog.user_id, day_expr, ClickLog.event_type, ClickLog.element_or_page_id)
+    db.session.execute(table.delete().where(ActivityRollup.day.not_in(compacted_days)))
+    db.session.execute(table.insert().from_select(
+        ['user_id', 'day', 'event_type', 'element_or_page_id', 'event_count', 'total_duration_seconds'], source
+    ))
+    db.session.execute(PageDwellDaily.__table__.delete().where(PageDwellDaily.day.not_in(compacted_days)))
+    users_by_day = {}
+    for day_str, user_id in db.session.execute(
+        db.select(day_expr, ClickLog.user_id).where(day_expr.not_in(compacted_days)).distinct()
+    ):
+        users_by_day.setdefault(datetime.date.fromisoformat(day_str), []).append(user_id)
+    for day, user_ids in users_by_day.items():
+        replace_page_dwell_rows(day, user_ids)
+    db.session.commit()
+    return db.session.query(db.func.count(ActivityRollup.id)).scalar()
+
+_activity_rollup_checked = False
+
+def ensure_activity_rollup():
+    """第一次使用時確認彙總表存在；若彙總表是空的但已有 ClickLog (舊版本升級)，從原始日誌補齊歷史資料。"""
+    global _activity_rollup_checked
+    if _activity_rollup_checked:
+        return
+    ensure_click_log_schema()
+    ActivityRollup.__table__.create(db.engine, checkfirst=True)
+    if ActivityRollup.query.first() is None and ClickLog.query.first() is not None:
+        row_count = rebuild_activity_rollup()
+        logger.info("已從原始日誌補齊 %d 筆活動彙總資料。", row_count)
+    _activity_rollup_checked = True
+
+@app.cli.command('rebuild-activity-rollup')
+def rebuild_activity_rollup_command():
+    """從 ClickLog 原始日誌重建活動彙總表。"""
+    db.create_all()
+    row_count = rebuild_activity_rollup()
+    print(f"活動彙總表重建完成，共 {row_count} 筆彙總資料。")
+
+class ClickLogBuffer:
+    """
+    程序內的 ClickLog 寫入緩衝區。
+    事件先放入記憶體佇列，累積到 flush_size 筆或每隔 flush_interval 秒，由背景執行緒以單一交易批次寫入；
+    程序結束時會再寫入一次剩餘的事件。
+    佇列最多保留 max_pending 筆事件，超過時丟棄新事件。寫入失敗的批次與新事件分開重試，
+    某一批有問題的資料不會擋住之後的事件；同一批失敗 max_attempts 次後寫入 dead-letter 檔案並放棄。
+    """
+    def __init__(self, flush_size, flush_interval, max_pending, max_attempts):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self._pending = []
+        self._failed_batches = deque() # [(失敗次數, 事件列表)]
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.flushed_events = 0
+        self.flush_count = 0
+        self.failed_flushes = 0
+        self.dropped_events = 0 # 佇列已滿而丟棄的事件數
+        self.dead_lettered_events = 0 # 重試失敗後寫入 dead-letter 檔案的事件數
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+    def _queued_events(self):
+        return len(self._pending) + sum(len(batch) for _, batch in self._failed_batches)
+
+    def add(self, rows):
+        with self._lock:
+            room = max(0, self.max_pending - self._queued_events())
+            dropped = len(rows) - room if len(rows) > room else 0
+            if dropped:
+                rows = rows[:room]
+                self.dropped_events += dropped
+            self._pending.extend(rows)
+            depth = len(self._pending)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='click-log-flusher', daemon=True)
+                self._thread.start()
+        if dropped:
+            logger.warning("ClickLog 寫入佇列已滿 (%d 筆)，丟棄 %d 筆新事件。", self.max_pending, dropped)
+        if depth >= self.flush_size:
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self, final=False):
+        """寫入所有等待中的事件，回傳成功寫入的筆數。final=True (程序結束時) 寫入失敗的批次直接寫入 dead-letter 檔案。"""
+        with self._flush_lock:
+            with self._lock:
+                batches = list(self._failed_batches)
+                self._failed_batches.clear()
+                if self._pending:
+                    batches.append((0, self._pending))
+                    self._pending = []
+            return sum(self._write_batch(attempts, batch, final) for attempts, batch in batches)
+
+    def _write_batch(self, attempts, batch, final):
+        started = time.perf_counter()
+        try:
+            with app.app_context():
+                ensure_click_log_schema()
+                db.session.execute(ClickLog.__table__.insert(), batch)
+                apply_activity_rollup(batch) # 與原始日誌在同一個交易中更新彙總表
+                apply_page_dwell_rollup(batch) # 須在寫入原始日誌之後：以資料表中的前後事件判斷
+                db.session.commit()
+        except Exception as e:
+            self.failed_flushes += 1
+            attempts += 1
+            if final or attempts >= self.max_attempts:
+                logger.error("ClickLog 批次寫入 %d 筆事件失敗 %d 次，改寫入 dead-letter 檔案: %s", len(batch), attempts, e)
+                self._dead_letter(batch, e)
+            else:
+                logger.error("ClickLog 批次寫入 %d 筆事件失敗 (第 %d 次)，將於下次重試: %s", len(batch), attempts, e)
+                with self._lock:
+                    self._failed_batches.append((attempts, batch))
+            return 0
+        elapsed = time.perf_counter() - started
+        if dashboard_events.has_subscribers():
+            try:
+                with app.app_context():
+                    publish_activity_changes({row["user_id"] for row in batch})
+            except Exception as e:
+                logger.warning("推送活動更新給教師儀表板失敗: %s", e)
+        self.flushed_events += len(batch)
+        self.flush_count += 1
+        self.last_flush_seconds = elapsed
+        self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+        self.total_flush_seconds += elapsed
+        return len(batch)
+
+    def _dead_letter(self, batch, error):
+        """把放棄寫入的事件附加到 CLICK_LOG_DEAD_LETTER_FOLDER/YYYY-MM-DD.jsonl，之後可人工檢查或重新匯入。"""
+        self.dead_lettered_events += len(batch)
+        folder = app.config['CLICK_LOG_DEAD_LETTER_FOLDER']
+        path = os.path.join(folder, f"{datetime.date.today().isoformat()}.jsonl")
+        try:
+            os.makedirs(folder, exist_ok=True)
+            with open(path, 'a', encoding='utf-8') as f:
+                for row in batch:
+                    event = {key: value.isoformat() if isinstance(value, datetime.datetime) else value for key, value in row.items()}
+                    f.write(json.dumps({"error": str(error), "event": event}, ensure_ascii=False) + "\n")
+        except Exception as e:
+            logger.error("無法寫入 ClickLog dead-letter 檔案 %s，%d 筆事件遺失: %s", path, len(batch), e)
+
+    def stats(self):
+        with self._lock:
+            depth = self._queued_events()
+        return {
+            "queue_depth": depth,
+            "flushed_events": self.flushed_events,
+            "flush_count": self.flush_count,
+            "failed_flushes": self.failed_flushes,
+            "dropped_events": self.dropped_events,
+            "dead_lettered_events": self.dead_lettered_events,
+            "last_flush_seconds": self.last_flush_seconds,
+            "max_flush_seconds": self.max_flush_seconds,
+            "avg_flush_seconds": self.total_flush_seconds / self.flush_count if self.flush_count else 0.0,
+        }
+
+click_log_buffer = ClickLogBuffer(app.config['CLICK_LOG_FLUSH_SIZE'], app.config['CLICK_LOG_FLUSH_INTERVAL_SECONDS'],
+                                  app.config['CLICK_LOG_MAX_PENDING_EVENTS'], app.config['CLICK_LOG_MAX_FLUSH_ATTEMPTS'])
+atexit.register(click_log_buffer.flush, True) # 程序關閉時寫入尚未落地的事件，無法寫入的留在 dead-letter 檔案
+
+# --- ClickLog Retention (點擊日誌保存期限與封存) ---
+# 超過 CLICK_LOG_RETENTION_DAYS 的原始事件逐日處理：
+#   1. 匯出 — 當天的事件依 id 排序寫成 gzip 壓縮的 JSON Lines，放在 CLICK_LOG_ARCHIVE_FOLDER/YYYY-MM/YYYY-MM-DD.jsonl.gz，
+#      記錄筆數、最大 id 與檔案雜湊 (status='exported')
+#   2. 壓縮 — 在同一個交易中重算當天的頁面停留時間 (PageDwellDaily)、刪除原始事件 (status='compacted')
+# 點擊數與停留秒數的每日彙總 (ActivityRollup) 及頁面停留時間在寫入時就已維護，刪除原始事件不影響班級摘要。
+CLICK_LOG_ARCHIVE_FIELDS = ('id', 'user_id', 'event_type', 'element_or_page_id', 'timestamp', 'duration_seconds')
+
+class ClickLogArchiveError(Exception):
+    pass
+
+_click_log_schema_checked = False
+
+def ensure_click_log_schema():
+    """建立封存相關資料表，並為舊版本建立的 ClickLog 表補上複合索引 (create_all 不會修改已存在的表)。"""
+    global _click_log_schema_checked
+    if _click_log_schema_checked:
+        return
+    for index in ClickLog.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+    ClickLogArchiveDay.__table__.create(db.engine, checkfirst=True)
+    PageDwellDaily.__table__.create(db.engine, checkfirst=True)
+    _click_log_schema_checked = True
+
+def _click_log_day_bounds(day):
+    start = datetime.datetime.combine(day, datetime.time.min)
+    return start, start + datetime.timedelta(days=1)
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def export_click_log_day(day):
+    """把某一天的原始事件寫入封存檔並記錄進度，回傳 ClickLogArchiveDay；當天沒有事件則回傳 None。"""
+    start, end = _click_log_day_bounds(day)
+    archive_path = os.path.join(f"{day:%Y-%m}", f"{day:%Y-%m-%d}.jsonl.gz")
+    full_path = os.path.join(app.config['CLICK_LOG_ARCHIVE_FOLDER'], archive_path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+    stmt = db.select(*(getattr(ClickLog, field) for field in CLICK_LOG_ARCHIVE_FIELDS)).where(
+        ClickLog.timestamp >= start, ClickLog.timestamp < end
+    ).order_by(ClickLog.id).execution_options(yield_per=5000)
+    row_count, max_log_id = 0, None
+    temp_path = full_path + '.tmp'
+    with gzip.open(temp_path, 'wt', encoding='utf-8', compresslevel=app.config['RESPONSE_GZIP_LEVEL']) as f:
+        for row in db.session.execute(stmt):
+            record = dict(zip(CLICK_LOG_ARCHIVE_FIELDS, row))
+            record['timestamp'] = record['timestamp'].isoformat()
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            row_count += 1
+            max_log_id = record['id']
+    if row_count == 0:
+        os.remove(temp_path)
+        return None
+    os.replace(temp_path, full_path) # 中斷時不會留下寫到一半的封存檔
+
+    archive_day = ClickLogArchiveDay(
+        day=day, status='exported', row_count=row_count, max_log_id=max_log_id,
+        archive_path=archive_path.replace(os.sep, '/'), sha256=_file_sha256(full_path)
+    )
+    db.session.add(archive_day)
+    db.session.commit()
+    return archive_day
+
+def compact_click_log_day(archive_day):
+    """以完整的當天原始事件重算頁面停留時間，並刪除已封存的原始事件，兩者在同一個交易中完成。"""
+    start, end = _click_log_day_bounds(archive_day.day)
+    user_ids = db.session.execute(
+        db.select(ClickLog.user_id).where(ClickLog.timestamp >= start, ClickLog.timestamp < end).distinct()
+    ).scalars().all()
+    replace_page_dwell_rows(archive_day.day, user_ids)
+    deleted = db.session.execute(ClickLog.__table__.delete().where(
+        ClickLog.timestamp >= start, ClickLog.timestamp < end, ClickLog.id <= archive_day.max_log_id
+    )).rowcount
+    if deleted != archive_day.row_count:
+        db.session.rollback()
+        raise ClickLogArchiveError(
+            f"{archive_day.day} 的原始事件數 ({deleted}) 與封存檔 ({archive_day.row_count}) 不一致，未刪除任何資料"
+        )
+    archive_day.status = 'compacted'
+    archive_day.compacted_at = datetime.datetime.utcnow()
+    db.session.commit()
+
+def compact_click_logs(retention_days=None):
+    """
+    封存並刪除超過保存期限的原始事件，回傳 {'days', 'rows', 'errors'}。
+    先完成上次中斷在 'exported' 的日期，再由舊到新處理其餘日期；某一天失敗只記錄錯誤，不影響其他日期。
+    """
+    if retention_days is None:
+        retention_days = app.config['CLICK_LOG_RETENTION_DAYS']
+    click_log_buffer.flush()
+    ensure_activity_rollup() # 彙總表必須先涵蓋這些日期，原始事件刪除後就無法再重算
+    cutoff = datetime.datetime.combine(
+        datetime.datetime.utcnow().date() - datetime.timedelta(days=retention_days), datetime.time.min
+    )
+    result = {"days": 0, "rows": 0, "errors": []}
+
+    def compact(archive_day):
+        try:
+            compact_click_log_day(archive_day)
+        except ClickLogArchiveError as e:
+            result["errors"].append(str(e))
+            return
+        result["days"] += 1
+        result["rows"] += archive_day.row_count
+        logger.info("已封存 %s 的 %d 筆 ClickLog。", archive_day.day, archive_day.row_count)
+
+    for archive_day in ClickLogArchiveDay.query.filter_by(status='exported').order_by(ClickLogArchiveDay.day).all():
+        compact(archive_day)
+
+    compacted_days = {
+        day for (day,) in db.session.query(ClickLogArchiveDay.day).filter_by(status='compacted')
+    }
+    expired_days = db.session.query(db.func.date(ClickLog.timestamp)).filter(
+        ClickLog.timestamp < cutoff
+    ).distinct().order_by(db.func.date(ClickLog.timestamp)).all()
+    for (day_str,) in expired_days:
+        day = datetime.date.fromisoformat(day_str)
+        if day in compacted_days:
+            # 封存後才寫入的舊事件 (例如手動匯入)，不覆寫既有的封存檔，留待人工處理
+            result["errors"].append(f"{day} 已封存，但資料表中仍有該日的事件")
+            continue
+        archive_day = export_click_log_day(day)
+        if archive_day is not None:
+            compact(archive_day)
+    return result
+
+def verify_click_log_archives():
+    """
+    逐一檢查封存紀錄：封存檔存在且雜湊相符、內容筆數與最大 id 與紀錄一致、事件都屬於該日期，
+    已壓縮的日期在資料表中不再有原始事件，且活動彙總的事件數與封存筆數相同。回傳問題描述的列表。
+    """
+    problems = []
+    for archive_day in ClickLogArchiveDay.query.order_by(ClickLogArchiveDay.day).all():
+        label = f"{archive_day.day}"
+        full_path = os.path.join(app.config['CLICK_LOG_ARCHIVE_FOLDER'], archive_day.archive_path)
+        if not os.path.exists(full_path):
+            problems.append(f"{label}: 找不到封存檔 {archive_day.archive_path}")
+            continue
+        if _file_sha256(full_path) != archive_day.sha256:
+            problems.append(f"{label}: 封存檔雜湊不符")
+            continue
+
+        start, end = _click_log_day_bounds(archive_day.day)
+        row_count, max_log_id, out_of_range = 0, None, 0
+        try:
+            with gzip.open(full_path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    row_count += 1
+                    max_log_id = record['id'] if max_log_id is None else max(max_log_id, record['id'])
+                    if not start <= datetime.datetime.fromisoformat(record['timestamp']) < end:
+                        out_of_range += 1
+        except (OSError, ValueError, KeyError) as e:
+            problems.append(f"{label}: 無法讀取封存檔 ({e})")
+            continue
+        if row_count != archive_day.row_count or max_log_id != archive_day.max_log_id:
+            problems.append(f"{label}: 封存檔有 {row_count} 筆 (最大 id {max_log_id})，紀錄為 {archive_day.row_count} 筆 (最大 id {archive_day.max_log_id})")
+        if out_of_range:
+            problems.append(f"{label}: 封存檔中有 {out_of_range} 筆事件不屬於該日期")
+
+        if archive_day.status == 'compacted':
+            remaining = db.session.query(db.func.count(ClickLog.id)).filter(
+                ClickLog.timestamp >= start, ClickLog.timestamp < end, ClickLog.id <= archive_day.max_log_id
+            ).scalar()
+            if remaining:
+                problems.append(f"{label}: 已壓縮，但資料表中仍有 {remaining} 筆已封存的事件")
+            rollup_count = db.session.query(db.func.coalesce(db.func.sum(ActivityRollup.event_count), 0)).filter(
+                ActivityRollup.day == archive_day.day
+            ).scalar()
+            if rollup_count != archive_day.row_count:
+                problems.append(f"{label}: 活動彙總有 {rollup_count} 筆事件，封存檔為 {archive_day.row_count} 筆")
+    return problems
+
+def rollup_page_dwell_times(user_ids, first_day, last_day):
+    """從 PageDwellDaily 加總 first_day 到 last_day (含) 的頁面停留秒數，格式同 compute_page_dwell_times。"""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+    rows = db.session.query(
+        PageDwellDaily.user_id, PageDwellDaily.element_or_page_id, db.func.sum(PageDwellDaily.dwell_seconds)
+    ).filter(
+        PageDwellDaily.user_id.in_(user_ids),
+        PageDwellDaily.day >= first_day,
+        PageDwellDaily.day <= last_day,
+    ).group_by(PageDwellDaily.user_id, PageDwellDaily.element_or_page_id).all()
+    dwell_by_user = {}
+    for user_id, page_id, seconds in rows:
+        dwell_by_user.setdefault(user_id, {})[page_id] = seconds
+    return dwell_by_user
+
+@app.cli.command('compact-click-logs')
+@click.option('--retention-days', type=int, default=None, help='保留最近幾天的原始事件 (預設為 CLICK_LOG_RETENTION_DAYS)')
+@click.option('--verify', is_flag=True, help='完成後檢查所有封存檔與資料表是否一致')
+@click.option('--vacuum', is_flag=True, help='完成後執行 VACUUM 以縮小 SQLite 檔案')
+def compact_click_logs_command(retention_days, verify, vacuum):
+    """封存超過保存期限的 ClickLog 並從資料表刪除；中斷後重新執行會從上次的進度繼續。"""
+    db.create_all()
+    result = compact_click_logs(retention_days)
+    for error in result['errors']:
+        print(f"錯誤: {error}")
+    print(f"ClickLog 封存完成: {result['days']} 天，共 {result['rows']} 筆事件。")
+
+    if vacuum:
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.exec_driver_sql('VACUUM')
+        print("已執行 VACUUM。")
+
+    if verify:
+        problems = verify_click_log_archives()
+        for problem in problems:
+            print(f"驗證失敗: {problem}")
+        archived_days = db.session.query(db.func.count(ClickLogArchiveDay.id)).scalar()
+        print(f"已驗證 {archived_days} 天的封存檔，發現 {len(problems)} 個問題。")
+        if problems:
+            raise SystemExit(1)
+    if result['errors']:
+        raise SystemExit(1)
+
+# --- Dashboard Events (教師儀表板即時更新) ---
+# 教師儀表板以 SSE (/api/teacher/events) 訂閱差異事件，不必反覆重新載入整個班級摘要：
+#   report   — 某位學生的報告新增/更新/移除 (來自報告資料夾的掃描)
+#   activity — 某位學生的點擊數與停留時間更新 (來自 ClickLog 批次寫入)
+#   resync   — 差異無法補齊 (佇列溢出、重連時事件已過期、一次變動太多)，前端應重新載入完整摘要
+class DashboardSubscriber:
+    def __init__(self, date, queue_size, student_ids=None):
+        self.date = date # 儀表板選擇的日期 'YYYY-MM-DD'，None 代表「最新」
+        self.student_ids = student_ids # 教師班級內的學生 id，None 代表所有學生
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.overflowed = False
+
+class DashboardEventHub:
+    """管理 SSE 訂閱者；事件依訂閱者選擇的日期與班級過濾後放入各自的有界佇列，不會阻塞發布端。"""
+    def __init__(self, queue_size, history_size):
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._history = deque(maxlen=history_size) # (event_id, event_type, date_scope, payload)
+        self._next_event_id = 1
+        self._lock = threading.Lock()
+
+    def subscribe(self, date, student_ids=None):
+        subscriber = DashboardSubscriber(date, self.queue_size, student_ids)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def has_subscribers(self):
+        with self._lock:
+            return bool(self._subscribers)
+
+    def subscribed_dates(self):
+        with self._lock:
+            return {subscriber.date for subscriber in self._subscribers}
+
+    @staticmethod
+    def _matches(subscriber, event):
+        _, event_type, date_scope, payload = event
+        subscriber_date = subscriber.date
+        student_id = payload.get("student_id")
+        if student_id is not None and subscriber.student_ids is not None and student_id not in subscriber.student_ids:
+            return False # 不在教師班級內的學生
+        if event_type == 'report':
+            # 報告事件以報告日期過濾；「最新」模式接收所有日期，由前端判斷是否比目前顯示的更新
+            return subscriber_date is None or subscriber_date == date_scope
+        if event_type == 'activity':
+            return subscriber_date == date_scope # 活動總計是依訂閱者的日期分別計算的
+        return True
+
+    def publish(self, event_type, payload, date_scope=None):
+        with self._lock:
+            event = (self._next_event_id, event_type, date_scope, payload)
+            self._next_event_id += 1
+            self._history.append(event)
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            if subscriber.overflowed or not self._matches(subscriber, event):
+                continue
+            try:
+                subscriber.queue.put_nowait(event)
+            except queue.Full:
+                subscriber.overflowed = True # 用戶端讀取太慢，改為要求重新載入
+
+    def replay(self, last_event_id, subscriber):
+        """回傳 last_event_id 之後、符合訂閱者日期與班級的事件；若中間的事件已不在歷史紀錄中則回傳 None。"""
+        with self._lock:
+            history = list(self._history)
+            next_event_id = self._next_event_id
+        if last_event_id >= next_event_id:
+            return None # 伺服器已重新啟動，事件編號不連續
+        if last_event_id + 1 < next_event_id and (not history or history[0][0] > last_event_id + 1):
+            return None
+        return [event for event in history if event[0] > last_event_id and self._matches(subscriber, event)]
+
+    def last_event_id(self):
+        with self._lock:
+            return self._next_event_id - 1
+
+    def stats(self):
+        with self._lock:
+            return {"subscribers": len(self._subscribers), "published_events": self._next_event_id - 1}
+
+dashboard_events = DashboardEventHub(app.config['DASHBOARD_EVENTS_QUEUE_SIZE'], app.config['DASHBOARD_EVENTS_HISTORY_SIZE'])
+
+def format_sse_event(event):
+    event_id, event_type, _, payload = event
+    return f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+def publish_report_changes(changes):
+    """將報告目錄的變動推送給訂閱者；每筆附上該學生的最新報告摘要，前端可直接替換該學生的資料。"""
+    if len(changes) > app.config['DASHBOARD_EVENTS_MAX_REPORT_CHANGES']:
+        dashboard_events.publish('resync', {"reason": "report_changes", "count": len(changes)})
+        return
+    student_ids = dict(db.session.query(User.username, User.id).filter(
+        User.username.in_({student_name for student_name, _, _, _ in changes}), User.role == 'student'))
+    report_fields = set(SUMMARY_FIELDS) - {'web_activity'}
+    for student_name, filename, report_date, change in changes:
+        if student_name not in student_ids:
+            continue
+        payload = {
+            "student_id": student_ids[student_name],
+            "student_name": student_name,
+            "report_filename": filename,
+            "report_date": report_date,
+            "change": change,
+            "report_summary": None,
+        }
+        if change != 'removed':
+            # 同一天有多份報告時，只有該日最新的一份會顯示在儀表板上
+            entry = find_report_entries_for_students([student_name], report_date).get(student_name)
+            if entry is None or entry.filename != filename:
+                continue
+            payload["report_summary"] = build_student_report_summary(student_name, entry.file_path, filename, report_date, report_fields)
+        dashboard_events.publish('report', payload, report_date)
+
+def publish_activity_changes(user_ids):
+    """依各訂閱者選擇的日期，重新計算有新事件的學生的點擊數與停留時間並推送。"""
+    students = dict(db.session.query(User.id, User.username).filter(User.id.in_(user_ids), User.role == 'student'))
+    if not students:
+        return
+    for date in dashboard_events.subscribed_dates():
+        selected_date = datetime.date.fromisoformat(date) if date else None
+        clicks_by_student, time_by_student, untracked_time_by_student = summarize_web_activity(list(students), selected_date)
+        for student_id, student_name in students.items():
+            dashboard_events.publish('activity', {
+                "student_id": student_id,
+                "student_name": student_name,
+                "date": date,
+                "total_general_clicks": clicks_by_student.get(student_id, 0),
+                "time_spent_on_tabs_details": time_by_student.get(student_id, {}),
+                "estimated_time_on_untracked_pages": untracked_time_by_student.get(student_id, {}),
+            }, date)
+
+_report_watcher_lock = threading.Lock()
+_report_watcher_state = {"thread": None}
+
+def _watch_report_folder():
+    """有教師訂閱時，定期以增量掃描檢查報告資料夾；變動會在 refresh_report_catalog 中推送。沒有訂閱者時結束。"""
+    while True:
+        time.sleep(app.config['REPORT_WATCH_INTERVAL_SECONDS'])
+        with _report_watcher_lock:
+            if not dashboard_events.has_subscribers():
+                _report_watcher_state["thread"] = None
+                return
+        with _report_catalog_lock:
+            if _report_catalog_state["refreshing"]:
+                continue
+            _report_catalog_state["refreshing"] = True
+        _run_report_catalog_refresh()
+
+def ensure_report_folder_watcher():
+    with _report_watcher_lock:
+        if _report_watcher_state["thread"] is None:
+            _report_watcher_state["thread"] = threading.Thread(target=_watch_report_folder, name='report-folder-watcher', daemon=True)
+            _report_watcher_state["thread"].start()
+
+# --- Conditional Responses (條件式請求與預先壓縮) ---
+RESPONSE_ENCODINGS = ('br', 'gzip', 'identity') # 依偏好排序
+
+def compute_etag(*parts):
+    return hashlib.sha1(json.dumps(parts, default=str, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def report_catalog_version():
+    """報告目錄的版本：任何新增、更新或移除都會改變 (筆數, 最大 ID, 最後掃描時間) 其中之一。"""
+    return db.session.query(
+        db.func.count(ReportCatalogEntry.id), db.func.max(ReportCatalogEntry.id), db.func.max(ReportCatalogEntry.scanned_at)
+    ).one()
+
+def click_log_version():
+    return db.session.query(db.func.max(ClickLog.id)).scalar()
+
+def not_modified_response(etag, last_modified=None):
+    """
+    若請求的 If-None-Match (或沒有時的 If-Modified-Since) 與目前版本相符，回傳 304 回應，否則回傳 None。
+    ETag 一律是弱 ETag，不同壓縮編碼的回應視為相同內容。
+    """
+    if request.if_none_match:
+        matched = request.if_none_match.contains_weak(etag)
+    elif last_modified is not None and request.if_modified_since is not None:
+        matched = last_modified.replace(microsecond=0) <= request.if_modified_since
+    else:
+        matched = False
+    if not matched:
+        return None
+    return add_cache_validators(Response(status=304), etag, last_modified)
+
+def add_cache_validators(response, etag, last_modified=None):
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache' # 每次都要重新驗證，資料屬於登入的使用者
+    return response
+
+def encode_response_body(body):
+    """回傳 {編碼: 內容}，包含原始內容、gzip，以及在安裝了 brotli 時的 br。"""
+    encoded = {'identity': body, 'gzip': gzip.compress(body, compresslevel=app.config['RESPONSE_GZIP_LEVEL'])}
+    if brotli is not None:
+        encoded['br'] = brotli.compress(body, quality=app.config['RESPONSE_BROTLI_QUALITY'])
+    return encoded
+
+def encoded_json_response(encoded, status=200):
+    """依 Accept-Encoding 從預先壓縮好的內容中選出最適合的版本。"""
+    available = [name for name in RESPONSE_ENCODINGS if name in encoded]
+    encoding = request.accept_encodings.best_match(available, default='identity')
+    response = Response(encoded[encoding], status=status, mimetype='application/json')
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+def _encode_report_response(report_path):
+    """ReportJsonCache 的 loader：序列化報告摘要回應並預先壓縮，之後重複下載不需再序列化或壓縮。"""
+    summary = load_report_summary(report_path)
+    body = app.json.dumps({
+        "report_metadata": summary["report_metadata"],
+        "overall_summary": summary["overall_summary"],
+        "sequence_count": summary["sequence_count"],
+        "behavior_timeline": summary["behavior_timeline"],
+    }).encode('utf-8')
+    encoded = encode_response_body(body)
+    return encoded, sum(len(content) for content in encoded.values())
+
+report_response_cache = ReportJsonCache(app.config['REPORT_RESPONSE_CACHE_MAX_BYTES'], loader=_encode_report_response)
+
+def report_file_validators(report_path, *extra):
+    """以報告檔案的修改時間與大小 (及報告摘要格式版本) 產生 (ETag, Last-Modified)。"""
+    stat_result = storage_stat(report_path)
+    etag = compute_etag('report', os.path.basename(report_path), stat_result.st_mtime_ns, stat_result.st_size, REPORT_SIDECAR_VERSION, *extra)
+    last_modified = datetime.datetime.fromtimestamp(stat_result.st_mtime, tz=datetime.timezone.utc)
+    return etag, last_modified
+
+# --- Metrics (效能指標) ---
+# 每個請求記錄總延遲與各階段 (資料庫、檔案系統、JSON 解析) 花費的時間及回應大小，
+# 以 Prometheus 文字格式由 /api/admin/metrics 提供。
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RESPONSE_SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+REQUEST_PHASES = ('db', 'filesystem', 'json_parse')
+
+class Histogram:
+    def __init__(self, name, help_text, buckets, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.label_names = label_names
+        self._series = {} # labels -> [各區間計數..., 總和, 總數]
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.setdefault(labels, [0] * len(self.buckets) + [0.0, 0])
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labels, list(series)) for labels, series in self._series.items())
+        for labels, series in items:
+            label_text = _prometheus_labels(zip(self.label_names, labels))
+            for upper_bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{label_text},le="{upper_bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{label_text},le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{label_text}}} {series[-2]}")
+            lines.append(f"{self.name}_count{{{label_text}}} {series[-1]}")
+        return lines
+
+def _prometheus_labels(pairs):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ",".join(f'{name}="{escape(value)}"' for name, value in pairs)
+
+def _prometheus_metric(name, metric_type, help_text, samples):
+    """samples: [(標籤 dict, 數值), ...]"""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    for labels, value in samples:
+        label_text = _prometheus_labels(sorted(labels.items()))
+        lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    return lines
+
+request_duration_histogram = Histogram(
+    'http_request_duration_seconds', '請求從開始到回應送完的時間', LATENCY_BUCKETS, ('endpoint', 'method', 'status'))
+request_phase_histogram = Histogram(
+    'http_request_phase_seconds', '單一請求在各階段花費的時間', LATENCY_BUCKETS, ('endpoint', 'phase'))
+response_size_histogram = Histogram(
+    'http_response_size_bytes', '回應內容的位元組數', RESPONSE_SIZE_BUCKETS, ('endpoint',))
+
+class RequestMetrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = dict.fromkeys(REQUEST_PHASES, 0.0)
+        self.bytes_sent = 0
+        self._lock = threading.Lock() # 檔案系統執行緒池中的工作可能同時回報
+
+    def add(self, phase, seconds):
+        with self._lock:
+            self.phases[phase] += seconds
+
+_current_request_metrics = contextvars.ContextVar('current_request_metrics', default=None)
+
+def get_request_metrics():
+    """目前請求的 RequestMetrics；串流回應的產生器中改從 g 取得 (此時 before_request 設定的 contextvar 已不在)。"""
+    metrics = _current_request_metrics.get()
+    if metrics is None and has_request_context():
+        metrics = g.get('request_metrics')
+    return metrics
+
+class measure_phase:
+    """with measure_phase('json_parse'): ... 將區塊花費的時間計入目前請求的指定階段；不在請求中時不做任何事。"""
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        metrics = get_request_metrics()
+        if metrics is not None:
+            metrics.add(self.phase, time.perf_counter() - self.started)
+        return False
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _record_query_start(conn, cursor, statement, parameters, context, executemany):
+    conn.info['metrics_query_started'] = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _record_query_end(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('metrics_query_started', None)
+    metrics = get_request_metrics()
+    if started is not None and metrics is not None:
+        metrics.add('db', time.perf_counter() - started)
+
+@app.before_request
+def start_request_metrics():
+    g.request_metrics = RequestMetrics()
+    _current_request_metrics.set(g.request_metrics)
 
-# --- Helper Functions for Activity Summary ---
-def calculate_time_on_page(student_user_id, page_entry_element_pattern, session_timeout_seconds=1800): # 30分鐘超時
-    logs = ClickLog.query.filter_by(user_id=student_user_id).order_by(ClickLog.timestamp).all()
-    
-    total_duration_seconds = 0
-    page_session_start_time = None
-    last_activity_time_in_session = None
-
-    for i, log_entry in enumerate(logs):
-        is_page_entry = page_entry_element_pattern in log_entry.element_clicked
-
-        if page_session_start_time is not None:
-            # 如果當前日誌與上一日誌時間間隔超過超時，則結束上一個頁面會話
-            time_diff_from_last = (log_entry.timestamp - last_activity_time_in_session).total_seconds()
-            if time_diff_from_last >= session_timeout_seconds:
-                duration_this_segment = (last_activity_time_in_session - page_session_start_time).total_seconds()
-                total_duration_seconds += min(duration_this_segment, session_timeout_seconds) # 計入但不超過超時
-                page_session_start_time = None # 重置
-        
-        if is_page_entry:
-            if page_session_start_time is not None : # 如果是連續進入同一個頁面 (例如刷新)
-                 # 結束上一個停留段 (從上個 page_entry 到現在)
-                duration_this_segment = (log_entry.timestamp - page_session_start_time).total_seconds()
-                total_duration_seconds += min(duration_this_segment, session_timeout_seconds)
+def _count_streamed_bytes(iterable, metrics):
+    try:
+        for chunk in iterable:
+            metrics.bytes_sent += len(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            yield chunk
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
 
-            page_session_start_time = log_entry.timestamp # 開始新的停留段
-        
-        if page_session_start_time is not None: # 只要在頁面會話中，就更新最後活動時間
-            last_activity_time_in_session = log_entry.timestamp
+@app.after_request
+def finish_request_metrics(response):
+    metrics = get_request_metrics()
+    if metrics is None:
+        return response
+    endpoint = request.url_rule.endpoint if request.url_rule is not None else 'unmatched'
+    labels = (endpoint, request.method, str(response.status_code))
+    if response.is_streamed and not response.direct_passthrough:
+        response.response = _count_streamed_bytes(response.response, metrics)
+    content_length = response.content_length
 
-    # 處理最後一段停留時間
-    if page_session_start_time and last_activity_time_in_session:
-        duration_last_segment = (last_activity_time_in_session - page_session_start_time).total_seconds()
-        total_duration_seconds += min(duration_last_segment, session_timeout_seconds)
-        
-    return total_duration_seconds
+    def record():
+        # 串流回應在內容全部送出後才會呼叫，延遲包含串流時間
+        request_duration_histogram.observe(labels, time.perf_counter() - metrics.started)
+        for phase, seconds in metrics.phases.items():
+            request_phase_histogram.observe((endpoint, phase), seconds)
+        response_size_histogram.observe((endpoint,), content_length if content_length is not None else metrics.bytes_sent)
 
-def format_seconds_to_readable(total_seconds_float):
-    total_seconds = int(total_seconds_float) # 確保是整數
-    hours = total_seconds // 3600
-    minutes = (total_seconds % 3600) // 60
-    seconds = total_seconds % 60
-    if hours > 0:
-        return f"{hours}小時 {minutes}分 {seconds}秒"
-    elif minutes > 0:
-        return f"{minutes}分 {seconds}秒"
-    else:
-        return f"{seconds}秒"
+    response.call_on_close(record)
+    return response
+
+@app.teardown_request
+def clear_request_metrics(exc):
+    _current_request_metrics.set(None)
+
+def render_prometheus_metrics():
+    lines = []
+    for histogram in (request_duration_histogram, request_phase_histogram, response_size_histogram):
+        lines.extend(histogram.render())
+
+    report_cache_stats = {'report_summary': report_summary_cache.stats(), 'report_response': report_response_cache.stats()}
+    for key in ('hits', 'misses', 'evictions'):
+        lines.extend(_prometheus_metric(f'report_cache_{key}_total', 'counter', f'報告快取 {key} 次數',
+            [({'cache': name}, stats[key]) for name, stats in report_cache_stats.items()]))
+    lines.extend(_prometheus_metric('report_cache_entries', 'gauge', '報告快取項目數',
+        [({'cache': name}, stats['entries']) for name, stats in report_cache_stats.items()]))
+    lines.extend(_prometheus_metric('report_cache_bytes', 'gauge', '報告快取佔用位元組',
+        [({'cache': name}, stats['bytes']) for name, stats in report_cache_stats.items()]))
+    with _image_variant_lock:
+        variant_count = len(_image_variant_index) if _image_variant_index is not None else 0
+        variant_bytes = _image_variant_total_bytes
+    lines.extend(_prometheus_metric('image_variant_cache_entries', 'gauge', '縮圖磁碟快取檔案數', [({}, variant_count)]))
+    lines.extend(_prometheus_metric('image_variant_cache_bytes', 'gauge', '縮圖磁碟快取位元組', [({}, variant_bytes)]))
+    with _keyframe_manifests_lock:
+        manifest_count = len(_keyframe_manifests)
+    lines.extend(_prometheus_metric('keyframe_manifest_entries', 'gauge', '記憶體中的關鍵影格清單數', [({}, manifest_count)]))
+    with _contact_sheet_cache_lock:
+        contact_sheet_count = len(_contact_sheet_cache)
+        contact_sheet_bytes = _contact_sheet_cache_state["bytes"]
+    lines.extend(_prometheus_metric('contact_sheet_cache_entries', 'gauge', '記憶體中的關鍵影格拼貼圖數', [({}, contact_sheet_count)]))
+    lines.extend(_prometheus_metric('contact_sheet_cache_bytes', 'gauge', '關鍵影格拼貼圖快取位元組', [({}, contact_sheet_bytes)]))
+    with _class_summary_cache_lock:
+        class_summary_count = len(_class_summary_cache)
+    lines.extend(_prometheus_metric('class_summary_cache_entries', 'gauge', '班級彙總快取項目數', [({}, class_summary_count)]))
+    with _identity_cache_lock:
+        identity_count = len(_identity_cache)
+        identity_stats = dict(_identity_cache_stats)
+    lines.extend(_prometheus_metric('identity_cache_entries', 'gauge', '登入身分快取項目數', [({}, identity_count)]))
+    lines.extend(_prometheus_metric('identity_cache_hits_total', 'counter', 'load_user 命中快取的次數', [({}, identity_stats['hits'])]))
+    lines.extend(_prometheus_metric('identity_cache_misses_total', 'counter', 'load_user 查詢資料庫的次數', [({}, identity_stats['misses'])]))
+
+    buffer_stats = click_log_buffer.stats()
+    lines.extend(_prometheus_metric('click_log_queue_depth', 'gauge', '等待寫入資料庫的事件數', [({}, buffer_stats['queue_depth'])]))
+    lines.extend(_prometheus_metric('click_log_flushed_events_total', 'counter', '已寫入的事件數', [({}, buffer_stats['flushed_events'])]))
+    lines.extend(_prometheus_metric('click_log_failed_flushes_total', 'counter', '寫入失敗的批次數', [({}, buffer_stats['failed_flushes'])]))
+    lines.extend(_prometheus_metric('click_log_dropped_events_total', 'counter', '因寫入佇列已滿而丟棄的事件數', [({}, buffer_stats['dropped_events'])]))
+    lines.extend(_prometheus_metric('click_log_dead_lettered_events_total', 'counter', '重試失敗後寫入 dead-letter 檔案的事件數', [({}, buffer_stats['dead_lettered_events'])]))
+    lines.extend(_prometheus_metric('click_log_last_flush_seconds', 'gauge', '最近一次批次寫入耗時', [({}, buffer_stats['last_flush_seconds'])]))
+
+    dashboard_stats = dashboard_events.stats()
+    lines.extend(_prometheus_metric('dashboard_event_subscribers', 'gauge', '目前連線中的教師儀表板 SSE 訂閱數', [({}, dashboard_stats['subscribers'])]))
+    lines.extend(_prometheus_metric('dashboard_events_published_total', 'counter', '已發布的儀表板事件數', [({}, dashboard_stats['published_events'])]))
+
+    lines.extend(_prometheus_metric('filesystem_io_pending', 'gauge', '檔案系統執行緒池中尚未完成的工作數',
+        [({}, filesystem_io_in_flight())]))
+    lines.extend(_prometheus_metric('filesystem_io_active_requests', 'gauge', '持有儲存空間名額的請求數',
+        [({}, filesystem_io_active_requests())]))
+    packed_stats = packed_storage.stats()
+    lines.extend(_prometheus_metric('packed_storage_packs', 'gauge', '已載入的每日封裝檔數', [({}, packed_stats['packs'])]))
+    lines.extend(_prometheus_metric('packed_storage_files', 'gauge', '封裝檔中的檔案數', [({}, packed_stats['files'])]))
+    lines.extend(_prometheus_metric('packed_storage_reads_total', 'counter', '從封裝檔讀取檔案的次數', [({}, packed_stats['reads'])]))
+    lines.extend(_prometheus_metric('log_queue_depth', 'gauge', '等待輸出的日誌紀錄數', [({}, log_queue.qsize())]))
+    lines.extend(_prometheus_metric('log_dropped_total', 'counter', '因佇列已滿而丟棄的日誌紀錄數', [({}, log_queue_handler.dropped)]))
+    return "\n".join(lines) + "\n"
+
+@app.route('/api/admin/metrics')
+def api_admin_metrics():
+    """
+    Prometheus 文字格式的效能指標 (包含請求路徑、延遲與佇列深度，不對一般帳號開放)。
+    以 Authorization: Bearer <METRICS_TOKEN> 存取；METRICS_ALLOW_LOOPBACK 開啟時本機也可直接存取。
+    """
+    token = app.config.get('METRICS_TOKEN')
+    authorization = request.headers.get('Authorization', '')
+    token_ok = bool(token) and authorization.startswith('Bearer ') and hmac.compare_digest(authorization[7:], token)
+    loopback_ok = app.config['METRICS_ALLOW_LOOPBACK'] and request.remote_addr in ('127.0.0.1', '::1')
+    if not (token_ok or loopback_ok):
+        return jsonify({'error': '權限不足'}), 403
+    return Response(render_prometheus_metrics(), mimetype='text/plain; version=0.0.4')
 
 # --- Routes ---
 @app.route('/')
@@ -172,7 +3255,7 @@ def register_page():
         except Exception as e:
             db.session.rollback()
             flash(f'註冊過程中發生錯誤，請稍後再試。', 'error') # 避免直接暴露錯誤細節給前端
-            print(f"註冊錯誤: {e}")
+            logger.exception("註冊錯誤: %s", e)
             return redirect(url_for('register_page'))
     return render_template('register.html')
 
@@ -184,100 +3267,64 @@ def logout():
     return redirect(url_for('login_page'))
 
 @app.route('/student/report')
-@login_required
+@role_required('student', page=True)
 def student_report_page():
-    if current_user.role != 'student':
-        flash('權限不足，無法訪問此頁面。', 'warning')
-        return redirect(url_for('index'))
     return render_template('student_report.html')
 
 @app.route('/teacher/dashboard')
-@login_required
+@role_required('teacher', page=True)
 def teacher_dashboard_page():
-    if current_user.role != 'teacher':
-        flash('權限不足，無法訪問此頁面。', 'warning')
-        return redirect(url_for('index'))
-    return render_template('teacher_dashboard.html')
+    classes = SchoolClass.query.filter_by(teacher_id=current_user.id).order_by(SchoolClass.name).all()
+    return render_template('teacher_dashboard.html', classes=classes)
 
 # --- API Routes ---
 
 @app.route('/api/student/reports_list', methods=['GET'])
-@login_required
+@role_required('student')
 def api_get_student_reports_list():
-    # 權限檢查
-    if current_user.role != 'student':
-        return jsonify({'error': '權限不足'}), 403
-
     try:
         student_id = current_user.username
-        student_report_folder = os.path.join(app.config['BEHAVIOR_REPORT_FOLDER'], student_id)
-        
-        # 檢查學生報告資料夾是否存在
-        if not os.path.isdir(student_report_folder):
-            print(f"API Warning: 未找到學生 {student_id} 的報告文件夾: {student_report_folder}")
-            return jsonify([]), 200
+        ensure_report_catalog_fresh()
 
-        reports_info = []
-        file_pattern = os.path.join(student_report_folder, f"student_{student_id}_behavior_report_*.json")
-        matching_files = glob.glob(file_pattern)
+        # 直接從報告目錄讀取，無效 (無法解析) 的報告已在掃描時被標記並排除
+        catalog_entries = ReportCatalogEntry.query.filter(
+            ReportCatalogEntry.student_name == student_id,
+            ReportCatalogEntry.parse_error.is_(None)
+        ).all()
 
-        print(f"API Info: 正在為學生 '{student_id}' 查找報告，找到 {len(matching_files)} 個匹配文件。")
+        etag = compute_etag('reports_list', student_id, sorted((e.filename, e.file_size, e.file_mtime) for e in catalog_entries))
+        last_modified = None
+        if catalog_entries:
+            last_modified = datetime.datetime.fromtimestamp(max(e.file_mtime for e in catalog_entries), tz=datetime.timezone.utc)
+        not_modified = not_modified_response(etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        logger.debug("正在為學生 '%s' 查找報告，目錄中有 %d 份有效報告。", student_id, len(catalog_entries))
+
+        reports_info = []
+        for entry in catalog_entries:
+            report_dt = entry.report_datetime or datetime.datetime.fromtimestamp(entry.file_mtime)
+            reports_info.append({
+                "filename": entry.filename,
+                "display_name": f"報告 - {report_dt.strftime('%Y年%m月%d日')}",
+                "timestamp_sort_key": report_dt.timestamp() # 使用時間戳進行排序
+            })
 
-        for f_path in matching_files:
-            filename = os.path.basename(f_path)
-            try:
-                with open(f_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                
-                report_time_str = data.get('report_metadata', {}).get('report_generation_time', '')
-                
-                # 【關鍵修正】增加對多種日期格式的兼容處理
-                report_dt = None
-                # 嘗試解析最標準的格式
-                try:
-                    report_dt = datetime.datetime.strptime(report_time_str, '%Y-%m-%d %H:%M:%S')
-                except ValueError:
-                    # 如果失敗，嘗試解析 "M/D" 這種簡短格式
-                    try:
-                        # 假設年份為當前年份
-                        report_dt = datetime.datetime.strptime(f"{datetime.date.today().year}/{report_time_str}", '%Y/%m/%d')
-                    except ValueError:
-                        print(f"    -> 警告: 無法解析報告 '{filename}' 中的日期 '{report_time_str}'。將使用檔案修改時間作為備用。")
-                        # 如果所有格式都失敗，使用檔案的最後修改時間作為排序依據
-                        report_dt = datetime.datetime.fromtimestamp(os.path.getmtime(f_path))
-
-                # 使用解析出的日期時間來生成顯示名稱和排序鍵
-                report_display_name = f"報告 - {report_dt.strftime('%Y年%m月%d日')}"
-                
-                reports_info.append({
-                    "filename": filename,
-                    "display_name": report_display_name,
-                    "timestamp_sort_key": report_dt.timestamp() # 使用時間戳進行排序
-                })
-
-            except (json.JSONDecodeError, KeyError) as e:
-                print(f"    -> 警告：處理報告文件 {filename} 時出錯: {e}。已跳過此文件。")
-                continue # 跳過這個損壞的檔案
-            
         # 按時間戳降序排序，最新的報告在最前面
         if reports_info:
             reports_info.sort(key=lambda x: x["timestamp_sort_key"], reverse=True)
         
-        print(f"API Info: 成功處理 {len(reports_info)} 個報告，準備返回。")
-        return jsonify(reports_info), 200
+        logger.debug("成功處理 %d 個報告，準備返回。", len(reports_info))
+        return add_cache_validators(jsonify(reports_info), etag, last_modified), 200
 
     except Exception as e:
-        import traceback
-        print(f"!!!!!!!!!!!! API 致命錯誤 in /api/student/reports_list !!!!!!!!!!!!")
-        print(traceback.format_exc())
+        logger.exception("API 致命錯誤 in /api/student/reports_list: %s", e)
         return jsonify({'error': '伺服器獲取報告列表時發生內部錯誤。'}), 500
 
 @app.route('/api/student/report', methods=['GET'])
-@login_required
+@role_required('student')
 def api_get_student_behavior_report():
-    if current_user.role != 'student':
-        return jsonify({'error': '權限不足'}), 403
-
     student_id = current_user.username
     requested_report_filename = request.args.get('report_file')
 
@@ -291,34 +3338,340 @@ def api_get_student_behavior_report():
     student_report_folder = os.path.join(app.config['BEHAVIOR_REPORT_FOLDER'], student_id)
     report_file_to_load = os.path.join(student_report_folder, requested_report_filename)
     
-    print(f"API請求：/api/student/report by User: {student_id}, 請求文件: {requested_report_filename}")
+    logger.debug("API請求：/api/student/report by User: %s, 請求文件: %s", student_id, requested_report_filename)
 
-    if not os.path.isfile(report_file_to_load):
-        print(f"  錯誤：指定的報告文件不存在: {report_file_to_load}")
+    try:
+        etag, last_modified = run_filesystem_io(report_file_validators, report_file_to_load)
+        not_modified = not_modified_response(etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+        # 詳細序列分析改由 /api/student/report_batches 分批取得
+        encoded = run_filesystem_io(report_response_cache.load, report_file_to_load)
+        logger.debug("成功讀取報告摘要: %s", os.path.basename(report_file_to_load))
+        return add_cache_validators(encoded_json_response(encoded), etag, last_modified)
+    except FileNotFoundError:
+        logger.info("指定的報告文件不存在: %s", report_file_to_load)
         return jsonify({'error': f'指定的報告文件 {requested_report_filename} 未找到。'}), 404
+    except StorageBusyError as e:
+        return storage_busy_response(e)
+    except ValueError:
+        return jsonify({'error': f'報告文件 {os.path.basename(report_file_to_load)} 格式錯誤。'}), 500
+    except Exception as e:
+        logger.exception("讀取報告文件時發生錯誤: %s", e)
+        return jsonify({'error': '讀取報告時發生內部錯誤。'}), 500
 
+@app.route('/api/student/report_batches', methods=['GET'])
+@role_required('student')
+def api_get_student_report_batches():
+    """分批取得 detailed_sequence_analysis：?report_file=&offset=0&limit=10，回傳第 [offset, offset+limit) 個批次。"""
+    requested_report_filename = request.args.get('report_file')
+    if not requested_report_filename:
+        return jsonify({'error': '未指定要加載的報告文件。'}), 400
+    if ".." in requested_report_filename or "/" in requested_report_filename or "\\" in requested_report_filename:
+        return jsonify({'error': '無效的報告文件名。'}), 400
     try:
-        with open(report_file_to_load, 'r', encoding='utf-8') as f:
-            report_data = json.load(f)
-        print(f"  成功讀取並解析JSON文件: {os.path.basename(report_file_to_load)}")
-        return jsonify(report_data), 200
-    except json.JSONDecodeError:
-        return jsonify({'error': f'報告文件 {os.path.basename(report_file_to_load)} 格式錯誤。'}), 500
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = int(request.args.get('limit', app.config['REPORT_BATCH_PAGE_SIZE']))
+    except ValueError:
+        return jsonify({'error': 'offset 與 limit 必須是整數。'}), 400
+    limit = max(1, min(limit, app.config['REPORT_BATCH_MAX_PAGE_SIZE']))
+
+    report_file_to_load = os.path.join(app.config['BEHAVIOR_REPORT_FOLDER'], current_user.username, requested_report_filename)
+
+    try:
+        etag, last_modified = run_filesystem_io(report_file_validators, report_file_to_load, 'batches', offset, limit)
+        not_modified = not_modified_response(etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+        total, batches = run_filesystem_io(read_report_batch_page, report_file_to_load, offset, limit)
+    except FileNotFoundError:
+        return jsonify({'error': f'指定的報告文件 {requested_report_filename} 未找到。'}), 404
+    except StorageBusyError as e:
+        return storage_busy_response(e)
+    except ValueError:
+        # 讀取摘要後檔案又被改寫時，位元組範圍會對不上
+        return jsonify({'error': f'報告文件 {requested_report_filename} 格式錯誤或已變更，請重新載入。'}), 500
     except Exception as e:
-        print(f"讀取報告文件時發生錯誤: {e}")
+        logger.exception("讀取報告批次時發生錯誤: %s", e)
         return jsonify({'error': '讀取報告時發生內部錯誤。'}), 500
 
-@app.route('/api/teacher/class_summary', methods=['GET']) # 教師端模擬摘要
-@login_required
-def api_get_teacher_class_summary():
-    if current_user.role != 'teacher':
-        return jsonify({'error': '權限不足'}), 403
-    mock_class_summary = {
-        "class_id": "C101", "report_date": datetime.date.today().strftime("%Y-%m-%d"),
-        "behavior_summary": [{"behavior_category": "書寫/做筆記", "percentage": 60.5, "trend": "上升"}],
-        "students_needing_attention": [{"student_id": "s1001", "student_name": "王小明", "reason": "專注度低"}]
+    next_offset = offset + len(batches)
+    return add_cache_validators(jsonify({
+        "report_file": requested_report_filename,
+        "offset": offset,
+        "total": total,
+        "batches": batches,
+        "next_offset": next_offset if next_offset < total else None,
+    }), etag, last_modified), 200
+
+# --- Class Aggregates (班級彙總) ---
+NON_TASK_HISTOGRAM_BINS = np.arange(0, 101, 10) # 非任務行為佔比分佈的區間 (0-10%, 10-20%, ...)
+
+_class_summary_cache = OrderedDict() # (class_id, date, threshold) -> (報告簽章, 計算結果)
+_class_summary_cache_lock = threading.Lock()
+
+def compute_class_aggregates(student_rows, threshold):
+    """
+    student_rows: [(student_id, student_name, behavior_statistics), ...]
+    以 NumPy 建立「學生 × 行為」的佔比矩陣，計算每個行為的平均、中位數與 P90，
+    以及非任務行為佔比的分佈與超過門檻的學生。
+    """
+    categories = sorted({
+        item.get("behavior_category")
+        for _, _, stats in student_rows for item in stats
+        if item.get("behavior_category")
+    })
+    category_index = {category: i for i, category in enumerate(categories)}
+    shares = np.zeros((len(student_rows), len(categories)), dtype=np.float64)
+    reported = np.zeros_like(shares, dtype=bool)
+    for row, (_, _, stats) in enumerate(student_rows):
+        for item in stats:
+            column = category_index.get(item.get("behavior_category"))
+            if column is not None:
+                shares[row, column] += float(item.get("percentage") or 0)
+                reported[row, column] = True
+
+    behavior_summary = []
+    if len(student_rows) and len(categories):
+        means = shares.mean(axis=0)
+        medians = np.median(shares, axis=0)
+        p90s = np.percentile(shares, 90, axis=0)
+        reporting_counts = reported.sum(axis=0)
+        for i in np.argsort(-means, kind='stable'):
+            behavior_summary.append({
+                "behavior_category": categories[i],
+                "percentage": round(float(means[i]), 1), # 與舊版欄位相容：班級平均佔比
+                "mean_percentage": round(float(means[i]), 1),
+                "median_percentage": round(float(medians[i]), 1),
+                "p90_percentage": round(float(p90s[i]), 1),
+                "students_reporting": int(reporting_counts[i]),
+            })
+
+    non_task_columns = [category_index[c] for c in categories if c in NON_TASK_BEHAVIORS]
+    non_task = shares[:, non_task_columns].sum(axis=1) if non_task_columns else np.zeros(len(student_rows))
+    if len(student_rows):
+        histogram, _ = np.histogram(np.clip(non_task, 0, 100), bins=NON_TASK_HISTOGRAM_BINS)
+        non_task_distribution = {
+            "mean": round(float(non_task.mean()), 1),
+            "median": round(float(np.median(non_task)), 1),
+            "p90": round(float(np.percentile(non_task, 90)), 1),
+            "min": round(float(non_task.min()), 1),
+            "max": round(float(non_task.max()), 1),
+            "histogram": [
+                {"range": f"{int(low)}-{int(high)}%", "students": int(count)}
+                for low, high, count in zip(NON_TASK_HISTOGRAM_BINS[:-1], NON_TASK_HISTOGRAM_BINS[1:], histogram)
+            ],
+        }
+    else:
+        non_task_distribution = {"mean": 0, "median": 0, "p90": 0, "min": 0, "max": 0, "histogram": []}
+
+    students_needing_attention = []
+    for row in np.argsort(-non_task, kind='stable'):
+        if non_task[row] <= threshold:
+            break
+        student_id, student_name, _ = student_rows[row]
+        students_needing_attention.append({
+            "student_id": student_id,
+            "student_name": student_name,
+            "non_task_percent": round(float(non_task[row]), 1),
+            "reason": f"非任務行為佔比 {non_task[row]:.1f}% 超過 {threshold:g}%",
+        })
+
+    return {
+        "student_count": len(student_rows),
+        "behavior_summary": behavior_summary,
+        "non_task_distribution": non_task_distribution,
+        "students_needing_attention": students_needing_attention,
     }
-    return jsonify(mock_class_summary), 200
+
+def load_behavior_statistics(report_targets):
+    """report_targets: [(student_name, report_path), ...]，回傳 {student_name: behavior_statistics}，讀取失敗的學生會被略過。"""
+    behavior_stats_by_student = {}
+    for student_name, report_path in report_targets:
+        try:
+            behavior_stats_by_student[student_name] = load_report_summary(report_path)["overall_summary"].get("behavior_statistics", [])
+        except (OSError, ValueError) as e:
+            logger.warning("讀取學生 %s 的報告 %s 時出錯: %s", student_name, os.path.basename(report_path), e)
+    return behavior_stats_by_student
+
+def get_class_summary(scope, students, report_date, threshold):
+    """取得班級在指定日期的彙總結果；只要班級名單或參與計算的任一報告 (大小/修改時間) 有變動，快取就會失效重算。"""
+    entries = find_report_entries_for_students([s.username for s in students], report_date)
+    signature = (tuple(s.id for s in students), tuple(sorted(
+        (entry.student_name, entry.filename, entry.file_size, entry.file_mtime) for entry in entries.values()
+    )))
+    cache_key = (scope.cache_key, report_date, threshold)
+    with _class_summary_cache_lock:
+        cached = _class_summary_cache.get(cache_key)
+        if cached is not None and cached[0] == signature:
+            _class_summary_cache.move_to_end(cache_key)
+            return cached[1]
+
+    behavior_stats_by_student = run_filesystem_io(load_behavior_statistics, [
+        (student.username, entries[student.username].file_path) for student in students if student.username in entries
+    ])
+    student_rows = [
+        (student.id, student.username, behavior_stats_by_student[student.username])
+        for student in students if student.username in behavior_stats_by_student
+    ]
+
+    result = compute_class_aggregates(student_rows, threshold)
+    result.update({"class_id": scope.class_id, "report_date": report_date, "threshold": threshold})
+    with _class_summary_cache_lock:
+        _class_summary_cache[cache_key] = (signature, result)
+        _class_summary_cache.move_to_end(cache_key)
+        while len(_class_summary_cache) > app.config['CLASS_SUMMARY_CACHE_SIZE']:
+            _class_summary_cache.popitem(last=False)
+    return result
+
+@app.route('/api/teacher/class_summary', methods=['GET'])
+@role_required('teacher')
+def api_get_teacher_class_summary():
+    """班級彙總：?date=YYYY-MM-DD (預設為最新的報告日期)，&threshold= 非任務行為佔比門檻 (%)，&class_id= (預設為教師的所有班級)。"""
+    report_date = request.args.get('date')
+    if report_date:
+        try:
+            datetime.date.fromisoformat(report_date)
+        except ValueError:
+            return jsonify({"error": "日期格式錯誤，應為 YYYY-MM-DD。"}), 400
+    try:
+        threshold = float(request.args.get('threshold', app.config['NON_TASK_ATTENTION_THRESHOLD']))
+    except ValueError:
+        return jsonify({"error": "threshold 格式錯誤。"}), 400
+
+    try:
+        scope = current_class_scope()
+    except ClassNotFoundError:
+        return class_not_found_response()
+
+    try:
+        ensure_report_catalog_fresh()
+        if not report_date:
+            available_dates = get_all_available_dates(scope)
+            if not available_dates:
+                return jsonify({"error": "系統中尚無任何報告。"}), 404
+            report_date = available_dates[0]
+        students = User.query.filter(*scope.student_filters()).order_by(User.id).all()
+        return jsonify(get_class_summary(scope, students, report_date, threshold)), 200
+    except StorageBusyError as e:
+        return storage_busy_response(e)
+    except Exception as e:
+        logger.exception("API ERROR in /api/teacher/class_summary: %s", e)
+        return jsonify({"error": "伺服器在計算班級彙總時發生內部錯誤。"}), 500
+
+def parse_trend_request_args():
+    """解析趨勢 API 共用的參數，回傳 (參數字典, 錯誤回應)。"""
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in ('day', 'week'):
+        return None, (jsonify({"error": "granularity 只能是 day 或 week。"}), 400)
+    try:
+        weeks = int(request.args.get('weeks', app.config['TREND_DEFAULT_WEEKS']))
+    except ValueError:
+        return None, (jsonify({"error": "weeks 格式錯誤。"}), 400)
+    weeks = max(1, min(weeks, app.config['TREND_MAX_WEEKS']))
+    end_date = request.args.get('end')
+    if end_date:
+        try:
+            datetime.date.fromisoformat(end_date)
+        except ValueError:
+            return None, (jsonify({"error": "日期格式錯誤，應為 YYYY-MM-DD。"}), 400)
+    else:
+        # 未指定時以最新的報告日期為終點，而非今天，避免假期後查不到資料
+        end_date = db.session.query(db.func.max(BehaviorSeriesPoint.report_date)).scalar() or datetime.date.today().isoformat()
+    start_date = (datetime.date.fromisoformat(end_date) - datetime.timedelta(days=weeks * 7 - 1)).isoformat()
+    behaviors = [b.strip() for b in request.args.get('behaviors', '').split(',') if b.strip()]
+    return {
+        "granularity": granularity, "weeks": weeks, "start_date": start_date, "end_date": end_date, "behaviors": behaviors,
+    }, None
+
+def query_behavior_series(student_names, trend_args):
+    query = db.session.query(
+        BehaviorSeriesPoint.student_name, BehaviorSeriesPoint.report_date,
+        BehaviorSeriesPoint.behavior_category, BehaviorSeriesPoint.percentage
+    ).filter(
+        BehaviorSeriesPoint.student_name.in_(student_names),
+        BehaviorSeriesPoint.report_date.between(trend_args["start_date"], trend_args["end_date"])
+    )
+    return [tuple(row) for row in query.all()]
+
+def _select_trend_categories(categories, requested_behaviors):
+    """回傳要輸出的 [(行為, 欄位索引或 None)]；指定了 behaviors 時依指定順序，未出現過的行為佔比視為 0。"""
+    category_index = {c: i for i, c in enumerate(categories)}
+    names = requested_behaviors or categories
+    return [(name, category_index.get(name)) for name in names]
+
+@app.route('/api/teacher/student_trend', methods=['GET'])
+@role_required('teacher')
+def api_get_student_trend():
+    """單一學生的行為趨勢：?student_id=&weeks=8&granularity=day|week&behaviors=趴睡,目視他處&end=YYYY-MM-DD"""
+    try:
+        scope = current_class_scope()
+    except ClassNotFoundError:
+        return class_not_found_response()
+    student = db.session.get(User, request.args.get('student_id', type=int) or 0)
+    if student is None or not scope.contains(student.id):
+        return jsonify({"error": "找不到指定的學生。"}), 404
+    ensure_report_catalog_fresh()
+    ensure_behavior_series()
+    trend_args, error_response = parse_trend_request_args()
+    if error_response:
+        return error_response
+
+    periods, _, categories, values = build_behavior_series_matrix(
+        query_behavior_series([student.username], trend_args), trend_args["granularity"]
+    )
+    behaviors = {}
+    for name, column in _select_trend_categories(categories, trend_args["behaviors"]):
+        # 每個期間都至少有這位學生的一份報告，報告中未出現的行為佔比為 0
+        behaviors[name] = _rounded_series(values[:, 0, column]) if column is not None else [0.0] * len(periods)
+    return jsonify({
+        "student_id": student.id,
+        "student_name": student.username,
+        "granularity": trend_args["granularity"],
+        "start_date": trend_args["start_date"],
+        "end_date": trend_args["end_date"],
+        "periods": periods,
+        "behaviors": behaviors,
+    }), 200
+
+@app.route('/api/teacher/class_trend', methods=['GET'])
+@role_required('teacher')
+def api_get_class_trend():
+    """全班的行為趨勢：每個期間各行為佔比的平均與中位數 (只計入該期間有報告的學生)。參數同 student_trend，另可指定 class_id。"""
+    try:
+        scope = current_class_scope()
+    except ClassNotFoundError:
+        return class_not_found_response()
+    ensure_report_catalog_fresh()
+    ensure_behavior_series()
+    trend_args, error_response = parse_trend_request_args()
+    if error_response:
+        return error_response
+
+    student_names = db.session.execute(scope.student_names_select()).scalars().all()
+    periods, _, categories, values = build_behavior_series_matrix(
+        query_behavior_series(student_names, trend_args), trend_args["granularity"]
+    )
+    reported = ~np.isnan(values[:, :, 0]) if categories else np.zeros(values.shape[:2], dtype=bool)
+    behaviors = {}
+    for name, column in _select_trend_categories(categories, trend_args["behaviors"]):
+        if column is None:
+            behaviors[name] = {"mean": [0.0] * len(periods), "median": [0.0] * len(periods)}
+            continue
+        with np.errstate(invalid='ignore'):
+            behaviors[name] = {
+                "mean": _rounded_series(np.nanmean(values[:, :, column], axis=1)) if periods else [],
+                "median": _rounded_series(np.nanmedian(values[:, :, column], axis=1)) if periods else [],
+            }
+    return jsonify({
+        "class_id": scope.class_id,
+        "granularity": trend_args["granularity"],
+        "start_date": trend_args["start_date"],
+        "end_date": trend_args["end_date"],
+        "periods": periods,
+        "student_counts": [int(n) for n in reported.sum(axis=1)],
+        "behaviors": behaviors,
+    }), 200
 
 @app.route('/api/log_click', methods=['POST'])
 @login_required
@@ -326,10 +3679,8 @@ def api_log_click_event():
     data = request.get_json()
     element_clicked = data.get('element')
     if element_clicked:
-        # 使用正確的欄位名稱 element_or_page_id
-        new_click = ClickLog(user_id=current_user.id, element_or_page_id=element_clicked) 
-        db.session.add(new_click)
-        db.session.commit()
+        # 使用正確的欄位名稱 element_or_page_id，交由緩衝區批次寫入
+        click_log_buffer.add([build_click_log_row(current_user.id, 'click', element_clicked)])
         return jsonify({'success': True, 'message': '點擊已記錄'}), 200
     return jsonify({'success': False, 'message': '缺少點擊元素信息'}), 400
 
@@ -341,18 +3692,18 @@ def create_initial_users():
             student_user = User(username='a123', role='student')
             student_user.set_password('a123')
             db.session.add(student_user)
-            print(f"學生用戶 {student_user.username} 已創建。")
+            logger.info("學生用戶 %s 已創建。", student_user.username)
         if not User.query.filter_by(username='b123').first():
             teacher_user = User(username='b123', role='teacher')
             teacher_user.set_password('b123')
             db.session.add(teacher_user)
-            print(f"教師用戶 {teacher_user.username} 已創建。")
+            logger.info("教師用戶 %s 已創建。", teacher_user.username)
         try:
             db.session.commit()
-            print("初始用戶提交完成 (如果之前不存在)。")
+            logger.info("初始用戶提交完成 (如果之前不存在)。")
         except Exception as e:
             db.session.rollback()
-            print(f"提交初始用戶時發生錯誤: {e}")
+            logger.error("提交初始用戶時發生錯誤: %s", e)
 
 
 @app.route('/api/get_sequence_image')
@@ -365,96 +3716,209 @@ def api_get_sequence_image():
     # === 步驟 1: 獲取並驗證前端傳來的參數 ===
     report_filename = request.args.get('report_file')
     image_filename = request.args.get('image_file')
+    size_name = request.args.get('size', 'original')
+    requested_version = request.args.get('v') # 由 /api/sequence_image_manifest 提供的版本；帶正確版本的 URL 可長期快取
 
-    # 打印收到的請求，方便除錯
-    print(f"\n--- [API /api/get_sequence_image] ---")
-    print(f"收到圖片請求: report_file='{report_filename}', image_file='{image_filename}'")
+    logger.debug("收到圖片請求: report_file='%s', image_file='%s'", report_filename, image_filename)
 
     if not report_filename or not image_filename:
-        print("  -> 錯誤: 缺少必要參數。")
+        logger.info("圖片請求缺少必要參數。")
         return jsonify({'error': '缺少報告或圖片文件名'}), 400
 
     # 安全檢查，防止惡意用戶嘗試訪問伺服器上的其他檔案
     if ".." in report_filename or "/" in report_filename or "\\" in report_filename:
-        print(f"  -> 安全錯誤: 偵測到無效的報告檔名 '{report_filename}'")
+        logger.warning("安全錯誤: 偵測到無效的報告檔名 '%s'", report_filename)
         return jsonify({'error': '無效的報告文件名'}), 400
     if ".." in image_filename or "/" in image_filename or "\\" in image_filename:
-        print(f"  -> 安全錯誤: 偵測到無效的圖片檔名 '{image_filename}'")
+        logger.warning("安全錯誤: 偵測到無效的圖片檔名 '%s'", image_filename)
         return jsonify({'error': '無效的圖片文件名'}), 400
+    if size_name != 'original' and size_name not in app.config['IMAGE_VARIANT_SIZES']:
+        return jsonify({'error': f'不支援的圖片尺寸 {size_name}'}), 400
 
     try:
-        # === 步驟 2: 讀取報告 JSON 以獲取元數據 ===
+        # === 步驟 2: 取得報告的關鍵影格清單 ===
         # 根據報告檔名中的學生姓名來確定資料夾，而不是 current_user.username
         # 這讓教師未來也有可能透過此API查看學生圖片
         match = re.search(r'student_([^_]+)_behavior_report', report_filename)
         if not match:
-            print(f"  -> 錯誤: 無法從報告檔名 '{report_filename}' 中解析出學生姓名。")
+            logger.info("無法從報告檔名 '%s' 中解析出學生姓名。", report_filename)
             return jsonify({'error': '無法解析報告檔名中的學生姓名'}), 400
         
         student_name_from_report = match.group(1)
-        
-        # 組合報告 JSON 的完整路徑
-        report_json_path = os.path.join(app.config['BEHAVIOR_REPORT_FOLDER'], student_name_from_report, report_filename)
-        print(f"  正在嘗試讀取報告JSON: {report_json_path}")
 
-        if not os.path.isfile(report_json_path):
-            print(f"  -> 錯誤: 報告JSON檔案未找到。")
+        manifest = run_filesystem_io(get_keyframe_manifest, student_name_from_report, report_filename)
+        if manifest is None:
+            logger.info("報告JSON檔案未找到: %s", report_filename)
             return jsonify({'error': '報告JSON文件未找到'}), 404
-        
-        with open(report_json_path, 'r', encoding='utf-8') as f:
-            report_data = json.load(f)
-        
-        metadata = report_data.get('report_metadata', {})
-        student_number = metadata.get('student_number')
-        report_time_str = metadata.get('report_generation_time')
-
-        if not student_number or not report_time_str:
-            print(f"  -> 錯誤: 報告 '{report_filename}' 中缺少 'student_number' 或 'report_generation_time'。")
+        if not manifest["folder"]:
+            logger.info("報告 '%s' 中缺少 'student_number' 或 'report_generation_time'。", report_filename)
             return jsonify({'error': '報告中缺少學生座號或生成時間'}), 404
-        
-        print(f"  成功讀取元數據: student_number='{student_number}', report_time='{report_time_str}'")
-
-        # === 步驟 3: 根據規則，動態建構圖片的完整路徑 ===
-        
-        # 1. 處理時間: 將 "6/11" 或 "2024-06-11 10:30:00" 格式化為 "0611"
-        report_time_folder = "".join(filter(str.isdigit, report_time_str))
-        # 如果是 YYYYMMDD 格式，取中間四位
-        if len(report_time_folder) == 8:
-             report_time_folder = report_time_folder[4:]
-        report_time_folder = report_time_folder.zfill(4)
-        
-        # 2. 處理座號: 將 "1" 轉換為 "ID_1"
-        id_folder = f"ID_{student_number}"
-        
-        # 3. 使用 os.path.join 安全地組合出最終的圖片路徑
-        final_image_path = os.path.join(
-            app.config['STUDENT_WEEK_PHOTO_FOLDER'], # 根目錄
-            report_time_folder,                     # 日期資料夾，例如 "0611"
-            id_folder,                              # 學生ID資料夾，例如 "ID_2"
-            "Keyframes",                            # 固定的子資料夾
-            image_filename                          # 圖片檔名
-        )
 
-        print(f"  -> 準備提供的圖片路徑: {final_image_path}")
+        # === 步驟 3: 從清單中查出圖片路徑並回傳 ===
+        final_image_path, exists = run_filesystem_io(resolve_keyframe_image, manifest, image_filename)
+        logger.debug("準備提供的圖片路徑: %s", final_image_path)
 
-        # === 步驟 4: 檢查圖片是否存在並回傳 ===
-        if os.path.isfile(final_image_path):
-            print(f"  -> 成功找到圖片，正在回傳...")
-            return send_file(final_image_path)
+        if exists:
+            version = run_filesystem_io(keyframe_file_version, final_image_path)
+            if requested_version and requested_version != version:
+                # 影像已被替換：導向新版本的 URL，避免舊 URL 的長期快取內容與實際檔案不一致
+                return redirect(keyframe_image_url(report_filename, image_filename, version, size_name, request.args.get('format')))
+            immutable = requested_version == version
+            if size_name == 'original':
+                return send_keyframe_file(final_image_path, None, version, immutable)
+            # 縮圖：由工作執行緒池產生一次後存入磁碟快取
+            variant_format = choose_image_variant_format(request.args.get('format'), request.headers.get('Accept'))
+            variant_path, mimetype = run_filesystem_io(get_image_variant, final_image_path, size_name, variant_format)
+            response = send_keyframe_file(variant_path, mimetype, f"{version}-{size_name}-{variant_format}", immutable)
+            response.vary.add('Accept')
+            return response
         else:
-            print(f"  -> 錯誤: 圖片檔案未找到。")
+            logger.info("圖片檔案未找到: %s", final_image_path)
             return jsonify({'error': f'圖片 {image_filename} 未在伺服器上找到'}), 404
 
+    except StorageBusyError as e:
+        return storage_busy_response(e)
     except json.JSONDecodeError:
-        print(f"  -> 嚴重錯誤: 報告檔案 {report_filename} 不是有效的JSON。")
+        logger.error("報告檔案 %s 不是有效的JSON。", report_filename)
         return jsonify({'error': '報告檔案格式錯誤'}), 500
     except Exception as e:
-        import traceback
-        print(f"  -> 伺服器內部錯誤: 在獲取圖片 {image_filename} 時發生問題: {e}")
-        traceback.print_exc() # 打印完整的錯誤堆疊
+        logger.exception("伺服器內部錯誤: 在獲取圖片 %s 時發生問題: %s", image_filename, e)
         return jsonify({'error': '伺服器內部錯誤'}), 500
 
 
+@app.route('/api/sequence_image_manifest')
+@login_required
+def api_get_sequence_image_manifest():
+    """
+    一次解析整批圖片：回傳報告中 (或 image_file 參數指定的) 每張圖片是否存在以及對應的圖片 URL，
+    讓前端不必逐張嘗試請求。
+    """
+    report_filename = request.args.get('report_file')
+    requested_images = request.args.getlist('image_file')
+
+    if not report_filename:
+        return jsonify({'error': '缺少報告文件名'}), 400
+    if ".." in report_filename or "/" in report_filename or "\\" in report_filename:
+        return jsonify({'error': '無效的報告文件名'}), 400
+    for image_filename in requested_images:
+        if ".." in image_filename or "/" in image_filename or "\\" in image_filename:
+            return jsonify({'error': '無效的圖片文件名'}), 400
+
+    match = re.search(r'student_([^_]+)_behavior_report', report_filename)
+    if not match:
+        return jsonify({'error': '無法解析報告檔名中的學生姓名'}), 400
+    student_name = match.group(1)
+    if current_user.role == 'student' and student_name != current_user.username:
+        return jsonify({'error': '權限不足'}), 403
+
+    try:
+        manifest = run_filesystem_io(get_keyframe_manifest, student_name, report_filename)
+    except StorageBusyError as e:
+        return storage_busy_response(e)
+    except json.JSONDecodeError:
+        return jsonify({'error': '報告檔案格式錯誤'}), 500
+    if manifest is None:
+        return jsonify({'error': '報告JSON文件未找到'}), 404
+    if not manifest["folder"]:
+        return jsonify({'error': '報告中缺少學生座號或生成時間'}), 404
+
+    try:
+        versions = run_filesystem_io(resolve_keyframe_versions, manifest, requested_images or list(manifest["images"].keys()))
+    except StorageBusyError as e:
+        return storage_busy_response(e)
+
+    # url / thumb_url 帶有影像版本，可被瀏覽器長期快取；影像被替換時版本 (以及 URL) 會跟著改變
+    etag = compute_etag('sequence_image_manifest', report_filename, versions)
+    not_modified = not_modified_response(etag)
+    if not_modified is not None:
+        return not_modified
+    images = {}
+    for image_filename, version in versions.items():
+        images[image_filename] = {
+            "exists": version is not None,
+            "version": version,
+            "url": keyframe_image_url(report_filename, image_filename, version) if version else None,
+            "thumb_url": keyframe_image_url(report_filename, image_filename, version, 'thumb') if version else None,
+        }
+    return add_cache_validators(jsonify({"report_file": report_filename, "images": images}), etag), 200
+
+
+@app.route('/api/keyframe_contact_sheet')
+@login_required
+def api_get_keyframe_contact_sheet():
+    """
+    一次取得多張關鍵影格的拼貼圖：?report_file=&behavior=<行為類別> (使用報告 behavior_to_images_index 中的影像)，
+    或以 image_file= (可重複) 明確指定影像。回傳 JSON：sheet 為 base64 編碼的拼貼圖，
+    tiles 記錄每張影像在圖中的位置與帶版本的原圖 URL，missing 為找不到或無法讀取的影像。
+    """
+    report_filename = request.args.get('report_file')
+    behavior = request.args.get('behavior')
+    requested_images = request.args.getlist('image_file')
+
+    if not report_filename or not (behavior or requested_images):
+        return jsonify({'error': '缺少報告文件名，或行為類別/圖片文件名'}), 400
+    if ".." in report_filename or "/" in report_filename or "\\" in report_filename:
+        return jsonify({'error': '無效的報告文件名'}), 400
+    for image_filename in requested_images:
+        if ".." in image_filename or "/" in image_filename or "\\" in image_filename:
+            return jsonify({'error': '無效的圖片文件名'}), 400
+    match = re.search(r'student_([^_]+)_behavior_report', report_filename)
+    if not match:
+        return jsonify({'error': '無法解析報告檔名中的學生姓名'}), 400
+    student_name = match.group(1)
+    if current_user.role == 'student' and student_name != current_user.username:
+        return jsonify({'error': '權限不足'}), 403
+
+    try:
+        manifest = run_filesystem_io(get_keyframe_manifest, student_name, report_filename)
+        if manifest is None:
+            return jsonify({'error': '報告JSON文件未找到'}), 404
+        if not manifest["folder"]:
+            return jsonify({'error': '報告中缺少學生座號或生成時間'}), 404
+
+        image_filenames = requested_images
+        if not image_filenames:
+            report_path = os.path.join(app.config['BEHAVIOR_REPORT_FOLDER'], student_name, report_filename)
+            report_summary = run_filesystem_io(load_report_summary, report_path)
+            behavior_index = (report_summary.get('overall_summary') or {}).get('behavior_to_images_index') or {}
+            image_filenames = behavior_index.get(behavior) or []
+        image_filenames = list(dict.fromkeys(image_filenames)) # 去除重複並保留順序
+        max_images = app.config['CONTACT_SHEET_MAX_IMAGES']
+        truncated = len(image_filenames) > max_images
+        image_filenames = image_filenames[:max_images]
+
+        variant_format = choose_image_variant_format(request.args.get('format'), request.headers.get('Accept'))
+        cache_key, versions = run_filesystem_io(contact_sheet_key, manifest, image_filenames, variant_format)
+        not_modified = not_modified_response(cache_key)
+        if not_modified is not None:
+            not_modified.vary.add('Accept')
+            return not_modified
+        sheet = run_filesystem_io(get_contact_sheet, manifest, versions, cache_key, variant_format)
+    except FileNotFoundError:
+        return jsonify({'error': '報告JSON文件未找到'}), 404
+    except StorageBusyError as e:
+        return storage_busy_response(e)
+    except (json.JSONDecodeError, ValueError):
+        return jsonify({'error': '報告檔案格式錯誤'}), 500
+
+    response = jsonify({
+        "report_file": report_filename,
+        "behavior": behavior,
+        "truncated": truncated,
+        "width": sheet["width"],
+        "height": sheet["height"],
+        "tile_size": sheet["tile_size"],
+        "columns": sheet["columns"],
+        "sheet": {"mimetype": sheet["mimetype"], "data": base64.b64encode(sheet["image"]).decode('ascii')},
+        "tiles": [
+            dict(tile, url=keyframe_image_url(report_filename, tile["image_file"], tile["version"])) for tile in sheet["tiles"]
+        ],
+        "missing": sheet["missing"],
+    })
+    response.vary.add('Accept')
+    return add_cache_validators(response, cache_key)
+
+
 # app.py
 
 @app.route('/api/log_page_event', methods=['POST'])
@@ -463,47 +3927,28 @@ def api_log_page_event():
     try:
         data = request.get_json()
         if not data:
-            print("API Error: /api/log_page_event - Request body is not valid JSON or is empty.")
+            logger.info("/api/log_page_event - Request body is not valid JSON or is empty.")
             return jsonify({'success': False, 'message': '無效的請求數據'}), 400
 
         event_type = data.get('event_type')
         element_or_page_id = data.get('element_or_page_id')
         duration_seconds_raw = data.get('duration_seconds') # 先獲取原始值
 
-        print(f"DEBUG: /api/log_page_event - Received data: {data}") # 打印接收到的數據
+        logger.debug("/api/log_page_event - Received data: %s", data)
 
         if not event_type or not element_or_page_id:
-            print("API Error: /api/log_page_event - Missing event_type or element_or_page_id.")
+            logger.info("/api/log_page_event - Missing event_type or element_or_page_id.")
             return jsonify({'success': False, 'message': '缺少事件類型或目標ID'}), 400
 
-        # 處理 duration_seconds
-        duration_to_save = None
-        if duration_seconds_raw is not None:
-            try:
-                duration_to_save = int(float(duration_seconds_raw)) # 先轉float再轉int，處理可能的小數
-            except (ValueError, TypeError):
-                print(f"API Warning: /api/log_page_event - Invalid duration_seconds value: {duration_seconds_raw}. Storing as NULL.")
-                # 可以選擇報錯，或者將其存為NULL
-
-        new_log = ClickLog(
-            user_id=current_user.id,
-            event_type=str(event_type),
-            element_or_page_id=str(element_or_page_id),
-            duration_seconds=duration_to_save
-        )
-        db.session.add(new_log)
-        db.session.commit()
-        print(f"DB Log: Event '{event_type}' for page '{element_or_page_id}' (duration: {duration_to_save}) by user {current_user.id} logged.")
+        # 處理 duration_seconds (無效值存為NULL)，並交由緩衝區批次寫入
+        new_log_row = build_click_log_row(current_user.id, event_type, element_or_page_id, duration_seconds_raw)
+        click_log_buffer.add([new_log_row])
+        logger.debug("Event '%s' for page '%s' (duration: %s) by user %s queued.", event_type, element_or_page_id, new_log_row['duration_seconds'], current_user.id)
         return jsonify({'success': True, 'message': f'事件 {event_type} 已記錄'}), 200
     
     except Exception as e:
-        db.session.rollback()
-        # 在伺服器端打印詳細錯誤
-        print(f"!!!!!!!!!!!! API ERROR in /api/log_page_event !!!!!!!!!!!!")
-        import traceback
-        print(traceback.format_exc()) # 打印完整的錯誤追蹤
-        print(f"Error details: {str(e)}")
-        print(f"Request data that caused error: {request.data}") # 打印原始請求體
+        # 在伺服器端記錄詳細錯誤與原始請求體
+        logger.exception("API ERROR in /api/log_page_event: %s (request data: %r)", e, request.data)
         return jsonify({'success': False, 'message': '記錄事件時發生內部錯誤，請查看伺服器日誌。'}), 500
 
 # (可選) 為 navigator.sendBeacon 創建一個單獨的端點
@@ -528,247 +3973,481 @@ def api_log_page_event_beacon():
         duration_seconds = data.get('duration_seconds')
 
         if not user_id_from_payload or not event_type or not element_or_page_id:
-            print(f"Beacon log 缺少必要數據: {data}")
+            logger.info("Beacon log 缺少必要數據: %s", data)
             return '', 204 # 即使失敗，beacon 通常也不處理響應體
 
         # 驗證 user_id (可選，但推薦)
         user = User.query.get(int(user_id_from_payload))
         if not user:
-            print(f"Beacon log 中的 user_id 無效: {user_id_from_payload}")
+            logger.info("Beacon log 中的 user_id 無效: %s", user_id_from_payload)
             return '', 204
 
-        new_log = ClickLog(
-            user_id=user.id,
-            event_type=str(event_type),
-            element_or_page_id=str(element_or_page_id),
-            duration_seconds=int(duration_seconds) if duration_seconds is not None else None
-        )
-        db.session.add(new_log)
-        db.session.commit()
-        print(f"Beacon 事件已記錄: {event_type} for user {user.id}")
+        click_log_buffer.add([build_click_log_row(user.id, event_type, element_or_page_id, duration_seconds)])
+        logger.debug("Beacon 事件已記錄: %s for user %s", event_type, user.id)
     except Exception as e:
-        print(f"處理 Beacon 日誌錯誤: {e}")
+        logger.exception("處理 Beacon 日誌錯誤: %s", e)
         # Beacon 請求通常不關心響應體，即使出錯也返回成功或無內容
     return '', 204 # No Content, 表示請求已處理
 
 
+@app.route('/api/log_events', methods=['POST'])
+@login_required
+def api_log_events():
+    """
+    批次記錄事件。請求體可以是事件陣列，或 {"events": [...]}；
+    每個事件包含 event_type、element_or_page_id 與可選的 duration_seconds、age_ms (事件發生到送出經過的毫秒數)。
+    也可由 navigator.sendBeacon 呼叫 (同源請求會帶上登入 cookie)。
+    """
+    data = request.get_json(force=True, silent=True)
+    events = data.get('events') if isinstance(data, dict) else data
+    if not isinstance(events, list) or not events:
+        return jsonify({'success': False, 'message': '無效的請求數據'}), 400
+    if len(events) > app.config['CLICK_LOG_MAX_EVENTS_PER_REQUEST']:
+        return jsonify({'success': False, 'message': '單次送出的事件數量過多'}), 413
+
+    received_at = datetime.datetime.utcnow()
+    rows = []
+    rejected = []
+    for index, event in enumerate(events):
+        if not isinstance(event, dict) or not event.get('event_type') or not event.get('element_or_page_id'):
+            rejected.append(index)
+            continue
+        rows.append(build_click_log_row(current_user.id, event['event_type'], event['element_or_page_id'],
+                                        event.get('duration_seconds'), event.get('age_ms'), received_at))
+    if rows:
+        click_log_buffer.add(rows)
+    return jsonify({'success': True, 'accepted': len(rows), 'rejected': rejected}), 200
+
 # ****** 修改API：教師獲取學生行為摘要 ******
+SUMMARY_FIELDS = ('web_activity', 'behavior_stats', 'images') # 可透過 fields= 選擇要回傳的欄位組
+NON_TASK_BEHAVIORS = {"玩弄物品", "目視同學", "目視他處", "喝水/飲食", "整理個人物品", "趴睡"}
+
+def summarize_web_activity(student_ids, selected_date):
+    """從活動彙總表查詢點擊數與各標籤頁停留時間，並估計沒有停留記錄的頁面，回傳三個以 user_id 為鍵的字典。"""
+    ensure_activity_rollup()
+    rollup_filters = [ActivityRollup.user_id.in_(student_ids)]
+    if selected_date:
+        rollup_filters.append(ActivityRollup.day == selected_date)
+    
+    # 點擊次數
+    general_clicks_query = db.session.query(
+        ActivityRollup.user_id,
+        db.func.sum(ActivityRollup.event_count)
+    ).filter(
+        *rollup_filters,
+        ActivityRollup.event_type == 'click'
+    ).group_by(ActivityRollup.user_id).all()
+    
+    # 各標籤頁停留時間
+    tab_durations_query = db.session.query(
+        ActivityRollup.user_id,
+        ActivityRollup.element_or_page_id,
+        db.func.sum(ActivityRollup.total_duration_seconds)
+    ).filter(
+        *rollup_filters,
+        ActivityRollup.event_type.like('tab_view_end%')
+    ).group_by(ActivityRollup.user_id, ActivityRollup.element_or_page_id).all()
+
+    # 將查詢結果轉換為字典，方便後續查找
+    clicks_by_student = {user_id: count for user_id, count in general_clicks_query}
+    time_by_student = {}
+    tracked_pages_by_student = {}
+    for user_id, page_id, total_seconds in tab_durations_query:
+        if user_id not in time_by_student:
+            time_by_student[user_id] = {}
+        tracked_pages_by_student.setdefault(user_id, set()).add(page_id)
+        if total_seconds and total_seconds > 0:
+            tab_display_name = TAB_DISPLAY_NAMES.get(page_id, page_id) # 如果沒有匹配，使用原始ID
+            time_by_student[user_id][tab_display_name] = format_seconds_to_readable(total_seconds)
+
+    # 沒有 tab_view_end 記錄的頁面，使用寫入時以會話切割算好的每日停留時間
+    if selected_date:
+        first_day = last_day = selected_date
+    else:
+        last_day = datetime.datetime.utcnow().date()
+        first_day = last_day - datetime.timedelta(days=app.config['SESSION_DWELL_LOOKBACK_DAYS'] - 1)
+    dwell_by_student = rollup_page_dwell_times(student_ids, first_day, last_day)
+    untracked_time_by_student = {}
+    for user_id, pages in dwell_by_student.items():
+        tracked_pages = tracked_pages_by_student.get(user_id, set())
+        untracked_time_by_student[user_id] = {
+            TAB_DISPLAY_NAMES.get(page_id, page_id): format_seconds_to_readable(total_seconds)
+            for page_id, total_seconds in pages.items()
+            if page_id not in tracked_pages and total_seconds >= 1
+        }
+    return clicks_by_student, time_by_student, untracked_time_by_student
+
+def find_report_entries_for_students(student_names, selected_date_str=None):
+    """從報告目錄找出每位學生最新 (或指定日期) 的有效報告，回傳 {student_name: ReportCatalogEntry}。"""
+    ensure_report_catalog_fresh()
+    catalog_query = ReportCatalogEntry.query.filter(
+        ReportCatalogEntry.student_name.in_(student_names),
+        ReportCatalogEntry.parse_error.is_(None)
+    )
+    if selected_date_str:
+        # 如果有指定日期，只使用檔名日期完全相符的報告
+        catalog_query = catalog_query.filter(ReportCatalogEntry.report_date == selected_date_str)
+    latest_entry_by_student = {}
+    for entry in catalog_query.all():
+        # 檔名中包含 YYYYMMDD_HHMMSS，字串排序即時間排序，最新的在最前面
+        current = latest_entry_by_student.get(entry.student_name)
+        if current is None or entry.filename > current.filename:
+            latest_entry_by_student[entry.student_name] = entry
+    return latest_entry_by_student
+
+def build_student_report_summary(student_name, report_path, report_filename, report_date, fields):
+    """讀取單一學生的報告並整理成摘要；只包含 fields 中要求的欄位組。找不到報告時回傳「無報告」的基本結構。"""
+    # 初始化報告摘要，確保即使沒有報告檔案，前端也能收到基本結構
+    student_report_summary = {
+        "latest_report_filename": None,
+        "report_date": "無報告",
+    }
+    if 'behavior_stats' in fields:
+        student_report_summary.update({
+            "behavior_statistics": [], # 【核心修正】確保這個欄位存在且為空陣列
+            # 保留您原有的計算欄位，如果前端需要的話
+            "top_behavior": "N/A",
+            "top_behavior_percent": 0,
+            "non_task_percent": 0,
+        })
+    if 'images' in fields:
+        student_report_summary["behavior_to_images_index"] = {}
+
+    if report_path is None:
+        return student_report_summary
+
+    try:
+        report_data = load_report_summary(report_path)
+
+        overall_summary = report_data.get("overall_summary") or {}
+        metadata = report_data.get("report_metadata") or {}
+
+        # 填充報告摘要資訊
+        student_report_summary["latest_report_filename"] = report_filename
+
+        # 【重要】統一從檔名解析日期，確保與前端選擇一致
+        if report_date:
+            student_report_summary["report_date"] = report_date
+        else: # 如果檔名不符規則，從JSON內讀取作為備用
+            student_report_summary["report_date"] = metadata.get("report_generation_time", "日期未知").split(" ")[0]
+
+        if 'behavior_stats' in fields:
+            # 【核心修正】直接傳遞完整的行為統計列表
+            behavior_stats = overall_summary.get("behavior_statistics", [])
+            student_report_summary["behavior_statistics"] = behavior_stats
+
+            # 計算並填充其他摘要欄位
+            if behavior_stats:
+                top_behavior = behavior_stats[0]
+                student_report_summary["top_behavior"] = top_behavior.get("behavior_category", "N/A")
+                student_report_summary["top_behavior_percent"] = top_behavior.get("percentage", 0)
+                non_task_total_percent = sum(
+                    item.get("percentage", 0) 
+                    for item in behavior_stats 
+                    if item.get("behavior_category") in NON_TASK_BEHAVIORS
+                )
+                student_report_summary["non_task_percent"] = round(non_task_total_percent, 1)
+
+        if 'images' in fields:
+            student_report_summary["behavior_to_images_index"] = overall_summary.get("behavior_to_images_index", {})
+
+    except Exception as e:
+        logger.warning("讀取或解析學生 %s 的報告 %s 時出錯: %s", student_name, report_filename, e)
+    return student_report_summary
+
+def submit_student_report_summary(*args):
+    """
+    將單一學生的報告讀取交給檔案系統執行緒池，回傳 (future, 開始時間)。
+    開始時間在工作真正開始執行時才填入 (並設定 event)，排隊等待的時間不計入逾時。
+    """
+    started = {"event": threading.Event()}
+    def run():
+        started["at"] = time.monotonic()
+        started["event"].set()
+        return build_student_report_summary(*args)
+    return submit_filesystem_io(run), started
+
+def wait_student_report_summary(future, started, timeout_seconds, deadline):
+    """
+    等待報告摘要完成；從開始執行起超過 timeout_seconds，或已過整個請求的期限 deadline (time.monotonic())
+    仍未完成則取消工作並回傳 None。
+    """
+    try:
+        # 仍在排隊時等待工作開始執行，最多等到整個請求的期限
+        if not started["event"].wait(max(0, deadline - time.monotonic())):
+            raise FuturesTimeoutError
+        wait_until = min(deadline, started["at"] + timeout_seconds)
+        return future.result(timeout=max(0, wait_until - time.monotonic()))
+    except FuturesTimeoutError:
+        future.cancel()
+        return None
+
 @app.route('/api/teacher/all_students_activity_summary')
-@login_required
+@role_required('teacher')
 def get_all_students_activity_summary():
-    if current_user.role != 'teacher':
-        return jsonify({"error": "權限不足"}), 403
-
+    """
+    以串流方式回傳 {"students": [...], "next_cursor": ..., "timed_out_count": ...}。
+    可選參數: date (YYYY-MM-DD)、fields (web_activity,behavior_stats,images，預設全部)、
+    student (學生姓名關鍵字)、class_id (預設為教師的所有班級)、limit 與 cursor (上一頁回傳的 next_cursor)。
+    """
     try:
-        # --- 步驟 1: 接收前端傳來的日期參數 ---
+        # --- 步驟 1: 接收並驗證前端傳來的參數 ---
         # 如果前端傳來 ?date=2025-07-08，這裡就能收到
         selected_date_str = request.args.get('date')
-        
-        # 學生查詢
-        students = User.query.filter_by(role='student').all()
-        summary_data = []
+        selected_date = None
+        if selected_date_str:
+            try:
+                selected_date = datetime.date.fromisoformat(selected_date_str)
+            except ValueError:
+                return jsonify({"error": "日期格式錯誤，應為 YYYY-MM-DD。"}), 400
 
-        print(f"\n--- [API /teacher/all_students_activity_summary] ---")
-        print(f"教師 {current_user.username} 請求摘要。學生總數: {len(students)}。篩選日期: {selected_date_str or '最新'}")
+        fields_param = request.args.get('fields')
+        fields = set(SUMMARY_FIELDS) if not fields_param else {f.strip() for f in fields_param.split(',') if f.strip()}
+        if fields - set(SUMMARY_FIELDS):
+            return jsonify({"error": f"不支援的欄位: {', '.join(sorted(fields - set(SUMMARY_FIELDS)))}"}), 400
 
-        # --- 步驟 2: 一次性查詢所有學生的網站活動數據 (性能優化) ---
-        all_student_ids = [s.id for s in students]
-        
-        # 查詢所有相關的點擊日誌
-        general_clicks_query = db.session.query(
-            ClickLog.user_id,
-            db.func.count(ClickLog.id)
-        ).filter(
-            ClickLog.user_id.in_(all_student_ids),
-            ClickLog.event_type == 'click'
-        ).group_by(ClickLog.user_id).all()
-        
-        # 查詢所有相關的標籤頁停留時間
-        tab_durations_query = db.session.query(
-            ClickLog.user_id,
-            ClickLog.element_or_page_id,
-            db.func.sum(ClickLog.duration_seconds)
-        ).filter(
-            ClickLog.user_id.in_(all_student_ids),
-            ClickLog.event_type.like('tab_view_end%')
-        ).group_by(ClickLog.user_id, ClickLog.element_or_page_id).all()
-
-        # 將查詢結果轉換為字典，方便後續查找
-        clicks_by_student = {user_id: count for user_id, count in general_clicks_query}
-        time_by_student = {}
-        for user_id, page_id, total_seconds in tab_durations_query:
-            if user_id not in time_by_student:
-                time_by_student[user_id] = {}
-            if total_seconds and total_seconds > 0:
-                tab_display_name = {
-                    'summaryNotesTab': 'AI觀察與建議',
-                    'overallStatsTab': '整體行為統計',
-                    'timelineTab': '行為趨勢圖',
-                    'sequenceDetailsTab': '詳細序列分析'
-                }.get(page_id, page_id) # 如果沒有匹配，使用原始ID
-                time_by_student[user_id][tab_display_name] = format_seconds_to_readable(total_seconds)
-
-        # --- 步驟 3: 遍歷學生，處理報告檔案 ---
+        try:
+            limit = int(request.args['limit']) if request.args.get('limit') else None
+            cursor = int(request.args['cursor']) if request.args.get('cursor') else None
+        except ValueError:
+            return jsonify({"error": "limit 或 cursor 格式錯誤。"}), 400
+        if limit is not None:
+            limit = max(1, min(limit, app.config['SUMMARY_MAX_PAGE_SIZE']))
+        student_filter = request.args.get('student', '').strip()
+
+        try:
+            scope = current_class_scope()
+        except ClassNotFoundError:
+            return class_not_found_response()
+
+        # 學生查詢：只查詢教師班級名單中的學生 (依 ID 排序，以 ID 作為分頁游標)
+        students_query = User.query.filter(*scope.student_filters())
+        if student_filter:
+            students_query = students_query.filter(User.username.contains(student_filter, autoescape=True))
+        if cursor is not None:
+            students_query = students_query.filter(User.id > cursor)
+        students_query = students_query.order_by(User.id)
+        if limit is not None:
+            students = students_query.limit(limit + 1).all()
+            next_cursor = students[limit - 1].id if len(students) > limit else None
+            students = students[:limit]
+        else:
+            students = students_query.all()
+            next_cursor = None
+
+        logger.debug(
+            "教師 %s 請求摘要。本頁學生數: %d。篩選日期: %s。欄位: %s",
+            current_user.username, len(students), selected_date_str or '最新', ','.join(sorted(fields))
+        )
+
+        # --- 步驟 2: 從報告目錄一次性找出每位學生要使用的報告 ---
+        needs_report = bool(fields & {'behavior_stats', 'images'})
+        latest_entry_by_student = find_report_entries_for_students([s.username for s in students], selected_date_str) if needs_report else {}
+        # 先把需要的值取出，串流產生時不再存取 ORM 物件
+        report_targets = []
         for student in students:
-            print(f"  正在處理學生: {student.username} (ID: {student.id})")
-            
-            # 從預先查好的字典中獲取網站互動數據
-            total_general_clicks = clicks_by_student.get(student.id, 0)
-            time_spent_on_tabs_formatted = time_by_student.get(student.id, {})
-
-            # 初始化報告摘要，確保即使沒有報告檔案，前端也能收到基本結構
-            student_report_summary = {
-                "latest_report_filename": None,
-                "report_date": "無報告",
-                "behavior_statistics": [], # 【核心修正】確保這個欄位存在且為空陣列
-                "behavior_to_images_index": {},
-                # 保留您原有的計算欄位，如果前端需要的話
-                "top_behavior": "N/A",
-                "top_behavior_percent": 0,
-                "non_task_percent": 0,
-            }
+            entry = latest_entry_by_student.get(student.username)
+            report_targets.append((
+                student.id, student.username,
+                entry.file_path if entry else None, entry.filename if entry else None, entry.report_date if entry else None
+            ))
 
-            student_report_folder = os.path.join(app.config['BEHAVIOR_REPORT_FOLDER'], student.username)
-            
-            if os.path.isdir(student_report_folder):
-                # --- 步驟 4: 根據日期參數構建檔案搜尋模式 (功能實現) ---
-                file_pattern = ""
-                if selected_date_str:
-                    # 如果有指定日期，檔名需要精確匹配 YYYYMMDD
-                    date_part_for_filename = selected_date_str.replace("-", "")
-                    file_pattern = os.path.join(student_report_folder, f"student_{student.username}_behavior_report_{date_part_for_filename}_*.json")
-                else:
-                    # 如果未指定日期，查找所有報告以獲取最新的
-                    file_pattern = os.path.join(student_report_folder, f"student_{student.username}_behavior_report_*.json")
-
-                # 查找並排序檔案，最新的在最前面
-                matching_files = sorted(glob.glob(file_pattern), reverse=True)
-                
-                if matching_files:
-                    latest_report_path = matching_files[0]
-                    print(f"    找到報告: {os.path.basename(latest_report_path)}")
-                    
-                    try:
-                        with open(latest_report_path, 'r', encoding='utf-8') as f:
-                            report_data = json.load(f)
-                        
-                        overall_summary = report_data.get("overall_summary", {})
-                        metadata = report_data.get("report_metadata", {})
-
-                        # 填充報告摘要資訊
-                        student_report_summary["latest_report_filename"] = os.path.basename(latest_report_path)
-                        
-                        # 【重要】統一從檔名解析日期，確保與前端選擇一致
-                        match = re.search(r'_(\d{8})_', os.path.basename(latest_report_path))
-                        if match:
-                             date_part = match.group(1)
-                             student_report_summary["report_date"] = f"{date_part[:4]}-{date_part[4:6]}-{date_part[6:8]}"
-                        else: # 如果檔名不符規則，從JSON內讀取作為備用
-                             student_report_summary["report_date"] = metadata.get("report_generation_time", "日期未知").split(" ")[0]
-
-                        # 【核心修正】直接傳遞完整的行為統計列表
-                        behavior_stats = overall_summary.get("behavior_statistics", [])
-                        student_report_summary["behavior_statistics"] = behavior_stats
-
-                        # 計算並填充其他摘要欄位
-                        if behavior_stats:
-                            top_behavior = behavior_stats[0]
-                            student_report_summary["top_behavior"] = top_behavior.get("behavior_category", "N/A")
-                            student_report_summary["top_behavior_percent"] = top_behavior.get("percentage", 0)
-                            
-                            non_task_behaviors = {"玩弄物品", "目視同學", "目視他處", "喝水/飲食", "整理個人物品", "趴睡"}
-                            non_task_total_percent = sum(
-                                item.get("percentage", 0) 
-                                for item in behavior_stats 
-                                if item.get("behavior_category") in non_task_behaviors
-                            )
-                            student_report_summary["non_task_percent"] = round(non_task_total_percent, 1)
-
-                        student_report_summary["behavior_to_images_index"] = overall_summary.get("behavior_to_images_index", {})
-
-                    except Exception as e:
-                        print(f"    錯誤: 讀取或解析學生 {student.username} 的報告 {os.path.basename(latest_report_path)} 時出錯: {e}")
-                else:
-                    print(f"    警告: 學生 {student.username} 在日期 '{selected_date_str or '最新'}' 沒有找到報告檔案。")
-            else:
-                print(f"    警告: 未找到學生 {student.username} 的報告資料夾: {student_report_folder}")
-
-            # --- 步驟 5: 組合最終數據 ---
-            summary_data.append({
-                "student_id": student.id,
-                "student_name": student.username,
-                "total_general_clicks": total_general_clicks,
-                "time_spent_on_tabs_details": time_spent_on_tabs_formatted,
-                "report_summary": student_report_summary # 現在這個物件包含了前端需要的所有資訊
-            })
-        
-        print("--- [API /teacher/all_students_activity_summary] 處理完成 ---")
-        return jsonify(summary_data)
+        # 內容只取決於本頁學生、使用的報告與活動日誌；都沒變時回傳 304，不必重新查詢與讀取報告
+        etag = compute_etag(
+            'all_students_activity_summary', sorted(request.args.items(multi=True)), next_cursor,
+            [(s.id, s.username) for s in students],
+            sorted((e.filename, e.file_size, e.file_mtime) for e in latest_entry_by_student.values()),
+            # 未指定日期時，估計停留時間涵蓋最近幾天，跨日後內容會改變
+            (click_log_version(), None if selected_date else datetime.datetime.utcnow().date()) if 'web_activity' in fields else None,
+        )
+        not_modified = not_modified_response(etag)
+        if not_modified is not None:
+            return not_modified
 
+        # --- 步驟 3: 一次性查詢本頁學生的網站活動數據 ---
+        if 'web_activity' in fields:
+            clicks_by_student, time_by_student, untracked_time_by_student = summarize_web_activity([s.id for s in students], selected_date)
     except Exception as e:
-        import traceback
-        print(f"!!!!!!!!!!!! API ERROR in /api/teacher/all_students_activity_summary !!!!!!!!!!!!")
-        print(traceback.format_exc())
+        logger.exception("API ERROR in /api/teacher/all_students_activity_summary: %s", e)
         return jsonify({"error": "伺服器在獲取班級摘要時發生內部錯誤。"}), 500
 
-# 【新增】一個輔助函數來獲取日期，避免重複程式碼
-def get_all_available_dates(report_root_folder):
-    unique_dates = set()
-    if not os.path.isdir(report_root_folder):
-        return []
+    # --- 步驟 4: 以滑動視窗在執行緒池中並行讀取報告，並依序以串流輸出 ---
+    # 串流期間不佔用儲存空間名額：每份報告的等待時間都有上限，讀取逾時的學生計入 timed_out_count
+    def generate_summary():
+        timeout_seconds = app.config['SUMMARY_STUDENT_TIMEOUT_SECONDS']
+        deadline = time.monotonic() + app.config['SUMMARY_REQUEST_DEADLINE_SECONDS']
+        window_size = app.config['SUMMARY_REPORT_WORKERS']
+        # 同時最多 window_size 位學生的報告在執行緒池中；每輸出一位就補送下一位，不一次送出整頁
+        unsubmitted = deque(
+            (student_id, (student_name, report_path, report_filename, report_date, fields))
+            for student_id, student_name, report_path, report_filename, report_date in report_targets
+            if needs_report and report_path is not None
+        )
+        pending_reports = {}
 
-    for student_folder in os.listdir(report_root_folder):
-        full_student_path = os.path.join(report_root_folder, student_folder)
-        if os.path.isdir(full_student_path):
-            file_pattern = os.path.join(full_student_path, "student_*.json")
-            for report_path in glob.glob(file_pattern):
-                try:
-                    filename = os.path.basename(report_path)
-                    date_part = filename.split('_')[-2] # student_楊忠潁_behavior_report_20250630_125840.json
-                    # 將 YYYYMMDD 格式化為 YYYY-MM-DD
-                    if len(date_part) == 8 and date_part.isdigit():
-                         report_date = f"{date_part[:4]}-{date_part[4:6]}-{date_part[6:8]}"
-                         unique_dates.add(report_date)
-                except IndexError:
-                    continue # 忽略格式不符的檔名
-    
-    return sorted(list(unique_dates), reverse=True)
+        def fill_window():
+            while unsubmitted and len(pending_reports) < window_size and time.monotonic() < deadline:
+                student_id, args = unsubmitted.popleft()
+                pending_reports[student_id] = submit_student_report_summary(*args)
 
+        def wait_report(student_id):
+            fill_window()
+            if student_id not in pending_reports:
+                unsubmitted.popleft() # 已超過整個請求的期限，不再送出新的讀取
+                return None
+            report_summary = wait_student_report_summary(*pending_reports.pop(student_id), timeout_seconds, deadline)
+            fill_window()
+            return report_summary
 
-@app.route('/api/teacher/available_report_dates')
-@login_required
-def get_available_report_dates():
-    if current_user.role != 'teacher':
-        return jsonify({"error": "權限不足"}), 403
+        timed_out_count = 0
+        try:
+            yield '{"students":['
+            for index, (student_id, student_name, report_path, report_filename, report_date) in enumerate(report_targets):
+                student_item = {
+                    "student_id": student_id,
+                    "student_name": student_name,
+                }
+                if 'web_activity' in fields:
+                    # 從預先查好的字典中獲取網站互動數據
+                    student_item["total_general_clicks"] = clicks_by_student.get(student_id, 0)
+                    student_item["time_spent_on_tabs_details"] = time_by_student.get(student_id, {})
+                    student_item["estimated_time_on_untracked_pages"] = untracked_time_by_student.get(student_id, {})
+                if needs_report:
+                    report_summary = None
+                    if report_path is None:
+                        logger.debug("學生 %s 在日期 '%s' 沒有找到報告檔案。", student_name, selected_date_str or '最新')
+                    else:
+                        report_summary = wait_report(student_id)
+                        if report_summary is None:
+                            timed_out_count += 1
+                            logger.warning("讀取學生 %s 的報告 %s 逾時，以「無報告」代替。", student_name, report_filename)
+                    if report_summary is None:
+                        report_summary = build_student_report_summary(student_name, None, None, None, fields)
+                    student_item["report_summary"] = report_summary
+                yield ("," if index else "") + json.dumps(student_item, ensure_ascii=False)
+            yield '],"next_cursor":' + json.dumps(next_cursor) + ',"timed_out_count":' + str(timed_out_count) + '}'
+        finally:
+            # 用戶端中途斷線或發生錯誤時，取消尚未開始的報告讀取
+            for future, _ in pending_reports.values():
+                future.cancel()
 
-    report_root_folder = app.config['BEHAVIOR_REPORT_FOLDER']
-    unique_dates = set()
+    response = Response(stream_with_context(generate_summary()), mimetype='application/json')
+    return add_cache_validators(response, etag)
 
-    if not os.path.isdir(report_root_folder):
-        return jsonify([])
-
-    try:
-        # 遍歷所有學生資料夾
-        for student_folder_name in os.listdir(report_root_folder):
-            full_student_path = os.path.join(report_root_folder, student_folder_name)
-            if os.path.isdir(full_student_path):
-                # 遍歷資料夾內所有 json 檔案
-                for report_filename in os.listdir(full_student_path):
-                    if report_filename.endswith(".json"):
-                        # 從檔名解析日期，例如 student_楊忠潁_behavior_report_20250630_125840.json
-                        parts = report_filename.split('_')
-                        if len(parts) >= 4:
-                            date_part = parts[-2]
-                            if len(date_part) == 8 and date_part.isdigit():
-                                 # 格式化為 YYYY-MM-DD
-                                 report_date = f"{date_part[:4]}-{date_part[4:6]}-{date_part[6:8]}"
-                                 unique_dates.add(report_date)
+# 【新增】一個輔助函數來獲取日期，避免重複程式碼
+def get_all_available_dates(scope=None):
+    # 直接從報告目錄查詢，不再遍歷每個學生資料夾；指定範圍時只列出班級學生有報告的日期
+    query = db.session.query(ReportCatalogEntry.report_date).filter(ReportCatalogEntry.report_date.isnot(None))
+    if scope is not None and scope.class_ids is not None:
+        query = query.filter(ReportCatalogEntry.student_name.in_(scope.student_names_select()))
+    rows = query.distinct().all()
+    return sorted((row[0] for row in rows), reverse=True)
+
+
+@app.route('/api/teacher/available_report_dates')
+@role_required('teacher')
+def get_available_report_dates():
+    try:
+        scope = current_class_scope()
+    except ClassNotFoundError:
+        return class_not_found_response()
+    try:
+        ensure_report_catalog_fresh()
+        etag = compute_etag('available_report_dates', report_catalog_version(), scope.cache_key, scope.version())
+        not_modified = not_modified_response(etag)
+        if not_modified is not None:
+            return not_modified
+        sorted_dates = get_all_available_dates(scope)
     except Exception as e:
-        print(f"Error scanning for report dates: {e}")
+        logger.exception("Error scanning for report dates: %s", e)
         return jsonify({"error": "掃描報告日期時出錯"}), 500
     
-    sorted_dates = sorted(list(unique_dates), reverse=True)
-    return jsonify(sorted_dates)
+    return add_cache_validators(jsonify(sorted_dates), etag)
+
+@app.route('/api/teacher/import_users', methods=['POST'])
+@role_required('teacher')
+def import_users_api():
+    """
+    以上傳的 CSV 檔 (表單欄位 file) 或 text/csv 請求內容批次建立學生帳號。各列的錯誤在 errors 中回傳；
+    role 為 teacher 的列不會建立 (教師帳號請以 flask import-users 建立)。
+    """
+    upload = request.files.get('file')
+    data = upload.read() if upload is not None else request.get_data()
+    if not data:
+        return jsonify({"error": "請上傳 CSV 檔案"}), 400
+    try:
+        rows, errors = parse_user_import_csv(decode_user_import_csv(data), USER_IMPORT_WEB_ROLES)
+    except UserImportError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        result = import_users(rows, errors)
+    except Exception as e:
+        db.session.rollback()
+        logger.exception("批次匯入帳號時出錯: %s", e)
+        return jsonify({"error": "匯入帳號時發生錯誤"}), 500
+    logger.info("教師 %s 批次匯入帳號: 建立 %d 個，%d 列有錯誤。", current_user.username, result['created'], len(result['errors']))
+    return jsonify(result)
+
+@app.route('/api/teacher/events')
+@role_required('teacher')
+def api_teacher_events():
+    """
+    教師儀表板的即時更新 (text/event-stream)：?date=YYYY-MM-DD 與儀表板目前選擇的日期一致 (省略代表最新)，
+    ?class_id= 同儀表板選擇的班級，只會收到班級內學生的事件。
+    事件格式見 Dashboard Events；斷線後瀏覽器會帶 Last-Event-ID 重連，由歷史紀錄補送期間的事件。
+    """
+    date = request.args.get('date') or None
+    if date is not None:
+        try:
+            datetime.date.fromisoformat(date)
+        except ValueError:
+            return jsonify({"error": "日期格式錯誤，應為 YYYY-MM-DD。"}), 400
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    try:
+        student_ids = current_class_scope().student_ids() # 訂閱當下的班級名單，名單變動後需重新連線
+    except ClassNotFoundError:
+        return class_not_found_response()
+
+    subscriber = dashboard_events.subscribe(date, student_ids)
+    ensure_report_folder_watcher()
+    heartbeat_seconds = app.config['DASHBOARD_EVENTS_HEARTBEAT_SECONDS']
+
+    # 不使用 stream_with_context：串流期間不需要請求上下文，也不會一直佔用資料庫連線
+    def generate_events():
+        sent_event_id = last_event_id or 0 # 補送的事件也可能已在佇列中，不重複送出
+        try:
+            yield "retry: 5000\n\n"
+            if last_event_id is not None:
+                missed_events = dashboard_events.replay(last_event_id, subscriber)
+                if missed_events is None:
+                    # resync 事件帶目前最新的編號，前端重新載入後從這裡繼續；伺服器重新啟動時編號也會因此重新對齊
+                    sent_event_id = dashboard_events.last_event_id()
+                    yield format_sse_event((sent_event_id, 'resync', None, {"reason": "history_expired"}))
+                else:
+                    for event in missed_events:
+                        sent_event_id = event[0]
+                        yield format_sse_event(event)
+            while True:
+                if subscriber.overflowed:
+                    yield format_sse_event((dashboard_events.last_event_id(), 'resync', None, {"reason": "queue_overflow"}))
+                    return
+                try:
+                    event = subscriber.queue.get(timeout=heartbeat_seconds)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if event[0] <= sent_event_id:
+                    continue
+                sent_event_id = event[0]
+                yield format_sse_event(event)
+        finally:
+            dashboard_events.unsubscribe(subscriber)
+
+    response = Response(generate_events(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # 避免 nginx 緩衝事件
+    return response
 
 
 if __name__ == '__main__':
@@ -779,7 +4458,7 @@ if __name__ == '__main__':
         os.makedirs(instance_path)
     if not os.path.exists(json_behavior_path):
         os.makedirs(json_behavior_path)
-        print(f"已創建資料夾: {json_behavior_path}")
+        logger.info("已創建資料夾: %s", json_behavior_path)
 
     with app.app_context(): # 確保在應用上下文中執行 create_all
         create_initial_users()
@@ -0,0 +1,273 @@
+"""
+以 Flask test client 對各 API 端點進行效能測試：依指定的並行數送出請求，記錄 p50/p95/p99 延遲、
+吞吐量與單一請求的記憶體配置峰值，並與儲存的基準 (benchmark_baseline.json) 比較，退步時以非零狀態結束。
+
+用法:
+    python generate_synthetic_data.py bench_data
+    python benchmark.py bench_data --concurrency 8 --requests 100
+    python benchmark.py bench_data --save-baseline   # 更新基準
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+# 每個端點: (名稱, 身分, 方法, 產生請求的函式)；函式接收 (context, rng) 並回傳 (path, json_body)
+def _student_report(context, rng):
+    return rng.choice(context['report_files'][context['student']])
+
+def _report_batches(context, rng):
+    offset = rng.randrange(0, context['batches'], 10)
+    return f"/api/student/report_batches?report_file={_student_report(context, rng)}&offset={offset}", None
+
+def _sequence_image(context, rng):
+    image = rng.choice(context['image_filenames'])
+    return f"/api/get_sequence_image?report_file={_student_report(context, rng)}&image_file={image}&size=thumb", None
+
+def _log_events(context, rng):
+    events = [
+        {"event_type": "click", "element_or_page_id": rng.choice(['behaviorChart', 'ganttChart', 'reportSelector'])}
+        for _ in range(20)
+    ]
+    return "/api/log_events", {"events": events}
+
+ENDPOINTS = [
+    ('student_reports_list', 'student', 'GET', lambda c, r: ("/api/student/reports_list", None)),
+    ('student_report', 'student', 'GET', lambda c, r: (f"/api/student/report?report_file={_student_report(c, r)}", None)),
+    ('student_report_batches', 'student', 'GET', _report_batches),
+    ('sequence_image_thumb', 'student', 'GET', _sequence_image),
+    ('sequence_image_manifest', 'student', 'GET', lambda c, r: (f"/api/sequence_image_manifest?report_file={_student_report(c, r)}", None)),
+    ('log_events', 'student', 'POST', _log_events),
+    ('teacher_available_dates', 'teacher', 'GET', lambda c, r: ("/api/teacher/available_report_dates", None)),
+    ('teacher_activity_summary', 'teacher', 'GET', lambda c, r: (f"/api/teacher/all_students_activity_summary?date={r.choice(c['report_dates'])}", None)),
+    ('teacher_class_summary', 'teacher', 'GET', lambda c, r: (f"/api/teacher/class_summary?date={r.choice(c['report_dates'])}", None)),
+    ('teacher_student_trend', 'teacher', 'GET', lambda c, r: (f"/api/teacher/student_trend?student_id={r.choice(c['student_ids'])}&weeks=8", None)),
+    ('teacher_class_trend', 'teacher', 'GET', lambda c, r: ("/api/teacher/class_trend?weeks=8", None)),
+]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="API 端點效能測試")
+    parser.add_argument('dataset', help="generate_synthetic_data.py 產生的資料夾")
+    parser.add_argument('--concurrency', type=int, default=8, help="並行的請求執行緒數")
+    parser.add_argument('--requests', type=int, default=100, help="每個端點送出的請求數")
+    parser.add_argument('--warmup', type=int, default=5, help="每個端點正式測量前的暖身請求數")
+    parser.add_argument('--memory-samples', type=int, default=10, help="以 tracemalloc 量測記憶體峰值的請求數 (0 代表略過)")
+    parser.add_argument('--endpoints', default='', help="只測試這些端點 (以逗號分隔)")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="基準檔路徑")
+    parser.add_argument('--save-baseline', action='store_true', help="將本次結果寫入基準檔，而不是與其比較")
+    parser.add_argument('--tolerance', type=float, default=1.5, help="p50/p95 延遲與記憶體超過基準的倍數即視為退步")
+    parser.add_argument('--latency-slack-ms', type=float, default=5.0, help="延遲比較時額外允許的毫秒數，避免極短請求的雜訊")
+    parser.add_argument('--memory-slack-kb', type=float, default=256.0, help="記憶體比較時額外允許的 KB 數")
+    parser.add_argument('--output', default=None, help="另外將結果寫成 JSON 檔")
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args(argv)
+
+def load_dataset(dataset_folder):
+    with open(os.path.join(dataset_folder, 'dataset.json'), encoding='utf-8') as manifest_file:
+        manifest = json.load(manifest_file)
+    # 必須在 import app 之前設定，app.config.from_prefixed_env() 才會讀到
+    os.environ.update(manifest['environment'])
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as app_module
+    app_module.logger.setLevel('WARNING')
+    return manifest, app_module
+
+def login(app_module, username, password):
+    client = app_module.app.test_client()
+    response = client.post('/login', data={'username': username, 'password': password})
+    if response.status_code != 302:
+        raise RuntimeError(f"無法以 {username} 登入 (HTTP {response.status_code})")
+    return client
+
+def send(client, method, path, body):
+    started = time.perf_counter()
+    if method == 'POST':
+        response = client.post(path, json=body)
+    else:
+        response = client.get(path)
+    response.get_data() # 讀完整個回應 (含串流)，再關閉以觸發 call_on_close
+    response.close()
+    return time.perf_counter() - started, response.status_code
+
+def build_workers(args, manifest, app_module):
+    """每個執行緒各自擁有已登入的學生與教師 test client；學生依序分配。"""
+    with app_module.app.app_context():
+        # 教師端的學生趨勢只能查詢自己班級的學生 (舊資料集沒有 class_students，視為全部學生)
+        class_students = manifest.get('class_students', manifest['students'])
+        student_ids = [user.id for user in app_module.User.query.filter(app_module.User.username.in_(class_students))]
+    shared = {
+        'report_files': manifest['report_files'],
+        'report_dates': manifest['report_dates'],
+        'image_filenames': manifest['image_filenames'],
+        'batches': manifest['parameters']['batches'],
+        'student_ids': student_ids,
+    }
+    workers = []
+    for index in range(args.concurrency):
+        student = manifest['students'][index % len(manifest['students'])]
+        workers.append({
+            'context': dict(shared, student=student),
+            'clients': {
+                'student': login(app_module, student, manifest['password']),
+                'teacher': login(app_module, manifest['teacher'], manifest['password']),
+            },
+            'rng': random.Random(args.seed + index),
+        })
+    return workers
+
+def run_endpoint(args, workers, endpoint):
+    name, role, method, build_request = endpoint
+    for _ in range(args.warmup):
+        worker = workers[0]
+        send(worker['clients'][role], method, *build_request(worker['context'], worker['rng']))
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker_loop(worker, request_count):
+        local_latencies = []
+        local_errors = []
+        for _ in range(request_count):
+            elapsed, status = send(worker['clients'][role], method, *build_request(worker['context'], worker['rng']))
+            local_latencies.append(elapsed)
+            if status >= 400:
+                local_errors.append(status)
+        with lock:
+            latencies.extend(local_latencies)
+            errors.extend(local_errors)
+
+    per_worker = [args.requests // len(workers) + (1 if i < args.requests % len(workers) else 0) for i in range(len(workers))]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(workers)) as executor:
+        for future in [executor.submit(worker_loop, worker, count) for worker, count in zip(workers, per_worker)]:
+            future.result()
+    wall_seconds = time.perf_counter() - started
+
+    latencies_ms = np.array(latencies) * 1000.0
+    result = {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "error_statuses": sorted(set(errors)),
+        "p50_ms": round(float(np.percentile(latencies_ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies_ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(latencies_ms, 99)), 3),
+        "mean_ms": round(float(latencies_ms.mean()), 3),
+        "throughput_rps": round(len(latencies) / wall_seconds, 1) if wall_seconds > 0 else None,
+    }
+    result["peak_memory_kb"] = measure_peak_memory(args, workers[0], role, method, build_request)
+    return name, result
+
+def measure_peak_memory(args, worker, role, method, build_request):
+    """依序送出幾個請求，以 tracemalloc 記錄單一請求期間 Python 記憶體配置的最大增量 (KB)。"""
+    if args.memory_samples <= 0:
+        return None
+    tracemalloc.start()
+    try:
+        peak = 0
+        for _ in range(args.memory_samples):
+            path, body = build_request(worker['context'], worker['rng'])
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            send(worker['clients'][role], method, path, body)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    return round(peak / 1024.0, 1)
+
+def compare_with_baseline(args, results, baseline):
+    """回傳退步項目的說明列表；基準中沒有的端點不比較。"""
+    regressions = []
+    for name, result in results.items():
+        reference = baseline['results'].get(name)
+        if reference is None:
+            continue
+        if result['errors']:
+            regressions.append(f"{name}: {result['errors']} 個請求失敗 (HTTP {result['error_statuses']})")
+        for key in ('p50_ms', 'p95_ms'):
+            limit = reference[key] * args.tolerance + args.latency_slack_ms
+            if result[key] > limit:
+                regressions.append(f"{name}: {key} {result[key]:.2f} > {limit:.2f} (基準 {reference[key]:.2f})")
+        if result.get('peak_memory_kb') is not None and reference.get('peak_memory_kb') is not None:
+            limit = reference['peak_memory_kb'] * args.tolerance + args.memory_slack_kb
+            if result['peak_memory_kb'] > limit:
+                regressions.append(f"{name}: peak_memory_kb {result['peak_memory_kb']:.1f} > {limit:.1f} (基準 {reference['peak_memory_kb']:.1f})")
+    return regressions
+
+def print_results(results):
+    header = f"{'endpoint':<28}{'req':>6}{'err':>5}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>9}{'peak KB':>10}"
+    print(header)
+    print('-' * len(header))
+    for name, result in results.items():
+        peak = '-' if result['peak_memory_kb'] is None else f"{result['peak_memory_kb']:.1f}"
+        print(f"{name:<28}{result['requests']:>6}{result['errors']:>5}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}"
+              f"{result['p99_ms']:>10.2f}{result['throughput_rps'] or 0:>9.1f}{peak:>10}")
+
+def main(argv=None):
+    args = parse_args(argv)
+    manifest, app_module = load_dataset(os.path.abspath(args.dataset))
+    selected = {name.strip() for name in args.endpoints.split(',') if name.strip()}
+    unknown = selected - {endpoint[0] for endpoint in ENDPOINTS}
+    if unknown:
+        sys.exit(f"未知的端點: {', '.join(sorted(unknown))}")
+
+    workers = build_workers(args, manifest, app_module)
+    results = {}
+    for endpoint in ENDPOINTS:
+        if selected and endpoint[0] not in selected:
+            continue
+        name, result = run_endpoint(args, workers, endpoint)
+        results[name] = result
+        print(f"  {name}: p95 {result['p95_ms']:.2f} ms")
+    print()
+    print_results(results)
+
+    report = {
+        "dataset": manifest['parameters'],
+        "settings": {"concurrency": args.concurrency, "requests": args.requests, "memory_samples": args.memory_samples},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count()},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump(report, output_file, ensure_ascii=False, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as baseline_file:
+            json.dump(report, baseline_file, ensure_ascii=False, indent=2)
+            baseline_file.write('\n')
+        print(f"\n基準已寫入 {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"\n找不到基準檔 {args.baseline}，請先以 --save-baseline 建立。")
+        return 0
+    with open(args.baseline, encoding='utf-8') as baseline_file:
+        baseline = json.load(baseline_file)
+    for key in ('dataset', 'settings'):
+        if baseline.get(key) != report[key]:
+            print(f"\n警告: 本次的 {key} 與基準不同，比較結果僅供參考。\n  基準: {baseline.get(key)}\n  本次: {report[key]}")
+
+    regressions = compare_with_baseline(args, results, baseline)
+    if regressions:
+        print("\n" + "!" * 60)
+        print(f"效能退步 ({len(regressions)} 項，容許倍數 {args.tolerance}):")
+        for line in regressions:
+            print(f"  REGRESSION {line}")
+        print("!" * 60)
+        return 1
+    print(f"\n所有端點皆在基準的 {args.tolerance} 倍以內。")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,294 @@
+"""
+產生效能測試用的合成資料集：N 位學生 × M 個日期的行為報告 (與正式環境相同的
+student_<name>_behavior_report_<YYYYMMDD>_<HHMMSS>.json 檔名與 JSON 結構)、對應的
+MMDD/ID_n/Keyframes 關鍵影格資料夾，以及獨立的 SQLite 資料庫 (帳號、ClickLog、活動彙總、報告目錄)。
+
+用法:
+    python generate_synthetic_data.py bench_data --students 40 --dates 20 --click-logs 1000000
+
+輸出資料夾中的 dataset.json 記錄產生參數與帳號，benchmark.py 依此設定環境變數並登入。
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import time
+
+BEHAVIOR_CATEGORIES = [
+    "書寫/做筆記", "目視黑板", "目視老師", "舉手", "閱讀課本",
+    "玩弄物品", "目視同學", "目視他處", "喝水/飲食", "整理個人物品", "趴睡",
+]
+TAB_IDS = ['summaryNotesTab', 'overallStatsTab', 'timelineTab', 'sequenceDetailsTab']
+CLICK_TARGETS = ['reportSelector', 'behaviorChart', 'ganttChart', 'loadMoreBatches', 'sequenceImage', 'logoutLink']
+CLICK_LOG_CHUNK_SIZE = 50000
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="產生效能測試用的合成報告、關鍵影格與 ClickLog 資料")
+    parser.add_argument('output', help="輸出資料夾 (不存在時自動建立)")
+    parser.add_argument('--students', type=int, default=40, help="學生人數")
+    parser.add_argument('--dates', type=int, default=20, help="每位學生的報告日期數 (連續上課日)")
+    parser.add_argument('--end-date', default=None, help="最後一個報告日期 YYYYMMDD，預設為今天")
+    parser.add_argument('--batches', type=int, default=30, help="每份報告的批次數")
+    parser.add_argument('--images-per-batch', type=int, default=5, help="每個批次的影像數")
+    parser.add_argument('--image-size', default='640x480', help="關鍵影格尺寸 WIDTHxHEIGHT")
+    parser.add_argument('--click-logs', type=int, default=1000000, help="ClickLog 資料列數")
+    parser.add_argument('--class-size', type=int, default=0,
+                        help="每班學生數；大於 0 時依序分班，sim_teacher 只負責第一班，其餘班級各有一位教師。0 代表不建立班級")
+    parser.add_argument('--password', default='bench', help="所有合成帳號的密碼")
+    parser.add_argument('--seed', type=int, default=20250630, help="亂數種子，相同參數可重現相同資料")
+    return parser.parse_args(argv)
+
+def school_days(end_date, count):
+    """從 end_date 往前取 count 個週一至週五的日期 (由舊到新)。"""
+    days = []
+    day = end_date
+    while len(days) < count:
+        if day.weekday() < 5:
+            days.append(day)
+        day -= datetime.timedelta(days=1)
+    return days[::-1]
+
+def render_keyframe_bytes(width, height):
+    """產生一張 JPEG 關鍵影格；所有影格共用同一份內容，只需編碼一次。"""
+    from PIL import Image, ImageDraw
+    image = Image.new('RGB', (width, height), (90, 120, 150))
+    draw = ImageDraw.Draw(image)
+    for x in range(0, width, 40):
+        draw.line([(x, 0), (x, height)], fill=(200, 200, 200))
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=80)
+    return buffer.getvalue()
+
+def build_behavior_statistics(rng, image_count):
+    """隨機分配影像到各行為，回傳依佔比由高到低排序的 behavior_statistics 與每張影像的行為。"""
+    weights = [rng.random() ** 2 for _ in BEHAVIOR_CATEGORIES]
+    image_behaviors = rng.choices(BEHAVIOR_CATEGORIES, weights=weights, k=image_count)
+    counts = {}
+    for behavior in image_behaviors:
+        counts[behavior] = counts.get(behavior, 0) + 1
+    statistics = [
+        {
+            "behavior_category": behavior,
+            "count": count,
+            "percentage": round(count * 100.0 / image_count, 1),
+            "average_confidence": round(rng.uniform(0.6, 0.98), 2),
+        }
+        for behavior, count in sorted(counts.items(), key=lambda item: item[1], reverse=True)
+    ]
+    return statistics, image_behaviors
+
+def keyframe_image_names(image_count):
+    """關鍵影格檔名 (HH-MM-SS-mmm.jpg)：從 08:10 開始每 12 秒一張，每份報告都相同。"""
+    start = datetime.datetime(2000, 1, 1, 8, 10)
+    return [(start + datetime.timedelta(seconds=12 * index)).strftime('%H-%M-%S-000.jpg') for index in range(image_count)]
+
+def build_report(rng, student_name, student_number, report_day, batches, images_per_batch, keyframe_folder):
+    image_names = keyframe_image_names(batches * images_per_batch)
+    statistics, image_behaviors = build_behavior_statistics(rng, len(image_names))
+
+    behavior_to_images = {}
+    for image_name, behavior in zip(image_names, image_behaviors):
+        behavior_to_images.setdefault(behavior, []).append(image_name)
+
+    sequences = []
+    for batch_index in range(batches):
+        batch_images = image_names[batch_index * images_per_batch:(batch_index + 1) * images_per_batch]
+        batch_behaviors = image_behaviors[batch_index * images_per_batch:(batch_index + 1) * images_per_batch]
+        sequences.append({
+            "batch_index": batch_index + 1,
+            "image_filenames_in_batch": batch_images,
+            "analysis": {
+                "sequence_summary": f"第 {batch_index + 1} 批次中，學生主要的行為為{max(set(batch_behaviors), key=batch_behaviors.count)}。",
+                "sequence_analysis_confidence": round(rng.uniform(0.6, 0.95), 2),
+                "per_image_highlights": [
+                    {
+                        "image_index_in_sequence": image_index,
+                        "behavior_category": behavior,
+                        "confidence": round(rng.uniform(0.5, 0.99), 2),
+                        "description": f"學生{behavior}，姿勢穩定。",
+                        "head_pose_analysis": {"angle_description": rng.choice(["正視前方", "頭部略向左轉", "頭部略向右轉", "低頭"])},
+                    }
+                    for image_index, behavior in enumerate(batch_behaviors)
+                ],
+            },
+        })
+
+    return {
+        "report_metadata": {
+            "student_id": student_name,
+            "student_number": str(student_number),
+            "report_generation_time": f"{report_day:%m/%d}", # get_keyframe_folder 依此推算 MMDD 資料夾；補零避免 10/6 被當成 0106
+            "student_image_source_folder": keyframe_folder,
+        },
+        "overall_summary": {
+            "total_images_found": len(image_names),
+            "total_images_analyzed": len(image_names),
+            "total_batches": batches,
+            "behavior_statistics": statistics,
+            "behavior_to_images_index": behavior_to_images,
+            "ai_summary_notes": {
+                "greeting": f"{student_name} 同學你好！",
+                "observation_points_summary": "今天的課堂中你大部分時間都專注於課程。",
+                "positive_feedback": "做筆記的習慣很好，請繼續保持。",
+                "reflection_points": "偶爾會分心看向其他地方。",
+                "suggestions": "遇到不懂的地方可以舉手發問。",
+                "encouragement": "加油！",
+            },
+        },
+        "detailed_sequence_analysis": sequences,
+    }
+
+def write_reports(args, students, report_days, report_folder, photo_folder):
+    rng = random.Random(args.seed)
+    width, height = (int(part) for part in args.image_size.lower().split('x'))
+    # 所有影格以硬連結指向同一個檔案，數十萬張影格也只佔少數幾張的磁碟空間
+    keyframe_source = os.path.join(photo_folder, 'keyframe.jpg')
+    with open(keyframe_source, 'wb') as image_file:
+        image_file.write(render_keyframe_bytes(width, height))
+    report_files = {}
+    image_count = 0
+    for student_number, student_name in enumerate(students, start=1):
+        student_folder = os.path.join(report_folder, student_name)
+        os.makedirs(student_folder, exist_ok=True)
+        report_files[student_name] = []
+        for report_day in report_days:
+            keyframe_folder = os.path.join(photo_folder, f"{report_day:%m%d}", f"ID_{student_number}", "Keyframes")
+            os.makedirs(keyframe_folder, exist_ok=True)
+            report = build_report(rng, student_name, student_number, report_day, args.batches, args.images_per_batch, keyframe_folder)
+            for sequence in report["detailed_sequence_analysis"]:
+                for image_name in sequence["image_filenames_in_batch"]:
+                    image_path = os.path.join(keyframe_folder, image_name)
+                    try:
+                        os.link(keyframe_source, image_path)
+                    except OSError:
+                        # 超過檔案系統的硬連結數上限 (或不支援硬連結)：複製一份，之後改連結到這份
+                        shutil.copyfile(keyframe_source, image_path)
+                        keyframe_source = image_path
+                    image_count += 1
+            filename = f"student_{student_name}_behavior_report_{report_day:%Y%m%d}_153000.json"
+            with open(os.path.join(student_folder, filename), 'w', encoding='utf-8') as report_file:
+                json.dump(report, report_file, ensure_ascii=False, indent=2)
+            report_files[student_name].append(filename)
+    return report_files, image_count
+
+def generate_click_logs(args, app_module, user_ids, report_days):
+    """以 Core executemany 分段寫入 ClickLog，最後由原始日誌重建活動彙總表。"""
+    db = app_module.db
+    rng = random.Random(args.seed + 1)
+    table = app_module.ClickLog.__table__
+    remaining = args.click_logs
+    while remaining > 0:
+        rows = []
+        for _ in range(min(CLICK_LOG_CHUNK_SIZE, remaining)):
+            day = rng.choice(report_days)
+            timestamp = datetime.datetime.combine(day, datetime.time(8)) + datetime.timedelta(seconds=rng.randrange(10 * 3600))
+            kind = rng.random()
+            if kind < 0.35:
+                event_type, target, duration = 'tab_view_start', rng.choice(TAB_IDS), None
+            elif kind < 0.7:
+                event_type, target, duration = 'tab_view_end', rng.choice(TAB_IDS), rng.randrange(5, 600)
+            else:
+                event_type, target, duration = 'click', rng.choice(CLICK_TARGETS), None
+            rows.append({
+                "user_id": rng.choice(user_ids),
+                "event_type": event_type,
+                "element_or_page_id": target,
+                "timestamp": timestamp,
+                "duration_seconds": duration,
+            })
+        db.session.execute(table.insert(), rows)
+        db.session.commit()
+        remaining -= len(rows)
+        print(f"  ClickLog: 剩餘 {remaining} 筆")
+    return app_module.rebuild_activity_rollup()
+
+def main(argv=None):
+    args = parse_args(argv)
+    output = os.path.abspath(args.output)
+    report_folder = os.path.join(output, 'json_behavior')
+    photo_folder = os.path.join(output, 'student_week_photo')
+    database_path = os.path.join(output, 'site.db')
+    if os.path.exists(database_path):
+        sys.exit(f"{database_path} 已存在，請指定新的輸出資料夾。")
+    os.makedirs(report_folder, exist_ok=True)
+    os.makedirs(photo_folder, exist_ok=True)
+
+    # 必須在 import app 之前設定，app.config.from_prefixed_env() 才會讀到
+    environment = {
+        'FLASK_BEHAVIOR_REPORT_FOLDER': report_folder,
+        'FLASK_STUDENT_WEEK_PHOTO_FOLDER': photo_folder,
+        'FLASK_SQLALCHEMY_DATABASE_URI': 'sqlite:///' + database_path.replace('\\', '/'),
+        'FLASK_REPORT_SIDECAR_FOLDER': os.path.join(output, 'report_sidecars'),
+        'FLASK_IMAGE_VARIANT_CACHE_FOLDER': os.path.join(output, 'image_variants'),
+    }
+    os.environ.update(environment)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as app_module
+
+    end_date = datetime.datetime.strptime(args.end_date, '%Y%m%d').date() if args.end_date else datetime.date.today()
+    report_days = school_days(end_date, args.dates)
+    students = [f"sim{number:04d}" for number in range(1, args.students + 1)]
+    teacher = 'sim_teacher'
+    class_size = args.class_size if args.class_size > 0 else len(students)
+    classes = [students[start:start + class_size] for start in range(0, len(students), class_size)] if args.class_size > 0 else []
+    teachers = [teacher] + [f"sim_teacher{number:02d}" for number in range(2, len(classes) + 1)]
+
+    started = time.perf_counter()
+    print(f"產生 {len(students)} 位學生 × {len(report_days)} 份報告 ...")
+    report_files, image_count = write_reports(args, students, report_days, report_folder, photo_folder)
+    print(f"  完成 ({image_count} 張關鍵影格，{time.perf_counter() - started:.1f} 秒)")
+
+    with app_module.app.app_context():
+        db = app_module.db
+        db.create_all()
+        password_hash = app_module.generate_password_hash(args.password) # 所有帳號共用，避免逐一雜湊
+        db.session.execute(app_module.User.__table__.insert(), [
+            {"username": name, "password_hash": password_hash, "role": role}
+            for name, role in [(name, 'teacher') for name in teachers] + [(name, 'student') for name in students]
+        ])
+        db.session.commit()
+        user_ids_by_name = dict(db.session.query(app_module.User.username, app_module.User.id))
+        user_ids = [user_ids_by_name[name] for name in students]
+
+        for number, (class_teacher, class_students) in enumerate(zip(teachers, classes), start=1):
+            school_class = app_module.SchoolClass(name=f"sim_class{number:02d}", teacher_id=user_ids_by_name[class_teacher])
+            db.session.add(school_class)
+            db.session.flush()
+            db.session.execute(app_module.Enrollment.__table__.insert(), [
+                {"class_id": school_class.id, "student_id": user_ids_by_name[name]} for name in class_students
+            ])
+        db.session.commit()
+        if classes:
+            print(f"建立 {len(classes)} 個班級 (每班 {class_size} 位學生)")
+
+        print(f"寫入 {args.click_logs} 筆 ClickLog ...")
+        rollup_rows = generate_click_logs(args, app_module, user_ids, report_days)
+        print(f"  活動彙總 {rollup_rows} 筆，累計 {time.perf_counter() - started:.1f} 秒")
+
+        print("建立報告目錄 ...")
+        app_module.refresh_report_catalog()
+        app_module.click_log_buffer.flush()
+
+    manifest = {
+        "parameters": {key: value for key, value in vars(args).items() if key != 'output'},
+        "environment": environment,
+        "password": args.password,
+        "teacher": teacher,
+        "students": students,
+        "class_students": classes[0] if classes else students, # teacher 負責的學生
+        "report_dates": [f"{day:%Y-%m-%d}" for day in report_days],
+        "report_files": report_files,
+        "image_filenames": keyframe_image_names(args.batches * args.images_per_batch),
+        "image_count": image_count,
+        "generated_at": datetime.datetime.now().isoformat(timespec='seconds'),
+    }
+    with open(os.path.join(output, 'dataset.json'), 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, ensure_ascii=False, indent=2)
+    print(f"資料集已寫入 {output}，總耗時 {time.perf_counter() - started:.1f} 秒。")
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,10 @@ let currentTabStartTime = null;
 let current_user_id_for_beacon = null; 
 const current_user_is_authenticated_in_js = true; // 假設用戶已登入
 
+// --- 詳細序列分析的分批載入狀態 (批次改由 /api/student/report_batches 取得) ---
+const SEQUENCE_BATCH_PAGE_SIZE = 10;
+let sequenceBatchState = { reportFilename: null, nextOffset: 0, total: 0, loading: false, imageUrls: null };
+
 // --- 輔助函數 ---
 function setTextContent(id, text) {
     const element = document.getElementById(id);
@@ -53,8 +57,9 @@ function parseTimeToSeconds(filename) {
 
 
 // 【已替換】全新的 prepareGanttChartData 函數，用於生成甘特圖數據
-function prepareGanttChartData(sequenceDataArray) {
-    if (!sequenceDataArray || !Array.isArray(sequenceDataArray)) {
+// behaviorTimeline 為伺服器整理好的精簡時間軸: [[影像檔名, 行為類別], ...]
+function prepareGanttChartData(behaviorTimeline) {
+    if (!behaviorTimeline || !Array.isArray(behaviorTimeline)) {
         console.warn("prepareGanttChartData: Input is not a valid array.");
         return { yLabels: [], datasets: [] };
     }
@@ -76,28 +81,13 @@ function prepareGanttChartData(sequenceDataArray) {
 
     // 1. 收集所有事件並轉換為帶有時間戳的格式
     const allEvents = [];
-    sequenceDataArray.forEach(sequence => {
-        if (sequence.analysis && Array.isArray(sequence.analysis.per_image_highlights)) {
-            sequence.analysis.per_image_highlights.forEach(hl => {
-                const imageIndex = hl.image_index_in_sequence;
-                const behaviorCat = hl.behavior_category;
-                
-                // 兼容從 0 或 1 開始的索引
-                let filename;
-                if (typeof imageIndex === 'number' && imageIndex >= 0 && imageIndex < sequence.image_filenames_in_batch.length) {
-                    filename = sequence.image_filenames_in_batch[imageIndex];
-                } else if (typeof imageIndex === 'number' && imageIndex > 0 && imageIndex <= sequence.image_filenames_in_batch.length) {
-                    filename = sequence.image_filenames_in_batch[imageIndex - 1]; // 兼容從1開始的索引
-                }
-
-                if (behaviorCat && filename) {
-                    const timestamp = parseTimeToSeconds(filename);
-                    if (timestamp !== null) {
-                        const coreState = behaviorToStateMap[behaviorCat] || '狀態不明/休息';
-                        allEvents.push({ timestamp, coreState, originalBehavior: behaviorCat });
-                    }
-                }
-            });
+    behaviorTimeline.forEach(([filename, behaviorCat]) => {
+        if (behaviorCat && filename) {
+            const timestamp = parseTimeToSeconds(filename);
+            if (timestamp !== null) {
+                const coreState = behaviorToStateMap[behaviorCat] || '狀態不明/休息';
+                allEvents.push({ timestamp, coreState, originalBehavior: behaviorCat });
+            }
         }
     });
 
@@ -154,28 +144,42 @@ function prepareGanttChartData(sequenceDataArray) {
 
 
 // --- 日誌記錄函數 ---
-function logStudentActivity(eventType, elementOrPageId, durationInSeconds) {
-    if (!current_user_is_authenticated_in_js) {
-        return;
-    }
+// 事件先暫存在前端，累積一定數量或每隔幾秒以 /api/log_events 一次送出
+const ACTIVITY_FLUSH_SIZE = 20;
+const ACTIVITY_FLUSH_INTERVAL_MS = 3000;
+let pendingActivityEvents = [];
+let activityFlushTimer = null;
+
+// 送出時為每個事件加上 age_ms (事件發生到送出經過的毫秒數)，伺服器以收到的時間減去它作為事件時間
+function activityEventsForSending(events) {
+    const now = Date.now();
+    return events.map(event => {
+        const wireEvent = Object.assign({}, event, { age_ms: now - event.occurredAt });
+        delete wireEvent.occurredAt;
+        return wireEvent;
+    });
+}
 
-    const payload = {
-        event_type: eventType,
-        element_or_page_id: elementOrPageId,
-    };
-    if (durationInSeconds !== undefined && durationInSeconds !== null) {
-        payload.duration_seconds = Math.round(durationInSeconds);
+// keepalive 為 true 時 (頁面卸載中) 請求在頁面關閉後仍會送出
+function flushStudentActivity(keepalive = false) {
+    if (activityFlushTimer) {
+        clearTimeout(activityFlushTimer);
+        activityFlushTimer = null;
     }
+    if (pendingActivityEvents.length === 0) return;
+    const events = pendingActivityEvents;
+    pendingActivityEvents = [];
 
-    fetch('/api/log_page_event', {
+    fetch('/api/log_events', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify(payload)
+        body: JSON.stringify({ events: activityEventsForSending(events) }),
+        keepalive: keepalive
     })
     .then(response => response.json())
     .then(data => {
         if (data.success) {
-            console.log(`Activity logged: ${eventType} - ${elementOrPageId}`, payload);
+            console.log(`Activity logged: ${data.accepted} event(s)`, events);
         } else {
             console.error('Failed to log activity:', data.message);
         }
@@ -183,6 +187,28 @@ function logStudentActivity(eventType, elementOrPageId, durationInSeconds) {
     .catch(error => console.error('Error logging activity:', error));
 }
 
+function logStudentActivity(eventType, elementOrPageId, durationInSeconds) {
+    if (!current_user_is_authenticated_in_js) {
+        return;
+    }
+
+    const payload = {
+        event_type: eventType,
+        element_or_page_id: elementOrPageId,
+        occurredAt: Date.now(),
+    };
+    if (durationInSeconds !== undefined && durationInSeconds !== null) {
+        payload.duration_seconds = Math.round(durationInSeconds);
+    }
+
+    pendingActivityEvents.push(payload);
+    if (pendingActivityEvents.length >= ACTIVITY_FLUSH_SIZE) {
+        flushStudentActivity();
+    } else if (!activityFlushTimer) {
+        activityFlushTimer = setTimeout(flushStudentActivity, ACTIVITY_FLUSH_INTERVAL_MS);
+    }
+}
+
 function logUserClick(elementName) {
     console.log("Button/Link clicked:", elementName);
     logStudentActivity('click', elementName);
@@ -229,6 +255,11 @@ function openTab(evt, tabIdToOpen) {
     currentOpenTabId = tabIdToOpen;
     currentTabStartTime = new Date();
     logStudentActivity('tab_view_start', currentOpenTabId);
+
+    // 第一次打開詳細序列分析時才載入第一批資料
+    if (tabIdToOpen === 'sequenceDetailsTab' && sequenceBatchState.nextOffset === 0) {
+        loadMoreSequenceBatches();
+    }
 }
 
 
@@ -454,13 +485,13 @@ function populateStudentBehaviorReport(reportData, reportFilename) {
     // --- 步驟 4: 渲染行為趨勢圖 (甘特圖) ---
     const behaviorTimelineSection = document.getElementById('behaviorTimelineSection');
     const ganttChartContainer = document.getElementById('behaviorLineChartContainer');
-    const sequenceDetails = reportData.detailed_sequence_analysis;
+    const behaviorTimeline = reportData.behavior_timeline;
 
-    if (sequenceDetails && Array.isArray(sequenceDetails) && sequenceDetails.length > 0 && behaviorTimelineSection) {
+    if (behaviorTimeline && Array.isArray(behaviorTimeline) && behaviorTimeline.length > 0 && behaviorTimelineSection) {
         behaviorTimelineSection.style.display = 'block';
         if (ganttChartContainer && typeof Chart !== 'undefined') {
             
-            const ganttChartData = prepareGanttChartData(sequenceDetails);
+            const ganttChartData = prepareGanttChartData(behaviorTimeline);
             
             if (ganttChartData && ganttChartData.datasets[0] && ganttChartData.datasets[0].data.length > 0) {
                 
@@ -558,79 +589,152 @@ function populateStudentBehaviorReport(reportData, reportFilename) {
     }
 
 
-    // --- 步驟 5: 填充詳細序列分析 (批次與圖片) ---
+    // --- 步驟 5: 重設詳細序列分析，批次在打開該標籤頁時才分批載入 ---
+    sequenceBatchState = { reportFilename: reportFilename, nextOffset: 0, total: reportData.sequence_count || 0, loading: false, imageUrls: null };
     const specificObsContainer = document.getElementById('specificImageObservationsContainer');
     const imageBehaviorDetailsSection = document.getElementById('sequenceDetailsTab');
-    
-    if (sequenceDetails && Array.isArray(sequenceDetails) && sequenceDetails.length > 0 && imageBehaviorDetailsSection) {
+    if (imageBehaviorDetailsSection) {
         imageBehaviorDetailsSection.style.display = 'block';
-        if (specificObsContainer) {
-            specificObsContainer.innerHTML = '';
-            
-            sequenceDetails.forEach(sequence => {
-                const batchContainer = document.createElement('div');
-                batchContainer.className = 'observation-block sequence-block';
-
-                let batchHeaderHTML = `<h4>批次 ${sequence.batch_index}</h4>`;
-                const analysis = sequence.analysis;
-                if (analysis && !analysis.error) {
-                    batchHeaderHTML += `<p><small>序列分析總體信心: ${(parseFloat(analysis.sequence_analysis_confidence || 0) * 100).toFixed(0)}%</small></p>`;
-                    batchHeaderHTML += `<p><strong>序列總結:</strong> ${escapeHtml(analysis.sequence_summary || 'N/A')}</p>`;
-                } else {
-                    batchHeaderHTML += `<p style="color:red;">此序列分析錯誤: ${escapeHtml(analysis ? analysis.error : '未知錯誤')}</p>`;
-                }
-                batchContainer.innerHTML = batchHeaderHTML;
-
-                const detailsGrid = document.createElement('div');
-                detailsGrid.className = 'details-grid';
-
-                if (analysis && analysis.per_image_highlights && analysis.per_image_highlights.length > 0) {
-                    analysis.per_image_highlights.forEach(hl => {
-                        let imageIndex = hl.image_index_in_sequence;
-                        let filenameIndex;
-
-                        if (typeof imageIndex === 'number' && imageIndex >= 0 && imageIndex < sequence.image_filenames_in_batch.length) {
-                            filenameIndex = imageIndex; // 索引從 0 開始
-                        } else if (typeof imageIndex === 'number' && imageIndex > 0 && imageIndex <= sequence.image_filenames_in_batch.length) {
-                            filenameIndex = imageIndex - 1; // 兼容索引從 1 開始
-                        } else {
-                             console.warn("Invalid image_index_in_sequence found:", hl);
-                             return;
-                        }
-                        
-                        const detailItem = document.createElement('div');
-                        detailItem.className = 'detail-item';
-
-                        const imageFilename = sequence.image_filenames_in_batch[filenameIndex];
-                        const imgSrc = `/api/get_sequence_image?report_file=${encodeURIComponent(reportFilename)}&image_file=${encodeURIComponent(imageFilename)}`;
-                        const imgTag = `<img src="${imgSrc}" alt="${escapeHtml(imageFilename)}" class="sequence-image" loading="lazy">`;
-
-                        let textHtml = `<div class="detail-text">`;
-                        textHtml += `<strong>${escapeHtml(imageFilename)}</strong><br>`;
-                        textHtml += `行為: ${escapeHtml(hl.behavior_category)} (信度: ${parseFloat(hl.confidence || 0).toFixed(2)})<br>`;
-                        if (hl.description) { textHtml += `<small><em>描述: ${escapeHtml(hl.description)}</em></small><br>`; }
-                        if (hl.head_pose_analysis) { textHtml += `<small><em>頭部姿態: ${escapeHtml(hl.head_pose_analysis.angle_description)}</em></small>`; }
-                        textHtml += `</div>`;
-
-                        detailItem.innerHTML = imgTag + textHtml;
-                        detailsGrid.appendChild(detailItem);
-                    });
-                }
-                
-                batchContainer.appendChild(detailsGrid);
-                specificObsContainer.appendChild(batchContainer);
-            });
-        }
-    } else if (imageBehaviorDetailsSection) {
-        imageBehaviorDetailsSection.style.display = 'block';
-        if (specificObsContainer) {
-            specificObsContainer.innerHTML = '<p>無詳細序列分析數據可顯示。</p>';
-        }
     }
+    if (specificObsContainer) {
+        specificObsContainer.innerHTML = sequenceBatchState.total > 0 ? '' : '<p>無詳細序列分析數據可顯示。</p>';
+    }
+}
+
+// 取得報告中每張影像帶版本的 URL (可被瀏覽器長期快取)；失敗時回傳空物件，改用不帶版本的 URL
+function fetchKeyframeUrls(reportFilename) {
+    return fetch(`/api/sequence_image_manifest?report_file=${encodeURIComponent(reportFilename)}`)
+        .then(response => response.ok ? response.json() : { images: {} })
+        .then(data => data.images || {})
+        .catch(() => ({}));
+}
+
+// 取得下一頁的批次並附加到詳細序列分析中
+function loadMoreSequenceBatches() {
+    const specificObsContainer = document.getElementById('specificImageObservationsContainer');
+    const state = sequenceBatchState;
+    if (!specificObsContainer || !state.reportFilename || state.loading || state.nextOffset === null || state.nextOffset >= state.total) {
+        return;
+    }
+    state.loading = true;
+
+    let loadMoreButton = document.getElementById('loadMoreSequenceBatchesButton');
+    if (loadMoreButton) {
+        loadMoreButton.disabled = true;
+        loadMoreButton.textContent = '正在加載...';
+    }
+
+    const url = `/api/student/report_batches?report_file=${encodeURIComponent(state.reportFilename)}&offset=${state.nextOffset}&limit=${SEQUENCE_BATCH_PAGE_SIZE}`;
+    const imageUrlsReady = state.imageUrls ? Promise.resolve(state.imageUrls) : fetchKeyframeUrls(state.reportFilename);
+    Promise.all([
+        fetch(url).then(response => response.json().then(data => {
+            if (!response.ok || data.error) { throw new Error(data.error || `HTTP error! status: ${response.status}`); }
+            return data;
+        })),
+        imageUrlsReady,
+    ])
+        .then(([data, imageUrls]) => {
+            if (sequenceBatchState !== state) return; // 期間已切換到其他報告
+            state.imageUrls = imageUrls;
+            data.batches.forEach(sequence => specificObsContainer.appendChild(renderSequenceBatch(sequence, state.reportFilename, imageUrls)));
+            state.nextOffset = data.next_offset;
+            state.loading = false;
+
+            if (loadMoreButton) loadMoreButton.remove();
+            if (state.nextOffset !== null) {
+                loadMoreButton = document.createElement('button');
+                loadMoreButton.id = 'loadMoreSequenceBatchesButton';
+                loadMoreButton.className = 'action-button';
+                loadMoreButton.textContent = `載入更多批次 (已顯示 ${state.nextOffset} / ${state.total})`;
+                loadMoreButton.addEventListener('click', () => {
+                    logUserClick('button_load_more_sequence_batches');
+                    loadMoreSequenceBatches();
+                });
+                specificObsContainer.appendChild(loadMoreButton);
+            }
+        })
+        .catch(error => {
+            console.error('加載詳細序列分析失敗:', error);
+            state.loading = false;
+            if (loadMoreButton) {
+                loadMoreButton.disabled = false;
+                loadMoreButton.textContent = '加載失敗，點擊重試';
+            } else {
+                specificObsContainer.innerHTML = `<p style="color:red;">無法加載詳細序列分析: ${escapeHtml(error.message)}</p>`;
+                state.nextOffset = 0;
+            }
+        });
+}
+
+// 將單一批次渲染為 DOM 區塊
+function renderSequenceBatch(sequence, reportFilename, imageUrls = {}) {
+    const batchContainer = document.createElement('div');
+    batchContainer.className = 'observation-block sequence-block';
+
+    let batchHeaderHTML = `<h4>批次 ${sequence.batch_index}</h4>`;
+    const analysis = sequence.analysis;
+    if (analysis && !analysis.error) {
+        batchHeaderHTML += `<p><small>序列分析總體信心: ${(parseFloat(analysis.sequence_analysis_confidence || 0) * 100).toFixed(0)}%</small></p>`;
+        batchHeaderHTML += `<p><strong>序列總結:</strong> ${escapeHtml(analysis.sequence_summary || 'N/A')}</p>`;
+    } else {
+        batchHeaderHTML += `<p style="color:red;">此序列分析錯誤: ${escapeHtml(analysis ? analysis.error : '未知錯誤')}</p>`;
+    }
+    batchContainer.innerHTML = batchHeaderHTML;
+
+    const detailsGrid = document.createElement('div');
+    detailsGrid.className = 'details-grid';
+
+    if (analysis && analysis.per_image_highlights && analysis.per_image_highlights.length > 0) {
+        analysis.per_image_highlights.forEach(hl => {
+            let imageIndex = hl.image_index_in_sequence;
+            let filenameIndex;
+
+            if (typeof imageIndex === 'number' && imageIndex >= 0 && imageIndex < sequence.image_filenames_in_batch.length) {
+                filenameIndex = imageIndex; // 索引從 0 開始
+            } else if (typeof imageIndex === 'number' && imageIndex > 0 && imageIndex <= sequence.image_filenames_in_batch.length) {
+                filenameIndex = imageIndex - 1; // 兼容索引從 1 開始
+            } else {
+                 console.warn("Invalid image_index_in_sequence found:", hl);
+                 return;
+            }
+
+            const detailItem = document.createElement('div');
+            detailItem.className = 'detail-item';
+
+            const imageFilename = sequence.image_filenames_in_batch[filenameIndex];
+            const versionedUrls = imageUrls[imageFilename];
+            const imgSrc = versionedUrls && versionedUrls.url
+                ? versionedUrls.url
+                : `/api/get_sequence_image?report_file=${encodeURIComponent(reportFilename)}&image_file=${encodeURIComponent(imageFilename)}`;
+            const thumbSrc = versionedUrls && versionedUrls.thumb_url ? versionedUrls.thumb_url : `${imgSrc}&size=thumb`;
+            const imgTag = `<a href="${imgSrc}" target="_blank"><img src="${thumbSrc}" alt="${escapeHtml(imageFilename)}" class="sequence-image" loading="lazy"></a>`;
+
+            let textHtml = `<div class="detail-text">`;
+            textHtml += `<strong>${escapeHtml(imageFilename)}</strong><br>`;
+            textHtml += `行為: ${escapeHtml(hl.behavior_category)} (信度: ${parseFloat(hl.confidence || 0).toFixed(2)})<br>`;
+            if (hl.description) { textHtml += `<small><em>描述: ${escapeHtml(hl.description)}</em></small><br>`; }
+            if (hl.head_pose_analysis) { textHtml += `<small><em>頭部姿態: ${escapeHtml(hl.head_pose_analysis.angle_description)}</em></small>`; }
+            textHtml += `</div>`;
+
+            detailItem.innerHTML = imgTag + textHtml;
+            detailsGrid.appendChild(detailItem);
+        });
+    }
+
+    batchContainer.appendChild(detailsGrid);
+    return batchContainer;
 }
 
 // 頁面卸載時記錄最後一個標籤頁的停留時間
 window.addEventListener('beforeunload', function (e) {
+    // 先以 beacon 送出尚未送出的暫存事件 (同源 beacon 會帶上登入 cookie)
+    if (pendingActivityEvents.length > 0 && navigator.sendBeacon) {
+        const pendingBlob = new Blob([JSON.stringify({ events: activityEventsForSending(pendingActivityEvents) })], { type: 'application/json; charset=UTF-8' });
+        if (navigator.sendBeacon('/api/log_events', pendingBlob)) {
+            pendingActivityEvents = [];
+        }
+    }
+
     if (currentOpenTabId && currentTabStartTime) {
         const endTime = new Date();
         const durationMs = endTime - currentTabStartTime;
@@ -652,4 +756,7 @@ window.addEventListener('beforeunload', function (e) {
             logStudentActivity('tab_view_end_unload_fallback', currentOpenTabId, durationSec);
         }
     }
+    // 無法以 beacon 送出的事件 (包含上面的 fallback 事件) 立即以 keepalive 請求送出；
+    // 暫存區平常由 setTimeout 送出，但頁面卸載時計時器不會再觸發
+    flushStudentActivity(true);
 });
\ No newline at end of file
@@ -2,6 +2,101 @@
 
 // --- 全局變量 ---
 let allStudentData = []; // 用於緩存從API獲取的所有學生數據
+let currentSummaryDate = ''; // 目前載入的報告日期 ('' 代表最新)
+let currentClassId = ''; // 目前選擇的班級 ('' 代表教師的所有班級)
+let imageIndexLoaded = false; // 行為影像索引只在打開影像瀏覽頁簽時才載入
+let dashboardEventSource = null; // 即時更新 (SSE) 連線
+let dashboardEventDate = null; // 即時更新連線訂閱的日期
+let dashboardEventClassId = null; // 即時更新連線訂閱的班級
+const SUMMARY_PAGE_SIZE = 50;
+const keyframeUrlCache = new Map(); // 報告檔名 -> 每張影像帶版本的 URL (見 /api/sequence_image_manifest)
+
+// 依序讀取班級摘要的每一頁 (伺服器以 next_cursor 分頁)，每讀完一頁就呼叫 onPage
+function fetchStudentSummaryPages(date, fields, onPage, extraParams = {}) {
+    const fetchPage = (cursor) => {
+        const params = new URLSearchParams(Object.assign({ fields: fields, limit: SUMMARY_PAGE_SIZE }, extraParams));
+        if (date) params.set('date', date);
+        if (currentClassId) params.set('class_id', currentClassId);
+        if (cursor !== null) params.set('cursor', cursor);
+        return fetch(`/api/teacher/all_students_activity_summary?${params.toString()}`)
+            .then(response => {
+                if (!response.ok) {
+                    return response.json().then(err => { throw new Error(err.error || '伺服器響應錯誤'); });
+                }
+                return response.json();
+            })
+            .then(data => {
+                if (data.error) { throw new Error(data.error); }
+                onPage(data.students || [], data);
+                return data.next_cursor !== null && data.next_cursor !== undefined ? fetchPage(data.next_cursor) : null;
+            });
+    };
+    return fetchPage(null);
+}
+
+// --- 即時更新 ---
+// 訂閱伺服器推送的差異事件 (/api/teacher/events)，只更新有變動的學生，不必重新載入整個班級摘要。
+// 日期與班級和目前載入的摘要一致；切換日期或班級時重新連線。
+function connectDashboardEvents(date, onResync) {
+    if (!window.EventSource) return;
+    if (dashboardEventSource && dashboardEventDate === date && dashboardEventClassId === currentClassId) return;
+    if (dashboardEventSource) dashboardEventSource.close();
+
+    const params = new URLSearchParams();
+    if (date) params.set('date', date);
+    if (currentClassId) params.set('class_id', currentClassId);
+    const query = params.toString();
+    dashboardEventSource = new EventSource(query ? `/api/teacher/events?${query}` : '/api/teacher/events');
+    dashboardEventDate = date;
+    dashboardEventClassId = currentClassId;
+    dashboardEventSource.addEventListener('report', event => applyReportEvent(JSON.parse(event.data)));
+    dashboardEventSource.addEventListener('activity', event => applyActivityEvent(JSON.parse(event.data)));
+    dashboardEventSource.addEventListener('resync', () => onResync()); // 伺服器無法補齊差異，重新載入完整摘要
+}
+
+function findLoadedStudent(studentId) {
+    return allStudentData.find(student => student.student_id === studentId);
+}
+
+// 報告新增/更新：直接替換該學生的報告摘要；報告被移除時重新查詢該學生
+function applyReportEvent(payload) {
+    const student = findLoadedStudent(payload.student_id);
+    if (!student) return; // 不在目前名單中的學生 (例如新帳號)，下次重新載入時才會出現
+    if (!payload.report_summary) {
+        refreshStudentRow(student);
+        return;
+    }
+    const current = student.report_summary || {};
+    // 「最新」模式下，只接受不比目前顯示的報告舊的報告
+    if (!currentSummaryDate && current.latest_report_filename && current.report_date > payload.report_date) return;
+    student.report_summary = Object.assign({}, current, payload.report_summary);
+    populateBehaviorStatsTab(allStudentData);
+    if (imageIndexLoaded) populateImageExplorerTab(allStudentData);
+}
+
+// 點擊數與停留時間更新：伺服器已依目前的日期計算好總計
+function applyActivityEvent(payload) {
+    const student = findLoadedStudent(payload.student_id);
+    if (!student) return;
+    student.total_general_clicks = payload.total_general_clicks;
+    student.time_spent_on_tabs_details = payload.time_spent_on_tabs_details;
+    student.estimated_time_on_untracked_pages = payload.estimated_time_on_untracked_pages;
+    populateWebActivityTab(allStudentData);
+}
+
+function refreshStudentRow(student) {
+    const requestedDate = currentSummaryDate;
+    const fields = imageIndexLoaded ? 'web_activity,behavior_stats,images' : 'web_activity,behavior_stats';
+    fetchStudentSummaryPages(requestedDate, fields, students => {
+        const updated = students.find(item => item.student_id === student.student_id);
+        if (!updated || requestedDate !== currentSummaryDate) return;
+        Object.assign(student, updated);
+        populateWebActivityTab(allStudentData);
+        populateBehaviorStatsTab(allStudentData);
+        if (imageIndexLoaded) populateImageExplorerTab(allStudentData);
+    }, { student: student.student_name })
+        .catch(error => console.error('更新學生資料失敗:', error));
+}
 
 // --- 輔助函數 ---
 function escapeHtmlJs(unsafe) {
@@ -30,6 +125,37 @@ function openTeacherTab(evt, tabIdToOpen) {
     }
     document.getElementById(tabIdToOpen).style.display = "block";
     evt.currentTarget.className += " active";
+
+    if (tabIdToOpen === 'imageExplorerTab' && !imageIndexLoaded) {
+        loadImageExplorerData();
+    }
+}
+
+// 頁簽3 的影像索引資料量較大，打開頁簽時才向伺服器索取 (fields=images)
+function loadImageExplorerData() {
+    const container = document.getElementById('imageExplorerContainer');
+    if (container) container.innerHTML = '<p class="text-center">正在加載行為影像索引...</p>';
+    imageIndexLoaded = true;
+    const requestedDate = currentSummaryDate;
+    const imageSummaries = {};
+
+    fetchStudentSummaryPages(requestedDate, 'images', students => {
+        students.forEach(student => { imageSummaries[student.student_id] = student.report_summary || {}; });
+    })
+    .then(() => {
+        if (requestedDate !== currentSummaryDate) return; // 期間已切換日期，丟棄過期的結果
+        allStudentData.forEach(student => {
+            const images = imageSummaries[student.student_id];
+            if (!images) return;
+            student.report_summary = Object.assign({}, student.report_summary, images);
+        });
+        populateImageExplorerTab(allStudentData);
+    })
+    .catch(error => {
+        imageIndexLoaded = false;
+        console.error('加載行為影像索引失敗:', error);
+        if (container) container.innerHTML = `<p>無法加載行為影像索引: ${escapeHtmlJs(error.message)}</p>`;
+    });
 }
 
 // --- 渲染函數 ---
@@ -52,12 +178,16 @@ function populateWebActivityTab(data) {
         row.insertCell().textContent = student.total_general_clicks;
         
         const timeCell = row.insertCell();
-        const timeDetails = student.time_spent_on_tabs_details;
-        if (timeDetails && Object.keys(timeDetails).length > 0) {
+        const timeDetails = student.time_spent_on_tabs_details || {};
+        const estimatedDetails = student.estimated_time_on_untracked_pages || {}; // 沒有停留記錄的頁面，由伺服器依活動記錄估計
+        if (Object.keys(timeDetails).length > 0 || Object.keys(estimatedDetails).length > 0) {
             let timeHtml = '<ul class="time-details-list">';
             for (const [tab, time] of Object.entries(timeDetails)) {
                 timeHtml += `<li><strong>${escapeHtmlJs(tab)}:</strong> ${escapeHtmlJs(time)}</li>`;
             }
+            for (const [page, time] of Object.entries(estimatedDetails)) {
+                timeHtml += `<li><strong>${escapeHtmlJs(page)}:</strong> ${escapeHtmlJs(time)} (估計)</li>`;
+            }
             timeHtml += '</ul>';
             timeCell.innerHTML = timeHtml;
         } else {
@@ -162,6 +292,25 @@ function populateImageExplorerTab(data) {
 }
 
 
+// 取得報告中每張影像帶版本的 URL (可被瀏覽器長期快取)；失敗時回傳空物件，改用不帶版本的 URL
+function fetchKeyframeUrls(reportFilename) {
+    if (keyframeUrlCache.has(reportFilename)) return Promise.resolve(keyframeUrlCache.get(reportFilename));
+    return fetch(`/api/sequence_image_manifest?report_file=${encodeURIComponent(reportFilename)}`)
+        .then(response => {
+            if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+            return response.json();
+        })
+        .then(data => {
+            const images = data.images || {};
+            keyframeUrlCache.set(reportFilename, images);
+            return images;
+        })
+        .catch(error => {
+            console.warn('無法取得影像版本，改用不帶版本的 URL:', error);
+            return {};
+        });
+}
+
 // --- Modal 彈出視窗邏輯 ---
 function showImageModal(dataset) {
     const modal = document.getElementById("imageModal");
@@ -180,22 +329,78 @@ function showImageModal(dataset) {
     modal.style.display = "block";
     
     const imageArray = JSON.parse(images);
-    modalImageGrid.innerHTML = ''; // 清空
+    const params = new URLSearchParams({ report_file: reportFilename, behavior: behavior });
+    fetch(`/api/keyframe_contact_sheet?${params.toString()}`)
+        .then(response => {
+            if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+            return response.json();
+        })
+        .then(contactSheet => renderContactSheet(modalImageGrid, contactSheet))
+        .catch(error => {
+            console.warn('無法取得拼貼圖，改為逐張載入:', error);
+            renderModalImagesIndividually(modalImageGrid, reportFilename, imageArray);
+        });
+}
 
-    imageArray.forEach(imageFile => {
-        const imgContainer = document.createElement('div');
-        const img = document.createElement('img');
-        
-        const imgSrc = `/api/get_sequence_image?report_file=${encodeURIComponent(reportFilename)}&image_file=${encodeURIComponent(imageFile)}`;
-        
-        img.src = imgSrc;
-        img.alt = imageFile;
-        img.title = imageFile; // 添加 title 屬性，滑鼠懸停時顯示檔名
-        img.className = 'modal-image';
-        img.loading = 'lazy';
-        
-        imgContainer.appendChild(img);
-        modalImageGrid.appendChild(imgContainer);
+// 拼貼圖：一個請求取得整個行為的所有縮圖，再依 tiles 的位置切成個別的畫布
+function renderContactSheet(container, contactSheet) {
+    const binary = atob(contactSheet.sheet.data);
+    const bytes = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i++) bytes[i] = binary.charCodeAt(i);
+    const sheetUrl = URL.createObjectURL(new Blob([bytes], { type: contactSheet.sheet.mimetype }));
+
+    const sheetImage = new Image();
+    sheetImage.onload = () => {
+        container.innerHTML = ''; // 清空
+        contactSheet.tiles.forEach(tile => {
+            const imgContainer = document.createElement('div');
+            const canvas = document.createElement('canvas');
+            canvas.width = tile.width;
+            canvas.height = tile.height;
+            canvas.getContext('2d').drawImage(sheetImage, tile.x, tile.y, tile.width, tile.height, 0, 0, tile.width, tile.height);
+            canvas.title = tile.image_file; // 滑鼠懸停時顯示檔名
+            canvas.className = 'modal-image';
+            canvas.onclick = () => window.open(tile.url, '_blank'); // 點擊後開啟原圖
+            imgContainer.appendChild(canvas);
+            container.appendChild(imgContainer);
+        });
+        if (contactSheet.missing.length > 0 || contactSheet.truncated) {
+            const note = document.createElement('p');
+            note.textContent = contactSheet.truncated
+                ? '圖片數量過多，僅顯示部分圖片。'
+                : `有 ${contactSheet.missing.length} 張圖片未在伺服器上找到。`;
+            container.appendChild(note);
+        }
+        URL.revokeObjectURL(sheetUrl);
+    };
+    sheetImage.src = sheetUrl;
+}
+
+// 拼貼圖無法取得時的備用方式：每張圖片各自請求
+function renderModalImagesIndividually(modalImageGrid, reportFilename, imageArray) {
+    fetchKeyframeUrls(reportFilename).then(imageUrls => {
+        modalImageGrid.innerHTML = ''; // 清空
+
+        imageArray.forEach(imageFile => {
+            const imgContainer = document.createElement('div');
+            const img = document.createElement('img');
+
+            const versionedUrls = imageUrls[imageFile];
+            const imgSrc = versionedUrls && versionedUrls.url
+                ? versionedUrls.url
+                : `/api/get_sequence_image?report_file=${encodeURIComponent(reportFilename)}&image_file=${encodeURIComponent(imageFile)}`;
+
+            // 網格中只需縮圖，點擊後再開啟原圖
+            img.src = versionedUrls && versionedUrls.thumb_url ? versionedUrls.thumb_url : `${imgSrc}&size=thumb`;
+            img.alt = imageFile;
+            img.title = imageFile; // 添加 title 屬性，滑鼠懸停時顯示檔名
+            img.className = 'modal-image';
+            img.loading = 'lazy';
+            img.onclick = () => window.open(imgSrc, '_blank');
+
+            imgContainer.appendChild(img);
+            modalImageGrid.appendChild(imgContainer);
+        });
     });
 }
 
@@ -204,6 +409,7 @@ function showImageModal(dataset) {
 document.addEventListener('DOMContentLoaded', function() {
     // --- 獲取所有需要的DOM元素 ---
     const dateSelector = document.getElementById('dateSelector');
+    const classSelector = document.getElementById('classSelector'); // 只有負責多個班級的教師才會出現
     const loadReportButton = document.getElementById('loadReportButton');
     const loadingMessage = document.getElementById('loadingMessage');
     const errorMessage = document.getElementById('errorMessage');
@@ -223,7 +429,10 @@ document.addEventListener('DOMContentLoaded', function() {
         loadingMessage.style.display = 'block';
         loadingMessage.textContent = '正在加載可用報告日期...';
         
-        fetch('/api/teacher/available_report_dates')
+        const datesUrl = currentClassId
+            ? `/api/teacher/available_report_dates?class_id=${encodeURIComponent(currentClassId)}`
+            : '/api/teacher/available_report_dates';
+        fetch(datesUrl)
             .then(response => {
                 if (!response.ok) throw new Error('無法獲取報告日期列表');
                 return response.json();
@@ -255,10 +464,9 @@ document.addEventListener('DOMContentLoaded', function() {
     // --- API 呼叫：根據日期獲取學生摘要數據 ---
     function loadReportData() {
         const selectedDate = dateSelector.value;
-        let apiUrl = '/api/teacher/all_students_activity_summary';
-        if (selectedDate) {
-            apiUrl += `?date=${selectedDate}`;
-        }
+        const selectedClassId = currentClassId;
+        currentSummaryDate = selectedDate;
+        imageIndexLoaded = false;
 
         loadingMessage.style.display = 'block';
         loadingMessage.textContent = `正在查詢 ${selectedDate || '最新'} 的報告數據...`;
@@ -267,25 +475,30 @@ document.addEventListener('DOMContentLoaded', function() {
         document.querySelectorAll('.tab-button').forEach(btn => btn.classList.remove('active'));
 
 
-        fetch(apiUrl)
-            .then(response => {
-                if (!response.ok) {
-                    return response.json().then(err => { throw new Error(err.error || '伺服器響應錯誤'); });
-                }
-                return response.json();
-            })
-            .then(data => {
-                if (data.error) { throw new Error(data.error); }
-                
-                allStudentData = data;
+        const loadedStudents = [];
+        let timedOutCount = 0;
+        fetchStudentSummaryPages(selectedDate, 'web_activity,behavior_stats', (students, page) => {
+            loadedStudents.push(...students);
+            timedOutCount += page.timed_out_count || 0;
+            loadingMessage.textContent = `正在查詢 ${selectedDate || '最新'} 的報告數據... (已載入 ${loadedStudents.length} 位學生)`;
+        })
+            .then(() => {
+                if (selectedDate !== currentSummaryDate || selectedClassId !== currentClassId) return; // 期間已切換日期或班級
+                allStudentData = loadedStudents;
                 renderAllTabs(allStudentData);
 
                 loadingMessage.style.display = 'none';
+                if (timedOutCount > 0) {
+                    // 伺服器讀取部分學生報告逾時，這些學生會先顯示為「無報告」
+                    errorMessage.textContent = `注意: 有 ${timedOutCount} 位學生的報告讀取逾時，暫時顯示為「無報告」，請稍後重新查詢。`;
+                    errorMessage.style.display = 'block';
+                }
                 // 默認顯示第一個標籤頁
                 const firstTab = document.getElementById('webActivityTab');
                 if (firstTab) firstTab.style.display = 'block';
                 const firstTabButton = document.querySelector('.tab-button');
                 if (firstTabButton) firstTabButton.classList.add('active');
+                connectDashboardEvents(selectedDate, loadReportData);
             })
             .catch(handleError);
     }
@@ -302,11 +515,21 @@ document.addEventListener('DOMContentLoaded', function() {
     function renderAllTabs(data) {
         populateWebActivityTab(data);
         populateBehaviorStatsTab(data);
-        populateImageExplorerTab(data);
+        // 影像瀏覽頁簽在打開時才載入 (見 loadImageExplorerData)
+        const imageContainer = document.getElementById('imageExplorerContainer');
+        if (imageContainer) imageContainer.innerHTML = '';
     }
 
     // --- 事件監聽 ---
     loadReportButton.addEventListener('click', loadReportData);
+    if (classSelector) {
+        // 切換班級時，可用的報告日期也不同，重新取得日期後載入
+        classSelector.addEventListener('change', () => {
+            currentClassId = classSelector.value;
+            loadReportButton.disabled = true;
+            fetchAvailableDates();
+        });
+    }
     
     if (closeBtn) {
         closeBtn.onclick = () => modal.style.display = "none";